@@ -1,29 +1,49 @@
 import os
 import sys
+import hmac
 import threading
 import time
 import json
+import uuid
 import enum
-import requests
-from datetime import datetime
-from sqlalchemy import func, Date
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from datetime import datetime, timedelta
+from sqlalchemy import func, Date, or_, text
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, Boolean, Float, Enum
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, contains_eager
 from sqlalchemy.ext.declarative import declarative_base
-from bs4 import BeautifulSoup
-from concurrent.futures import ThreadPoolExecutor
-from bot.database import Base, User, Product, Order, OrderItem, CartItem, Category, init_db
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+from bot.database import Base, User, Product, Order, OrderItem, CartItem, OrderNote, OrderStatusHistory, Category, StockCheckRequest, init_db, create_db_engine
+from bot.leases import read_lease
+from bot.metrics import ADMIN_REQUEST_SECONDS, CONTENT_TYPE, db_call_site, render as render_metrics
+from bot.money import to_kopecks, format_rub
+from bot.catalog_cache import register_catalog_versioning
+from bot.ledger import apply_transaction, balance_history, SOURCE_ADMIN
+from bot.notifications import enqueue_notification
+from admin_panel.stats import get_stats, register_stats_invalidation
+from admin_panel.stock_checker import check_product_availability, enqueue_check
+from admin_panel.media_prewarm import start_prewarm
+from admin_panel.order_updates import BulkUpdateError, bulk_update_orders, parse_tracking_csv, status_message, tracking_message
+
+try:
+    from config import ADMIN_METRICS_TOKEN
+except ImportError:
+    ADMIN_METRICS_TOKEN = None
+
 app = Flask(__name__)
 app.secret_key = 'your-secret-key-here'
 app.config['SECRET_KEY'] = 'admin-panel-secret'
+app.jinja_env.filters['rub'] = format_rub
+# Ключ идемпотентности для форм, изменяющих баланс
+app.jinja_env.globals['new_request_key'] = lambda: uuid.uuid4().hex
 
-engine = create_engine('sqlite:///shared_database.db')
+engine = create_db_engine('admin')
 Session = sessionmaker(bind=engine)
+register_stats_invalidation(Session)
+register_catalog_versioning(Session)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -33,149 +53,25 @@ class AdminUser(UserMixin):
     def __init__(self, user_id):
         self.id = user_id
 
-class OrderNote(Base):
-    __tablename__ = 'order_notes'
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'))
-    text = Column(Text)
-    created_at = Column(DateTime, default=datetime.now)
-
-class OrderStatusHistory(Base):
-    __tablename__ = 'order_status_history'
-    id = Column(Integer, primary_key=True)
-    order_id = Column(Integer, ForeignKey('orders.id'))
-    status = Column(String(50))
-    changed_at = Column(DateTime, default=datetime.now)
-
-init_db()
-
-def send_telegram_notification(user_id, message):
-    try:
-        try:
-            from config import BOT_TOKEN
-        except ImportError:
-            print("⚠️ Файл config.py не найден!")
-            return False
-            
-        url = f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage"
-        
-        payload = {
-            'chat_id': int(user_id),
-            'text': message,
-            'parse_mode': 'HTML'
-        }
-        
-        response = requests.post(url, json=payload, timeout=10)
-        
-        if response.status_code == 200:
-            print(f"Уведомление отправлено пользователю {user_id}")
-            return True
-        else:
-            error_data = response.json()
-            print(f"Ошибка Telegram API: {response.status_code} - {error_data}")
-            return False
-            
-    except requests.exceptions.RequestException as e:
-        print(f"Ошибка сети при отправке уведомления: {e}")
-        return False
-    except Exception as e:
-        print(f"Неизвестная ошибка при отправке уведомления: {e}")
-        return False
-
-def check_product_availability(url):
-    """
-    Проверяет наличие товара на внешнем сайте
-    Возвращает True если товар в наличии, False если нет
-    """
-    try:
-        headers = {
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-            'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
-            'Accept-Encoding': 'gzip, deflate',
-            'Connection': 'keep-alive',
-            'Upgrade-Insecure-Requests': '1',
-        }
-        
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'html.parser')
-        
-        page_text = soup.get_text().lower().replace(' ', '')
-        
-        no_stock_indicators = [
-            'нетиспользоватьсейчас', 'нетвналичии', 'распродано', 'outofstock',
-            'недоступно', 'temporarilyoutofstock', 'ожидаетсяпоступление'
-        ]
-        
-        for indicator in no_stock_indicators:
-            if indicator in page_text:
-                return False
-        
-        add_to_cart_selectors = [
-            'a.btn--stock-info.cart-add',
-            'a[class*="cart-add"]',
-            'a[class*="add-to-cart"]',
-            'button[class*="cart-add"]',
-            'button[class*="add-to-cart"]',
-            'a.btn-primary[onclick*="cart"]',
-            'button.btn-primary[onclick*="cart"]'
-        ]
-        
-        for selector in add_to_cart_selectors:
-            if soup.select(selector):
-                return True
-        
-        cart_elements = soup.find_all(class_=lambda x: x and any(word in str(x).lower() for word in ['cart', 'add-to', 'buy', 'купить']))
-        if cart_elements:
-            for element in cart_elements:
-                if not any(word in element.get_text().lower() for word in ['нет', 'распродано', 'ожидается']):
-                    return True
-        
-        return False
-        
-    except Exception as e:
-        print(f"Ошибка при проверке товара {url}: {e}")
-        return False
+init_db('admin')
 
-def check_single_product(product_id):
-    db = Session()
-    try:
-        product = db.query(Product).filter(Product.id == product_id).first()
-        if product and product.external_url:
-            is_available = check_product_availability(product.external_url)
-            product.is_active = is_available
-            product.last_checked = datetime.now()
-            db.commit()
-            return (product_id, is_available)
-    except Exception as e:
-        print(f"Ошибка при проверке товара {product_id}: {e}")
-    finally:
-        db.close()
-    return (product_id, False)
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.call_site_token = db_call_site.set(f'admin:{request.endpoint}')
 
-def background_checker():
-    """Фоновая задача для проверки наличия товаров"""
-    while True:
-        try:
-            db = Session()
-            products = db.query(Product).filter(Product.external_url.isnot(None)).all()
-            
-            with ThreadPoolExecutor(max_workers=5) as executor:
-                results = list(executor.map(
-                    lambda p: check_single_product(p.id), 
-                    products
-                ))
-            
-            print(f"Проверено {len(results)} товаров")
-            time.sleep(3600)
-        except Exception as e:
-            print(f"Ошибка в фоновой задаче: {e}")
-            time.sleep(300)
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        ADMIN_REQUEST_SECONDS.observe(time.perf_counter() - started, request.endpoint or 'unknown', str(response.status_code))
+    return response
 
-checker_thread = threading.Thread(target=background_checker, daemon=True)
-checker_thread.start()
+@app.teardown_request
+def reset_call_site(exception=None):
+    token = g.pop('call_site_token', None)
+    if token is not None:
+        db_call_site.reset(token)
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -230,17 +126,15 @@ def logout():
 @app.route('/')
 @login_required
 def dashboard():
-    db = Session()
+    return render_template('dashboard.html', stats=get_stats(Session))
+
+@app.route('/api/stats')
+@login_required
+def api_stats():
     try:
-        stats = {
-            'total_users': db.query(User).count(),
-            'total_products': db.query(Product).count(),
-            'total_orders': db.query(Order).count(),
-            'pending_orders': db.query(Order).filter(Order.status == 'pending').count()
-        }
-        return render_template('dashboard.html', stats=stats)
-    finally:
-        db.close()
+        return jsonify(get_stats(Session))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 @app.route('/check_availability/<int:product_id>')
 @login_required
@@ -250,11 +144,11 @@ def check_availability(product_id):
     try:
         product = db.query(Product).filter(Product.id == product_id).first()
         if product and product.external_url:
-            is_available = check_product_availability(product.external_url)
-            product.is_active = is_available
-            product.last_checked = datetime.now()
-            db.commit()
-            flash(f'Товар {"в наличии" if is_available else "нет в наличии"}!', 'success')
+            if enqueue_check(db, product.id):
+                db.commit()
+                flash('Проверка наличия поставлена в очередь, статус обновится через несколько секунд', 'success')
+            else:
+                flash('Проверка этого товара уже в очереди', 'info')
         else:
             flash('Невозможно проверить товар без внешней ссылки!', 'warning')
         return redirect(url_for('products'))
@@ -267,32 +161,117 @@ def sync_all_products():
     """Синхронизировать все товары"""
     db = Session()
     try:
-        products = db.query(Product).filter(Product.external_url.isnot(None)).all()
-        checked_count = 0
-        available_count = 0
-        
-        for product in products:
-            is_available = check_product_availability(product.external_url)
-            product.is_active = is_available
-            product.last_checked = datetime.now()
-            if is_available:
-                available_count += 1
-            checked_count += 1
-        
-        db.commit()
-        flash(f'Проверено {checked_count} товаров. В наличии: {available_count}', 'success')
+        if enqueue_check(db):
+            db.commit()
+            flash('Проверка всех товаров поставлена в очередь', 'success')
+        else:
+            flash('Проверка всех товаров уже в очереди', 'info')
         return redirect(url_for('products'))
     finally:
         db.close()
 
+PRODUCT_SORT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'price': Product.price,
+    'category': Product.category,
+    'last_checked': Product.last_checked
+}
+
+def parse_bool_arg(name):
+    """Разбирает необязательный булев параметр запроса ('1'/'0')"""
+    value = request.args.get(name, '').lower()
+    if value in ('1', 'true', 'yes'):
+        return True
+    if value in ('0', 'false', 'no'):
+        return False
+    return None
+
 @app.route('/products', methods=['GET'])
 @login_required
 def products():
+    return render_template('products.html', categories=list(Category))
+
+@app.route('/api/products')
+@login_required
+def api_products():
+    """Постраничный список товаров с фильтрацией, поиском и сортировкой на стороне сервера"""
     db = Session()
     try:
-        products_list = db.query(Product).order_by(Product.category, Product.id.desc()).all()
-        
-        return render_template('products.html', products=products_list)
+        page = max(request.args.get('page', 1, type=int), 1)
+        per_page = min(max(request.args.get('per_page', 50, type=int), 1), 200)
+
+        query = db.query(
+            Product.id,
+            Product.name,
+            Product.description,
+            Product.price,
+            Product.category,
+            Product.photo_gif_id,
+            Product.external_url,
+            Product.is_active,
+            Product.last_checked
+        )
+
+        category = request.args.get('category')
+        if category:
+            try:
+                query = query.filter(Product.category == Category[category])
+            except KeyError:
+                return jsonify({'error': f'Неизвестная категория: {category}'}), 400
+
+        active = parse_bool_arg('active')
+        if active is not None:
+            query = query.filter(Product.is_active == active)
+
+        has_url = parse_bool_arg('has_url')
+        if has_url is True:
+            query = query.filter(Product.external_url.isnot(None), Product.external_url != '')
+        elif has_url is False:
+            query = query.filter(or_(Product.external_url.is_(None), Product.external_url == ''))
+
+        stale_hours = request.args.get('stale_hours', type=int)
+        if stale_hours:
+            threshold = datetime.now() - timedelta(hours=stale_hours)
+            query = query.filter(or_(Product.last_checked.is_(None), Product.last_checked < threshold))
+
+        search = request.args.get('q', '').strip()
+        if search:
+            pattern = f"%{search}%"
+            conditions = [Product.name.ilike(pattern), Product.description.ilike(pattern)]
+            if search.isdigit():
+                conditions.append(Product.id == int(search))
+            query = query.filter(or_(*conditions))
+
+        total = query.count()
+
+        sort = request.args.get('sort', '-id')
+        column = PRODUCT_SORT_FIELDS.get(sort.lstrip('-'), Product.id)
+        order_by = [column.desc() if sort.startswith('-') else column.asc(), Product.id.desc()]
+        if column is Product.last_checked:
+            order_by.insert(0, Product.last_checked.is_(None).desc())
+
+        rows = query.order_by(*order_by).offset((page - 1) * per_page).limit(per_page).all()
+
+        return jsonify({
+            'items': [{
+                'id': row.id,
+                'name': row.name,
+                'description': row.description or '',
+                'price': format_rub(row.price),
+                'category': row.category.name,
+                'photo_gif_id': row.photo_gif_id or '',
+                'external_url': row.external_url or '',
+                'is_active': bool(row.is_active),
+                'last_checked': row.last_checked.isoformat() if row.last_checked else None
+            } for row in rows],
+            'page': page,
+            'per_page': per_page,
+            'total': total,
+            'has_more': page * per_page < total
+        })
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
     finally:
         db.close()
 
@@ -307,12 +286,7 @@ def add_product():
         final_active = False
         
         if external_url:
-            is_available = check_product_availability(external_url)
-            final_active = is_available 
-            if is_available:
-                flash('Товар проверен и доступен в наличии!', 'success')
-            else:
-                flash('Товар проверен - нет в наличии!', 'warning')
+            flash('Товар добавлен неактивным, наличие по ссылке проверит фоновый воркер', 'info')
         elif is_active:
             final_active = True
             flash('⚠️ Товар активирован без проверки по ссылке!', 'warning')
@@ -320,15 +294,18 @@ def add_product():
         new_product = Product(
             name=request.form['name'],
             description=request.form['description'],
-            price=float(request.form['price']),
+            price=to_kopecks(request.form['price']),
             photo_gif_id=request.form.get('photo_gif_id', ''),
             external_url=external_url,
             category=request.form['category'],
-            is_active=final_active,
-            last_checked=datetime.now() if external_url else None
+            is_active=final_active
         )
         db.add(new_product)
+        db.flush()
+        if external_url:
+            enqueue_check(db, new_product.id)
         db.commit()
+        start_prewarm(engine, new_product.id, new_product.photo_gif_id)
         flash('Товар успешно добавлен!')
         return redirect(url_for('products'))
     finally:
@@ -344,18 +321,20 @@ def edit_product(product_id):
         if product:
             product.name = request.form['name']
             product.description = request.form['description']
-            product.price = float(request.form['price'])
+            product.price = to_kopecks(request.form['price'])
+            old_photo = product.photo_gif_id
             product.photo_gif_id = request.form.get('photo_gif_id', '')
+            photo_changed = product.photo_gif_id != old_photo
+            if photo_changed:
+                # Сохраненный file_id относится к старой картинке
+                product.photo_file_id = None
             old_external_url = product.external_url
             product.external_url = request.form.get('external_url', '') 
             product.category = request.form['category']
             
             if product.external_url and product.external_url != old_external_url:
-                is_available = check_product_availability(product.external_url)
-                product.is_active = is_available
-                product.last_checked = datetime.now()
-                status_msg = "в наличии" if is_available else "нет в наличии"
-                flash(f'Товар проверен - {status_msg}!', 'info')
+                enqueue_check(db, product.id)
+                flash('Ссылка изменена, наличие будет проверено в фоне', 'info')
             elif not product.external_url and 'is_active' in request.form:
                 product.is_active = True
                 flash('⚠️ Товар активирован без проверки по ссылке!', 'warning')
@@ -363,6 +342,8 @@ def edit_product(product_id):
                 product.is_active = False
             
             db.commit()
+            if photo_changed:
+                start_prewarm(engine, product.id, product.photo_gif_id)
             flash('Товар успешно обновлен!')
         
         return redirect(url_for('products'))
@@ -377,6 +358,7 @@ def delete_product(product_id):
         product = db.query(Product).filter(Product.id == product_id).first()
         if product:
             db.query(CartItem).filter(CartItem.product_id == product_id).delete()
+            db.query(StockCheckRequest).filter(StockCheckRequest.product_id == product_id).delete()
             
             order_items = db.query(OrderItem).filter(OrderItem.product_id == product_id).all()
             for item in order_items:
@@ -403,12 +385,30 @@ def delete_product(product_id):
 def debug_check(url):
     """Отладочная функция для проверки работы парсера"""
     result = check_product_availability(url)
+    if result is None:
+        message = 'Сайт поставщика недоступен'
+    else:
+        message = 'Товар в наличии' if result else 'Товара нет в наличии'
     return jsonify({
         'url': url,
         'available': result,
-        'message': 'Товар в наличии' if result else 'Товара нет в наличии'
+        'message': message
     })
 
+@app.route('/crawler_stats')
+@login_required
+def crawler_stats():
+    """Состояние воркера проверки наличия и метрики по доменам поставщиков"""
+    db = Session()
+    try:
+        pending = db.query(func.count(StockCheckRequest.id)).filter(StockCheckRequest.status == 'pending').scalar()
+        return jsonify({
+            'worker': read_lease(db, 'stock_checker'),
+            'pending_requests': pending
+        })
+    finally:
+        db.close()
+
 @app.route('/products/toggle/<int:product_id>')
 @login_required
 def toggle_product(product_id):
@@ -433,21 +433,75 @@ def toggle_product(product_id):
     finally:
         db.close()
 
+ORDER_TABS = [
+    ('active', 'В работе'),
+    ('pending', 'Ожидают'),
+    ('processing', 'Обрабатываются'),
+    ('shipped', 'Отправлены'),
+    ('cancelled', 'Отменены'),
+    ('delivered', 'Доставлены')
+]
+
+ORDERS_PER_PAGE = 50
+
 @app.route('/orders')
 @login_required
 def orders():
+    tab = request.args.get('tab', 'active')
+    if tab not in dict(ORDER_TABS):
+        tab = 'active'
+    page = max(request.args.get('page', 1, type=int), 1)
+    search = request.args.get('q', '').strip()
+
     db = Session()
     try:
-        active_orders = db.query(Order).filter(Order.status != 'delivered').order_by(Order.created_at.desc()).all()
-        
-        delivered_orders = db.query(Order).filter(Order.status == 'delivered').order_by(Order.created_at.desc()).all()
-        
-        for order in delivered_orders:
-            order.status_history = db.query(OrderStatusHistory).filter(
-                OrderStatusHistory.order_id == order.id
-            ).order_by(OrderStatusHistory.changed_at.desc()).all()
-            
-        return render_template('orders.html', orders=active_orders, delivered_orders=delivered_orders)
+        query = db.query(Order).outerjoin(Order.user).options(contains_eager(Order.user))
+        counts_query = db.query(Order.status, func.count(Order.id)).outerjoin(Order.user)
+
+        if search:
+            conditions = [Order.order_number.ilike(f"%{search}%"), User.username.ilike(f"%{search}%")]
+            if search.isdigit():
+                conditions.extend([Order.user_id == int(search), User.user_id == int(search)])
+            query = query.filter(or_(*conditions))
+            counts_query = counts_query.filter(or_(*conditions))
+
+        status_counts = dict(counts_query.group_by(Order.status).all())
+        tab_counts = {key: status_counts.get(key, 0) for key, _ in ORDER_TABS}
+        tab_counts['active'] = sum(count for status, count in status_counts.items() if status != 'delivered')
+
+        if tab == 'active':
+            query = query.filter(Order.status != 'delivered')
+        else:
+            query = query.filter(Order.status == tab)
+
+        total_pages = max((tab_counts[tab] + ORDERS_PER_PAGE - 1) // ORDERS_PER_PAGE, 1)
+        page = min(page, total_pages)
+
+        orders_list = query.order_by(Order.created_at.desc(), Order.id.desc()).offset(
+            (page - 1) * ORDERS_PER_PAGE
+        ).limit(ORDERS_PER_PAGE).all()
+
+        delivered_dates = {}
+        if tab == 'delivered' and orders_list:
+            delivered_dates = dict(db.query(
+                OrderStatusHistory.order_id,
+                func.max(OrderStatusHistory.changed_at)
+            ).filter(
+                OrderStatusHistory.order_id.in_([order.id for order in orders_list]),
+                OrderStatusHistory.status == 'delivered'
+            ).group_by(OrderStatusHistory.order_id).all())
+
+        return render_template(
+            'orders.html',
+            orders=orders_list,
+            delivered_dates=delivered_dates,
+            order_tabs=ORDER_TABS,
+            tab_counts=tab_counts,
+            tab=tab,
+            page=page,
+            total_pages=total_pages,
+            search=search
+        )
     finally:
         db.close()
 
@@ -461,7 +515,7 @@ def order_details(order_id):
             return jsonify({
                 'order_number': order.order_number,
                 'user_id': order.user_id,
-                'total_amount': order.total_amount,
+                'total_amount': format_rub(order.total_amount),
                 'status': order.status,
                 'tracking_number': order.tracking_number or '',
                 'shipping_address': order.shipping_address or '',
@@ -525,19 +579,15 @@ def update_tracking():
             order.tracking_number = tracking_number
             order.shipping_address = shipping_address
             order.phone_number = phone_number
-            db.commit()
             
             if tracking_number and tracking_number != old_tracking_number:
                 user = db.query(User).filter(User.id == order.user_id).first()
                 if user:
-                    message = (
-                        f"📦 <b>Обновление информации о заказе</b>\n\n"
-                        f"🔖 Номер заказа: #{order.order_number}\n"
-                        f"📦 Вашему заказу присвоен трек-номер: {tracking_number}\n\n"
-                        f"📍 Адрес доставки: {shipping_address or 'уточняется'}\n"
-                        f"📞 Телефон: {phone_number or 'уточняется'}"
-                    )
-                    send_telegram_notification(user.user_id, message)
+                    # Уведомление фиксируется вместе с изменением заказа, отправит воркер
+                    enqueue_notification(db, user.user_id, tracking_message(
+                        order.order_number, tracking_number, shipping_address, phone_number
+                    ))
+            db.commit()
             
         return jsonify({'success': True})
     except Exception as e:
@@ -604,31 +654,12 @@ def update_order_status(order_id):
             db.add(history)
             
             order.status = new_status
-            db.commit()
             
-            status_translations = {
-                'pending': '⏳ Ожидает обработки',
-                'processing': '🔧 Обрабатывается',
-                'shipped': '🚚 Отправлен',
-                'delivered': '✅ Доставлен',
-                'cancelled': '❌ Отменен'
-            }
-            
-            message = (
-                f"📦 <b>Обновление статуса заказа</b>\n\n"
-                f"🔖 Номер заказа: #{order.order_number}\n"
-                f"📊 Статус: {status_translations.get(new_status, new_status)}\n"
-            )
-            
-            if new_status == 'shipped' and order.tracking_number:
-                message += f"📦 Трек-номер: {order.tracking_number}\n"
-            
-            success = send_telegram_notification(user.user_id, message)
+            # Уведомление фиксируется вместе с изменением заказа, отправит воркер
+            enqueue_notification(db, user.user_id, status_message(order.order_number, new_status, order.tracking_number))
+            db.commit()
             
-            if success:
-                flash('✅ Статус заказа обновлен и уведомление отправлено!')
-            else:
-                flash('⚠️ Статус заказа обновлен, но уведомление не отправлено!')
+            flash('✅ Статус заказа обновлен, уведомление поставлено в очередь!')
         
         return redirect(url_for('orders'))
         
@@ -639,6 +670,46 @@ def update_order_status(order_id):
     finally:
         db.close()
 
+@app.route('/api/orders/bulk-update', methods=['POST'])
+@login_required
+def bulk_update_order_status():
+    """
+    Массовое обновление заказов одной транзакцией. JSON или форма:
+    order_ids + status - сменить статус выбранных заказов;
+    csv (текст или файл) строк "номер заказа,трек-номер" и, при желании,
+    status - проставить трек-номера и статус.
+    """
+    data = request.get_json(silent=True) or request.form
+    status = data.get('status') or None
+    notify = str(data.get('notify', 'true')).lower() not in ('0', 'false', 'off')
+    order_ids = data.get('order_ids') if request.is_json else request.form.getlist('order_ids')
+
+    csv_text = data.get('csv') or ''
+    if 'file' in request.files:
+        csv_text = request.files['file'].read().decode('utf-8-sig')
+    if not isinstance(csv_text, str):
+        return jsonify({'success': False, 'error': 'csv должен быть строкой'}), 400
+    if csv_text.strip() and order_ids:
+        # Заказы из CSV выбираются по номеру - вместе с order_ids непонятно, что обновлять
+        return jsonify({'success': False, 'error': 'Укажите либо order_ids, либо CSV'}), 400
+    tracking, errors = parse_tracking_csv(csv_text)
+    if csv_text.strip() and not tracking:
+        return jsonify({'success': False, 'error': 'В CSV нет ни одной строки с заказом', 'errors': errors}), 400
+
+    db = Session()
+    try:
+        result = bulk_update_orders(db, order_ids=order_ids, status=status, tracking=tracking, notify=notify)
+        db.commit()
+        return jsonify({'success': True, 'errors': errors, **result})
+    except BulkUpdateError as e:
+        db.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 400
+    except Exception as e:
+        db.rollback()
+        return jsonify({'success': False, 'error': str(e)}), 500
+    finally:
+        db.close()
+
 @app.route('/orders/<int:order_id>/status-history')
 @login_required
 def order_status_history(order_id):
@@ -698,14 +769,16 @@ def create_test_order():
                 username='test_user',
                 first_name='Test',
                 last_name='User',
-                balance=5000.0
+                balance=0
             )
             db.add(test_user)
+            db.flush()
+            apply_transaction(db, test_user, to_kopecks(5000), SOURCE_ADMIN, f'test-user-{test_user.id}', comment='Тестовый пользователь')
             db.commit()
         
         test_order = Order(
             user_id=test_user.id,
-            total_amount=2500.0,
+            total_amount=to_kopecks(2500),
             status='processing',
             tracking_number='RB123456789RU',
             shipping_address='г. Москва, ул. Тестовая, д. 123, кв. 45'
@@ -742,12 +815,20 @@ def create_test_order():
 def add_user_balance(user_id):
     db = Session()
     try:
-        user = db.query(User).filter(User.id == user_id).first()
+        user = db.query(User).filter(User.id == user_id).with_for_update().first()
         if user:
-            amount = float(request.form['amount'])
-            user.balance += amount
+            amount = to_kopecks(request.form['amount'])
+            # Ключ формы: повторная отправка той же формы (F5, двойной клик) не пополнит дважды
+            request_key = request.form.get('request_key') or uuid.uuid4().hex
+            _, applied = apply_transaction(
+                db, user, amount, SOURCE_ADMIN, request_key,
+                comment=f"Пополнение администратором {current_user.id}"
+            )
             db.commit()
-            flash(f'Баланс пользователя {user.username} пополнен на {amount} руб.!')
+            if applied:
+                flash(f'Баланс пользователя {user.username} пополнен на {format_rub(amount)} руб.!')
+            else:
+                flash('Это пополнение уже было выполнено', 'info')
         return redirect(url_for('users'))
     except Exception as e:
         db.rollback()
@@ -756,5 +837,66 @@ def add_user_balance(user_id):
     finally:
         db.close()
 
+@app.route('/api/users/<int:user_id>/balance-history')
+@login_required
+def user_balance_history(user_id):
+    """Журнал баланса пользователя, постранично: ?before=<created_at>&before_id=<id> последней записи"""
+    db = Session()
+    try:
+        before = request.args.get('before')
+        try:
+            before = datetime.fromisoformat(before) if before else None
+        except ValueError:
+            return jsonify({'error': 'before должен быть датой в формате ISO'}), 400
+        before_id = request.args.get('before_id')
+        if before_id is not None:
+            if before is None or not before_id.isdigit():
+                return jsonify({'error': 'before_id - целое число, указывается вместе с before'}), 400
+            before_id = int(before_id)
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+        rows = balance_history(db, user_id, limit=limit, before=before, before_id=before_id)
+        has_more = len(rows) == limit
+        return jsonify({
+            'items': [{
+                'id': row.id,
+                'amount': format_rub(row.amount),
+                'balance_after': format_rub(row.balance_after),
+                'source': row.source,
+                'external_id': row.external_id,
+                'comment': row.comment or '',
+                'created_at': row.created_at.isoformat()
+            } for row in rows],
+            'next_before': rows[-1].created_at.isoformat() if has_more else None,
+            'next_before_id': rows[-1].id if has_more else None
+        })
+    finally:
+        db.close()
+
+@app.route('/healthz')
+def healthz():
+    """Проверка живости для супервизора и балансировщика"""
+    db = Session()
+    try:
+        db.execute(text('SELECT 1'))
+        return jsonify({'status': 'ok'})
+    except Exception as e:
+        return jsonify({'status': 'error', 'error': str(e)}), 503
+    finally:
+        db.close()
+
+@app.route('/metrics')
+def metrics():
+    """
+    Метрики этого процесса в формате Prometheus (у каждого воркера gunicorn свои).
+    Доступны вошедшему администратору или с заголовком
+    Authorization: Bearer <ADMIN_METRICS_TOKEN> для Prometheus.
+    """
+    authorization = request.headers.get('Authorization', '')
+    token_ok = bool(ADMIN_METRICS_TOKEN) and hmac.compare_digest(authorization, f'Bearer {ADMIN_METRICS_TOKEN}')
+    if not token_ok and not current_user.is_authenticated:
+        # Prometheus не умеет входить через форму - отвечаем 401, а не редиректом
+        return Response('Unauthorized\n', status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return Response(render_metrics(), content_type=CONTENT_TYPE)
+
 if __name__ == '__main__':
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
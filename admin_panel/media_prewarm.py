@@ -0,0 +1,82 @@
+"""
+Прогрев Telegram file_id картинок товаров из админ-панели.
+
+После сохранения товара с новой картинкой она один раз отправляется от
+имени бота в служебный чат MEDIA_WARMUP_CHAT_ID, file_id из ответа
+записывается в товар, а служебное сообщение удаляется. Первый покупатель
+получает картинку уже по file_id. Без MEDIA_WARMUP_CHAT_ID прогрев
+выключен - file_id запомнит сам бот при первом просмотре товара.
+"""
+import time
+import threading
+import requests
+
+from bot.product_media import MEDIA_SEND_SECONDS, media_kind, save_file_id
+
+try:
+    from config import BOT_TOKEN
+except ImportError:
+    BOT_TOKEN = None
+
+try:
+    from config import MEDIA_WARMUP_CHAT_ID
+except ImportError:
+    MEDIA_WARMUP_CHAT_ID = None
+
+PREWARM_CONFIG = {
+    # Telegram сам скачивает файл у поставщика, это бывает долго
+    'timeout': 60
+}
+
+def telegram_call(method, payload):
+    response = requests.post(
+        f"https://api.telegram.org/bot{BOT_TOKEN}/{method}",
+        json=payload,
+        timeout=PREWARM_CONFIG['timeout']
+    )
+    data = response.json()
+    if not data.get('ok'):
+        raise RuntimeError(f"{method}: {data.get('description', response.status_code)}")
+    return data['result']
+
+def prewarm_product_media(engine, product_id, source):
+    """Отправляет картинку в служебный чат и сохраняет file_id товара"""
+    kind = media_kind(source)
+    method, field = ('sendAnimation', 'animation') if kind == 'animation' else ('sendPhoto', 'photo')
+
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        message = telegram_call(method, {
+            'chat_id': MEDIA_WARMUP_CHAT_ID,
+            field: source,
+            'disable_notification': True
+        })
+        outcome = 'ok'
+    except Exception as e:
+        print(f"Не удалось прогреть картинку товара {product_id}: {e}")
+        return None
+    finally:
+        MEDIA_SEND_SECONDS.observe(time.perf_counter() - started, kind, 'prewarm', outcome)
+
+    if kind == 'animation':
+        media = message.get('animation') or message.get('document') or {}
+        file_id = media.get('file_id')
+    else:
+        file_id = message['photo'][-1]['file_id'] if message.get('photo') else None
+    if file_id:
+        save_file_id(engine, product_id, source, file_id)
+
+    try:
+        telegram_call('deleteMessage', {'chat_id': MEDIA_WARMUP_CHAT_ID, 'message_id': message['message_id']})
+    except Exception as e:
+        print(f"Не удалось удалить служебное сообщение прогрева: {e}")
+    return file_id
+
+def start_prewarm(engine, product_id, source):
+    """Прогревает картинку в фоновом потоке, не задерживая ответ админки"""
+    if not source or not MEDIA_WARMUP_CHAT_ID or not BOT_TOKEN:
+        return None
+    thread = threading.Thread(target=prewarm_product_media, args=(engine, product_id, source), daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,161 @@
+"""
+Изменение статусов и трек-номеров заказов из админ-панели.
+
+Тексты уведомлений покупателям общие для изменения одного заказа и
+массового обновления. bulk_update_orders применяет изменения сотен
+заказов в транзакции вызывающего кода: заказы читаются одним запросом,
+статус меняется одним UPDATE, трек-номера - одним пакетным UPDATE по
+первичному ключу, история статусов и уведомления вставляются пачками.
+Уведомления доставляет воркер (см. bot/notifications.py).
+"""
+import csv
+import io
+from datetime import datetime
+from sqlalchemy import insert, update
+
+from bot.database import User, Order, OrderStatusHistory
+from bot.notifications import enqueue_notifications
+
+BULK_UPDATE_CONFIG = {
+    'max_orders': 1000
+}
+
+STATUS_TRANSLATIONS = {
+    'pending': '⏳ Ожидает обработки',
+    'processing': '🔧 Обрабатывается',
+    'shipped': '🚚 Отправлен',
+    'delivered': '✅ Доставлен',
+    'cancelled': '❌ Отменен'
+}
+
+# Заголовки первой строки CSV, которую нужно пропустить
+CSV_HEADER_NAMES = ('order_number', 'order', 'номер заказа', 'заказ')
+
+class BulkUpdateError(ValueError):
+    """Некорректный запрос массового обновления"""
+
+def status_message(order_number, status, tracking_number=None, tracking_assigned=False):
+    """tracking_assigned - трек-номер новый, показать его при любом статусе"""
+    message = (
+        f"📦 <b>Обновление статуса заказа</b>\n\n"
+        f"🔖 Номер заказа: #{order_number}\n"
+        f"📊 Статус: {STATUS_TRANSLATIONS.get(status, status)}\n"
+    )
+    if tracking_number and (status == 'shipped' or tracking_assigned):
+        message += f"📦 Трек-номер: {tracking_number}\n"
+    return message
+
+def tracking_message(order_number, tracking_number, shipping_address=None, phone_number=None):
+    return (
+        f"📦 <b>Обновление информации о заказе</b>\n\n"
+        f"🔖 Номер заказа: #{order_number}\n"
+        f"📦 Вашему заказу присвоен трек-номер: {tracking_number}\n\n"
+        f"📍 Адрес доставки: {shipping_address or 'уточняется'}\n"
+        f"📞 Телефон: {phone_number or 'уточняется'}"
+    )
+
+def parse_tracking_csv(text):
+    """
+    Строки "номер заказа,трек-номер" (разделитель запятая, точка с запятой
+    или табуляция). Возвращает ({номер заказа: трек-номер}, [ошибки])
+    """
+    text = (text or '').strip()
+    if not text:
+        return {}, []
+    try:
+        dialect = csv.Sniffer().sniff(text.splitlines()[0], delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+
+    tracking = {}
+    errors = []
+    for line_number, row in enumerate(csv.reader(io.StringIO(text), dialect), start=1):
+        cells = [cell.strip() for cell in row]
+        if not any(cells):
+            continue
+        if line_number == 1 and cells[0].lower() in CSV_HEADER_NAMES:
+            continue
+        if len(cells) < 2 or not cells[0] or not cells[1]:
+            errors.append(f"Строка {line_number}: нужны номер заказа и трек-номер")
+            continue
+        tracking[cells[0].lstrip('#')] = cells[1]
+    return tracking, errors
+
+def bulk_update_orders(db, order_ids=None, status=None, tracking=None, notify=True):
+    """
+    Меняет статус заказов order_ids (или заказов из tracking) и трек-номера
+    из tracking ({номер заказа: трек-номер}) в транзакции db, без commit.
+    Покупателю ставится одно уведомление на заказ: о статусе, если он
+    изменился (вместе с новым трек-номером, если он есть), иначе о новом
+    трек-номере.
+    Возвращает {'updated', 'notifications', 'not_found'}.
+    """
+    tracking = tracking or {}
+    if status is not None and (not isinstance(status, str) or status not in STATUS_TRANSLATIONS):
+        raise BulkUpdateError(f"Неизвестный статус: {status}")
+    if not order_ids and not tracking:
+        raise BulkUpdateError("Не выбраны заказы")
+    if status is None and not tracking:
+        raise BulkUpdateError("Не указан статус")
+
+    query = db.query(
+        Order.id, Order.order_number, Order.status, Order.tracking_number,
+        Order.shipping_address, Order.phone_number, User.user_id
+    ).outerjoin(User, User.id == Order.user_id)
+    if tracking:
+        keys = list(tracking)
+        query = query.filter(Order.order_number.in_(keys))
+    else:
+        try:
+            keys = sorted({int(order_id) for order_id in order_ids})
+        except (TypeError, ValueError):
+            raise BulkUpdateError("Некорректный id заказа")
+        query = query.filter(Order.id.in_(keys))
+    if len(keys) > BULK_UPDATE_CONFIG['max_orders']:
+        raise BulkUpdateError(f"За один раз можно обновить не больше {BULK_UPDATE_CONFIG['max_orders']} заказов")
+
+    orders = query.all()
+    found = {order.order_number if tracking else order.id for order in orders}
+    not_found = [key for key in keys if key not in found]
+
+    now = datetime.now()
+    status_changed = []
+    tracking_rows = []
+    history_rows = []
+    messages = []
+    for order in orders:
+        new_tracking = tracking.get(order.order_number)
+        tracking_changed = bool(new_tracking) and new_tracking != order.tracking_number
+        changes_status = status is not None and status != order.status
+        if tracking_changed:
+            tracking_rows.append({'id': order.id, 'tracking_number': new_tracking})
+        if changes_status:
+            status_changed.append(order.id)
+            history_rows.append({'order_id': order.id, 'status': status, 'changed_at': now})
+
+        if not notify or not order.user_id:
+            continue
+        if changes_status:
+            messages.append((order.user_id, status_message(
+                order.order_number, status,
+                new_tracking if tracking_changed else order.tracking_number,
+                tracking_assigned=tracking_changed
+            )))
+        elif tracking_changed:
+            messages.append((order.user_id, tracking_message(order.order_number, new_tracking, order.shipping_address, order.phone_number)))
+
+    if status_changed:
+        # Query.update, а не update(): на него реагирует сброс кэша статистики (after_bulk_update)
+        db.query(Order).filter(Order.id.in_(status_changed)).update(
+            {Order.status: status}, synchronize_session=False
+        )
+        db.execute(insert(OrderStatusHistory), history_rows)
+    if tracking_rows:
+        # Пакетный UPDATE по первичному ключу: разные значения для каждого заказа
+        db.execute(update(Order), tracking_rows)
+
+    return {
+        'updated': len({row['id'] for row in tracking_rows} | set(status_changed)),
+        'notifications': enqueue_notifications(db, messages),
+        'not_found': not_found
+    }
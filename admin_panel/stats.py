@@ -0,0 +1,110 @@
+"""
+Статистика для главной панели.
+
+Все показатели считаются одним агрегирующим запросом и кэшируются на
+STATS_CONFIG['ttl'] секунд. Кэш сбрасывается при коммите сессии админки,
+в которой менялись заказы или пользователи; изменения, сделанные ботом
+в другом процессе, становятся видны по истечении TTL.
+"""
+import time
+import threading
+from datetime import datetime, date
+from sqlalchemy import select, func, case, event
+from bot.database import User, Product, Order
+from bot.money import format_rub
+
+STATS_CONFIG = {
+    'ttl': 30
+}
+
+ORDER_STATUSES = ['pending', 'processing', 'shipped', 'delivered', 'cancelled']
+
+stats_cache = {'value': None, 'expires_at': 0.0}
+stats_lock = threading.Lock()
+
+def count_if(condition):
+    return func.coalesce(func.sum(case((condition, 1), else_=0)), 0)
+
+def compute_stats(db):
+    """Считает все показатели главной панели одним запросом"""
+    today_start = datetime.combine(date.today(), datetime.min.time())
+    not_cancelled = Order.status != 'cancelled'
+
+    statement = select(
+        select(func.count(User.id)).scalar_subquery().label('total_users'),
+        select(func.count(Product.id)).scalar_subquery().label('total_products'),
+        select(func.count(Product.id)).where(Product.is_active == True).scalar_subquery().label('active_products'),
+        func.count(Order.id).label('total_orders'),
+        func.coalesce(func.sum(case((not_cancelled, Order.total_amount), else_=0)), 0).label('revenue'),
+        count_if(Order.created_at >= today_start).label('today_orders'),
+        func.coalesce(func.sum(case(((Order.created_at >= today_start) & not_cancelled, Order.total_amount), else_=0)), 0).label('today_revenue'),
+        *[count_if(Order.status == status).label(f'status_{status}') for status in ORDER_STATUSES]
+    ).select_from(Order)
+
+    row = db.execute(statement).one()
+
+    return {
+        'total_users': row.total_users,
+        'total_products': row.total_products,
+        'active_products': row.active_products,
+        'total_orders': row.total_orders,
+        'pending_orders': row.status_pending,
+        'revenue': format_rub(row.revenue),
+        'today_orders': row.today_orders,
+        'today_revenue': format_rub(row.today_revenue),
+        'status_breakdown': {status: getattr(row, f'status_{status}') for status in ORDER_STATUSES},
+        'generated_at': datetime.now().isoformat()
+    }
+
+def get_stats(Session):
+    """Возвращает статистику из кэша или пересчитывает ее"""
+    now = time.monotonic()
+    cached = stats_cache['value']
+    if cached is not None and now < stats_cache['expires_at']:
+        return cached
+
+    with stats_lock:
+        if stats_cache['value'] is not None and time.monotonic() < stats_cache['expires_at']:
+            return stats_cache['value']
+
+        db = Session()
+        try:
+            value = compute_stats(db)
+        finally:
+            db.close()
+
+        stats_cache['value'] = value
+        stats_cache['expires_at'] = time.monotonic() + STATS_CONFIG['ttl']
+        return value
+
+def invalidate_stats():
+    stats_cache['expires_at'] = 0.0
+
+def register_stats_invalidation(Session):
+    """Сбрасывает кэш статистики после коммитов, затронувших заказы или пользователей"""
+
+    @event.listens_for(Session, 'after_flush')
+    def mark_stats_dirty(session, flush_context):
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, (Order, User)):
+                session.info['stats_dirty'] = True
+                break
+
+    @event.listens_for(Session, 'after_bulk_update')
+    def mark_stats_dirty_bulk_update(update_context):
+        if update_context.mapper.class_ in (Order, User):
+            update_context.session.info['stats_dirty'] = True
+
+    @event.listens_for(Session, 'after_bulk_delete')
+    def mark_stats_dirty_bulk_delete(delete_context):
+        if delete_context.mapper.class_ in (Order, User):
+            delete_context.session.info['stats_dirty'] = True
+
+    @event.listens_for(Session, 'after_commit')
+    def invalidate_on_commit(session):
+        if session.info.pop('stats_dirty', False):
+            invalidate_stats()
+
+    @event.listens_for(Session, 'after_rollback')
+    def forget_dirty_on_rollback(session):
+        session.info.pop('stats_dirty', None)
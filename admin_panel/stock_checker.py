@@ -0,0 +1,480 @@
+"""
+Проверка наличия товаров на сайтах поставщиков.
+
+Загрузка страниц идет в пуле потоков через SupplierCrawler (лимиты и
+circuit breaker по доменам), а запись результатов в БД делает один поток
+пачками: last_checked обновляется одним UPDATE на пачку, is_active - одним
+executemany только для товаров, у которых наличие действительно
+изменилось. Об изменениях оповещаются подписчики (кэши каталога и т.п.)
+через subscribe_availability_changes.
+
+Плановые проходы и заявки из админ-панели (таблица stock_check_requests)
+выполняет отдельный процесс worker.py; админ-панель только ставит заявки
+через enqueue_check и читает результаты.
+"""
+import json
+import math
+import time
+import random
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from bs4 import BeautifulSoup
+from sqlalchemy import select, update
+from bot.database import Product, StockCheckRequest
+from bot.metrics import CRAWLER_FETCH_SECONDS, CRAWLER_PARSE_SECONDS
+
+CHECKER_CONFIG = {
+    'max_workers': 5,
+    'batch_size': 50,
+    'sweep_interval': 3600,
+    'error_interval': 300
+}
+
+CRAWLER_CONFIG = {
+    'timeout': 15,
+    'min_host_interval': 1.0,
+    'max_attempts': 3,
+    'backoff_base': 2.0,
+    'backoff_max': 30.0,
+    'failure_threshold': 5,
+    'circuit_cooldown': 900,
+    'retry_budget_ratio': 0.1,
+    'retry_budget_min': 5,
+    'latency_samples': 500
+}
+
+CRAWLER_HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
+    'Accept-Language': 'ru-RU,ru;q=0.8,en-US;q=0.5,en;q=0.3',
+    'Accept-Encoding': 'gzip, deflate',
+    'Connection': 'keep-alive',
+    'Upgrade-Insecure-Requests': '1',
+}
+
+availability_listeners = []
+
+def subscribe_availability_changes(listener):
+    """
+    Подписывает обработчик на изменения наличия.
+    Обработчик получает список событий вида
+    {'product_id': ..., 'is_active': ..., 'checked_at': ...}
+    """
+    availability_listeners.append(listener)
+    return listener
+
+def emit_availability_changes(events):
+    """Рассылает события об изменении наличия всем подписчикам"""
+    if not events:
+        return
+    for listener in list(availability_listeners):
+        try:
+            listener(events)
+        except Exception as e:
+            print(f"Ошибка в обработчике изменений наличия: {e}")
+
+def parse_retry_after(value):
+    """
+    Retry-After в секундах (число или HTTP-дата), не меньше 0.
+    None, если заголовка нет или его не разобрать.
+    """
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    if math.isnan(seconds):
+        return None
+    return max(seconds, 0.0)
+
+class CrawlerError(Exception):
+    """Ошибка загрузки страницы поставщика"""
+    def __init__(self, message, retryable=True, retry_after=None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class SupplierCrawler:
+    """
+    Загрузчик страниц поставщиков с вежливостью по доменам.
+
+    Для каждого хоста соблюдается минимальный интервал между запросами,
+    неудачные запросы повторяются с экспоненциальной задержкой и джиттером
+    в пределах бюджета повторов на обход, а после серии ошибок хост
+    отключается автоматом (circuit breaker) - его товары получают
+    результат None ("неизвестно") и сохраняют прежний is_active.
+    Retry-After дольше backoff_max тоже отключает хост: держать поток
+    обхода столько времени нельзя.
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(CRAWLER_CONFIG)
+        if config:
+            self.config.update(config)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+        self.retry_budget = self.config['retry_budget_min']
+        self.budget_lock = threading.Lock()
+
+    def get_host(self, host):
+        with self.hosts_lock:
+            if host not in self.hosts:
+                self.hosts[host] = {
+                    'lock': threading.Lock(),
+                    'next_request_at': 0.0,
+                    'consecutive_failures': 0,
+                    'circuit_open_until': 0.0,
+                    'requests': 0,
+                    'successes': 0,
+                    'failures': 0,
+                    'skipped': 0,
+                    'latencies': deque(maxlen=self.config['latency_samples'])
+                }
+            return self.hosts[host]
+
+    def start_sweep(self, products_count):
+        """Выделяет бюджет повторов на новый обход"""
+        with self.budget_lock:
+            self.retry_budget = max(
+                self.config['retry_budget_min'],
+                int(products_count * self.config['retry_budget_ratio'])
+            )
+
+    def take_retry(self):
+        with self.budget_lock:
+            if self.retry_budget <= 0:
+                return False
+            self.retry_budget -= 1
+            return True
+
+    def is_circuit_open(self, state):
+        return time.monotonic() < state['circuit_open_until']
+
+    def wait_for_slot(self, state):
+        """Ждет, пока хост можно снова запрашивать"""
+        with state['lock']:
+            now = time.monotonic()
+            wait = state['next_request_at'] - now
+            state['next_request_at'] = max(now, state['next_request_at']) + self.config['min_host_interval']
+        if wait > 0:
+            time.sleep(wait)
+
+    def record_success(self, state, latency):
+        with state['lock']:
+            state['requests'] += 1
+            state['successes'] += 1
+            state['consecutive_failures'] = 0
+            state['circuit_open_until'] = 0.0
+            state['latencies'].append(latency)
+
+    def record_failure(self, state, latency, retry_after=None):
+        with state['lock']:
+            state['requests'] += 1
+            state['failures'] += 1
+            state['consecutive_failures'] += 1
+            state['latencies'].append(latency)
+            now = time.monotonic()
+            if retry_after is not None and retry_after > self.config['backoff_max']:
+                state['circuit_open_until'] = now + self.config['circuit_cooldown']
+                return True
+            if retry_after:
+                state['next_request_at'] = max(state['next_request_at'], now + retry_after)
+            if state['consecutive_failures'] >= self.config['failure_threshold']:
+                state['circuit_open_until'] = now + self.config['circuit_cooldown']
+                return True
+        return False
+
+    def backoff_delay(self, attempt):
+        delay = min(self.config['backoff_max'], self.config['backoff_base'] * (2 ** attempt))
+        return random.uniform(0, delay)
+
+    def fetch(self, url):
+        response = requests.get(url, headers=CRAWLER_HEADERS, timeout=self.config['timeout'])
+        if response.status_code == 429 or response.status_code >= 500:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            raise CrawlerError(f"HTTP {response.status_code}", retry_after=retry_after)
+        if response.status_code in (404, 410):
+            return None
+        if response.status_code >= 400:
+            raise CrawlerError(f"HTTP {response.status_code}", retryable=False)
+        return response.text
+
+    def check(self, url):
+        """
+        Проверяет наличие товара по ссылке.
+        Возвращает True/False, или None если хост недоступен.
+        """
+        host = urlparse(url).netloc.lower()
+        state = self.get_host(host)
+
+        if self.is_circuit_open(state):
+            with state['lock']:
+                state['skipped'] += 1
+            return None
+
+        attempt = 0
+        while True:
+            self.wait_for_slot(state)
+            started = time.monotonic()
+            try:
+                html = self.fetch(url)
+            except (requests.exceptions.RequestException, CrawlerError) as e:
+                retryable = getattr(e, 'retryable', True)
+                retry_after = getattr(e, 'retry_after', None)
+                elapsed = time.monotonic() - started
+                CRAWLER_FETCH_SECONDS.observe(elapsed, host, 'error')
+                circuit_opened = self.record_failure(state, elapsed, retry_after)
+                if circuit_opened:
+                    print(f"⚠️ Хост {host} временно отключен: {e}")
+                    return None
+                if not retryable or attempt + 1 >= self.config['max_attempts'] or not self.take_retry():
+                    print(f"Ошибка при проверке товара {url}: {e}")
+                    return None
+                if not retry_after:
+                    time.sleep(self.backoff_delay(attempt))
+                attempt += 1
+                continue
+
+            elapsed = time.monotonic() - started
+            CRAWLER_FETCH_SECONDS.observe(elapsed, host, 'ok' if html is not None else 'not_found')
+            self.record_success(state, elapsed)
+            if html is None:
+                return False
+            with CRAWLER_PARSE_SECONDS.time(host):
+                return parse_availability(html)
+
+    def get_metrics(self):
+        """Метрики по доменам: доля успешных запросов и задержки"""
+        metrics = {}
+        with self.hosts_lock:
+            hosts = list(self.hosts.items())
+        for host, state in hosts:
+            with state['lock']:
+                latencies = sorted(state['latencies'])
+                requests_count = state['requests']
+                metrics[host] = {
+                    'requests': requests_count,
+                    'successes': state['successes'],
+                    'failures': state['failures'],
+                    'skipped': state['skipped'],
+                    'success_rate': round(state['successes'] / requests_count, 3) if requests_count else None,
+                    'avg_latency': round(sum(latencies) / len(latencies), 3) if latencies else None,
+                    'p95_latency': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3) if latencies else None,
+                    'circuit_open': self.is_circuit_open(state)
+                }
+        return metrics
+
+def parse_availability(html):
+    """Определяет наличие товара по HTML страницы"""
+    soup = BeautifulSoup(html, 'html.parser')
+
+    page_text = soup.get_text().lower().replace(' ', '')
+
+    no_stock_indicators = [
+        'нетиспользоватьсейчас', 'нетвналичии', 'распродано', 'outofstock',
+        'недоступно', 'temporarilyoutofstock', 'ожидаетсяпоступление'
+    ]
+
+    for indicator in no_stock_indicators:
+        if indicator in page_text:
+            return False
+
+    add_to_cart_selectors = [
+        'a.btn--stock-info.cart-add',
+        'a[class*="cart-add"]',
+        'a[class*="add-to-cart"]',
+        'button[class*="cart-add"]',
+        'button[class*="add-to-cart"]',
+        'a.btn-primary[onclick*="cart"]',
+        'button.btn-primary[onclick*="cart"]'
+    ]
+
+    for selector in add_to_cart_selectors:
+        if soup.select(selector):
+            return True
+
+    cart_elements = soup.find_all(class_=lambda x: x and any(word in str(x).lower() for word in ['cart', 'add-to', 'buy', 'купить']))
+    if cart_elements:
+        for element in cart_elements:
+            if not any(word in element.get_text().lower() for word in ['нет', 'распродано', 'ожидается']):
+                return True
+
+    return False
+
+crawler = SupplierCrawler()
+
+def check_product_availability(url):
+    """
+    Проверяет наличие товара на внешнем сайте
+    Возвращает True если товар в наличии, False если нет,
+    None если сайт поставщика сейчас недоступен
+    """
+    return crawler.check(url)
+
+def write_back_results(db, results, checked_at=None):
+    """
+    Записывает пачку результатов проверки одной транзакцией.
+    results - список (product_id, is_available).
+    Результаты None (сайт недоступен) пропускаются: is_active и
+    last_checked таких товаров не меняются.
+    Текущее is_active читается в той же транзакции после UPDATE
+    last_checked, который уже заблокировал строки: изменение из
+    админ-панели, сделанное во время проверки, не затирается
+    устаревшим снимком и не дает ложных событий.
+    Возвращает список событий об изменении наличия.
+    """
+    results = [(product_id, is_available) for product_id, is_available in results if is_available is not None]
+    if not results:
+        return []
+
+    checked_at = checked_at or datetime.now()
+    checked_ids = [product_id for product_id, _ in results]
+
+    db.execute(
+        update(Product)
+        .where(Product.id.in_(checked_ids))
+        .values(last_checked=checked_at)
+        .execution_options(synchronize_session=False)
+    )
+    current_states = dict(db.execute(select(Product.id, Product.is_active).where(Product.id.in_(checked_ids))).all())
+    changes = [
+        {'id': product_id, 'is_active': is_available}
+        for product_id, is_available in results
+        # Товар удален во время проверки - обновлять нечего
+        if product_id in current_states and current_states[product_id] != is_available
+    ]
+    if changes:
+        db.execute(update(Product), changes)
+    db.commit()
+
+    return [
+        {'product_id': change['id'], 'is_active': change['is_active'], 'checked_at': checked_at}
+        for change in changes
+    ]
+
+def load_checkable_products(Session, product_ids=None):
+    """Возвращает (id, external_url) товаров с внешней ссылкой"""
+    db = Session()
+    try:
+        query = db.query(Product.id, Product.external_url).filter(
+            Product.external_url.isnot(None),
+            Product.external_url != ''
+        )
+        if product_ids is not None:
+            query = query.filter(Product.id.in_(product_ids))
+        return query.order_by(Product.id).all()
+    finally:
+        db.close()
+
+def flush_batch(Session, batch):
+    db = Session()
+    try:
+        events = write_back_results(db, batch)
+    except Exception as e:
+        db.rollback()
+        print(f"Ошибка при записи результатов проверки: {e}")
+        return []
+    finally:
+        db.close()
+
+    emit_availability_changes(events)
+    return events
+
+def run_sweep(Session, product_ids=None, max_workers=None, batch_size=None):
+    """
+    Проверяет товары с внешними ссылками и записывает результаты пачками.
+    Возвращает статистику проверки.
+    """
+    max_workers = max_workers or CHECKER_CONFIG['max_workers']
+    batch_size = batch_size or CHECKER_CONFIG['batch_size']
+
+    products = load_checkable_products(Session, product_ids)
+    stats = {'checked': 0, 'available': 0, 'unknown': 0, 'changed': 0}
+    crawler.start_sweep(len(products))
+
+    batch = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        availability = executor.map(lambda p: check_product_availability(p.external_url), products)
+        for product, is_available in zip(products, availability):
+            batch.append((product.id, is_available))
+            stats['checked'] += 1
+            if is_available is None:
+                stats['unknown'] += 1
+            elif is_available:
+                stats['available'] += 1
+
+            if len(batch) >= batch_size:
+                stats['changed'] += len(flush_batch(Session, batch))
+                batch = []
+
+    stats['changed'] += len(flush_batch(Session, batch))
+    return stats
+
+def enqueue_check(db, product_id=None):
+    """
+    Ставит проверку товара (product_id=None - всех товаров) в очередь воркера.
+    Коммит делает вызывающий код. Возвращает False, если такая заявка уже ждет.
+    """
+    query = db.query(StockCheckRequest.id).filter(StockCheckRequest.status == 'pending')
+    if product_id is None:
+        query = query.filter(StockCheckRequest.product_id.is_(None))
+    else:
+        query = query.filter(StockCheckRequest.product_id == product_id)
+    if query.first():
+        return False
+
+    db.add(StockCheckRequest(product_id=product_id))
+    return True
+
+def process_check_requests(Session):
+    """
+    Выполняет ожидающие заявки из админ-панели одним проходом: если среди них
+    есть заявка на все товары - полная проверка, иначе только выбранные товары.
+    Возвращает статистику или None, если заявок нет.
+    """
+    db = Session()
+    try:
+        pending = db.query(StockCheckRequest.id, StockCheckRequest.product_id).filter(
+            StockCheckRequest.status == 'pending'
+        ).order_by(StockCheckRequest.id).all()
+    finally:
+        db.close()
+
+    if not pending:
+        return None
+
+    request_ids = [row.id for row in pending]
+    if any(row.product_id is None for row in pending):
+        product_ids = None
+    else:
+        product_ids = sorted({row.product_id for row in pending})
+
+    try:
+        stats = run_sweep(Session, product_ids=product_ids)
+        status = 'done'
+    except Exception as e:
+        print(f"Ошибка при выполнении заявок на проверку: {e}")
+        stats = {'error': str(e)}
+        status = 'failed'
+
+    db = Session()
+    try:
+        db.execute(
+            update(StockCheckRequest)
+            .where(StockCheckRequest.id.in_(request_ids))
+            .values(status=status, finished_at=datetime.now(), result=json.dumps(stats))
+        )
+        db.commit()
+    finally:
+        db.close()
+
+    return stats
@@ -1,17 +1,15 @@
 #!/usr/bin/env python3
 import sys
 import os
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from werkzeug.security import generate_password_hash
-from bot.database import User, Base, init_db
+from bot.database import User, Base, init_db, create_db_engine
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
 class SimpleAdminManager:
     def __init__(self):
-        db_path = os.path.join(os.path.dirname(__file__), '..', 'shared_database.db')
-        self.engine = create_engine(f'sqlite:///{db_path}', echo=False)
+        self.engine = create_db_engine('cli')
         self.Session = sessionmaker(bind=self.engine)
     
     def show_admins_simple(self):
@@ -0,0 +1,135 @@
+"""
+Кэш результатов поиска товаров и версия каталога.
+
+Результат поиска - кортеж id активных товаров - кэшируется по
+нормализованному запросу ("ELF  Bar" и "elf bar" дают одну запись) с
+ограничением по размеру и TTL. Каждая запись помнит версию каталога из
+таблицы catalog_version, при которой посчитана; любая запись товаров
+(админ-панель, воркер проверки наличия) увеличивает версию, и старые
+записи перестают использоваться во всех процессах сразу.
+"""
+import re
+import time
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from sqlalchemy import select, update, insert, event, func
+
+try:
+    from database import Product, CatalogVersion
+    from metrics import counter, gauge_function
+except ImportError:
+    from bot.database import Product, CatalogVersion
+    from bot.metrics import counter, gauge_function
+
+SEARCH_CACHE_CONFIG = {
+    'max_entries': 1000,
+    'ttl': 300,
+    'max_ids': 500
+}
+
+SEARCH_CACHE_REQUESTS = counter('shop_search_cache_requests_total', 'Обращения к кэшу поиска', ['result'])
+
+def normalize_query(text):
+    """Нижний регистр, ё -> е, одиночные пробелы"""
+    return re.sub(r'\s+', ' ', (text or '').lower().replace('ё', 'е')).strip()
+
+def normalized_column(column):
+    """
+    Значение столбца так же, как normalize_query: нижний регистр и ё -> е,
+    иначе запрос "елка" не найдет товар "Ёлка"
+    """
+    return func.replace(func.lower(column), 'ё', 'е')
+
+def get_catalog_version(connection):
+    version = connection.execute(select(CatalogVersion.version).where(CatalogVersion.id == 1)).scalar()
+    return version or 0
+
+def bump_catalog_version(connection):
+    """Увеличивает версию каталога в текущей транзакции"""
+    result = connection.execute(
+        update(CatalogVersion)
+        .where(CatalogVersion.id == 1)
+        .values(version=CatalogVersion.version + 1, updated_at=datetime.now())
+    )
+    if not result.rowcount:
+        connection.execute(insert(CatalogVersion).values(id=1, version=1, updated_at=datetime.now()))
+
+def bump_catalog_version_on(engine):
+    with engine.begin() as connection:
+        bump_catalog_version(connection)
+
+def register_catalog_versioning(Session):
+    """Увеличивает версию каталога при любой записи товаров через сессии Session"""
+
+    @event.listens_for(Session, 'after_flush')
+    def bump_on_product_flush(session, flush_context):
+        for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+            if isinstance(instance, Product):
+                bump_catalog_version(session.connection())
+                break
+
+    @event.listens_for(Session, 'after_bulk_update')
+    def bump_on_product_bulk_update(update_context):
+        if update_context.mapper.class_ is Product:
+            bump_catalog_version(update_context.session.connection())
+
+    @event.listens_for(Session, 'after_bulk_delete')
+    def bump_on_product_bulk_delete(delete_context):
+        if delete_context.mapper.class_ is Product:
+            bump_catalog_version(delete_context.session.connection())
+
+class SearchCache:
+    def __init__(self, max_entries=None, ttl=None):
+        self.max_entries = max_entries or SEARCH_CACHE_CONFIG['max_entries']
+        self.ttl = ttl or SEARCH_CACHE_CONFIG['ttl']
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, version):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            entry_version, expires_at, product_ids = entry
+            if entry_version != version or expires_at <= time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return product_ids
+
+    def put(self, key, version, product_ids):
+        with self.lock:
+            self.entries[key] = (version, time.monotonic() + self.ttl, product_ids)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+search_cache = SearchCache()
+gauge_function('shop_search_cache_entries', 'Записи в кэше поиска', lambda: len(search_cache))
+
+def search_product_ids(db, text):
+    """Id активных товаров, подходящих под запрос, из кэша или одним запросом к БД"""
+    key = normalize_query(text)
+    if not key:
+        return ()
+
+    version = get_catalog_version(db)
+    product_ids = search_cache.get(key, version)
+    if product_ids is not None:
+        SEARCH_CACHE_REQUESTS.inc('hit')
+        return product_ids
+
+    SEARCH_CACHE_REQUESTS.inc('miss')
+    rows = db.execute(
+        select(Product.id)
+        .where(normalized_column(Product.name).like(f"%{key}%"), Product.is_active == True)
+        .order_by(Product.id)
+        .limit(SEARCH_CACHE_CONFIG['max_ids'])
+    )
+    product_ids = tuple(row.id for row in rows)
+    search_cache.put(key, version, product_ids)
+    return product_ids
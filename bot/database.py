@@ -1,14 +1,85 @@
-import uuid
 import os
 import enum
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, DateTime, Text, ForeignKey, Enum
+from sqlalchemy import create_engine, event, Column, Integer, BigInteger, String, Boolean, DateTime, Text, ForeignKey, Enum, Index, UniqueConstraint
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 
+try:
+    from migrations import run_migrations
+    from money import Money
+    from order_numbers import next_order_number
+    from metrics import instrument_engine
+except ImportError:
+    from bot.migrations import run_migrations
+    from bot.money import Money
+    from bot.order_numbers import next_order_number
+    from bot.metrics import instrument_engine
+
 Base = declarative_base()
 
+PROJECT_ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+DB_PATH = os.path.join(PROJECT_ROOT, 'shared_database.db')
+
+# Настройки пула соединений для разных типов процессов
+ENGINE_PROFILES = {
+    'bot': {'pool_size': 5, 'max_overflow': 10},
+    'admin': {'pool_size': 4, 'max_overflow': 4},
+    'worker': {'pool_size': 2, 'max_overflow': 2},
+    'cli': {'pool_size': 1, 'max_overflow': 0}
+}
+
+# WAL позволяет читать во время записи другого процесса,
+# busy_timeout - ждать освобождения блокировки вместо ошибки "database is locked"
+SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 15000,
+    'mmap_size': 268435456,
+    'cache_size': -32000,
+    'temp_store': 'MEMORY'
+}
+
+# Для PostgreSQL пулы больше: блокировки на уровне строк позволяют
+# нескольким процессам писать одновременно
+POSTGRES_POOL = {
+    'pool_size_factor': 2,
+    'pool_recycle': 1800,
+    'pool_timeout': 30
+}
+
+engines = {}
+
+def get_database_url():
+    """
+    Адрес базы для всех точек входа (бот, админка, CLI, воркеры).
+    Приоритет: переменная окружения DATABASE_URL, DATABASE_URL из config.py,
+    DATABASE_PATH из config.py (файл SQLite), файл shared_database.db в корне проекта.
+    """
+    url = os.environ.get('DATABASE_URL')
+    if url:
+        return url
+
+    try:
+        from config import DATABASE_URL
+    except ImportError:
+        DATABASE_URL = None
+    if DATABASE_URL:
+        return DATABASE_URL
+
+    try:
+        from config import DATABASE_PATH
+    except ImportError:
+        DATABASE_PATH = None
+    path = DB_PATH
+    if DATABASE_PATH:
+        path = DATABASE_PATH if os.path.isabs(DATABASE_PATH) else os.path.join(PROJECT_ROOT, DATABASE_PATH)
+    return f'sqlite:///{os.path.abspath(path)}'
+
+def is_sqlite(engine):
+    return engine.dialect.name == 'sqlite'
+
 class Category(enum.Enum):
     DISPOSABLE = "Одноразовые вейпы"
     HOOKAH = "Электронные кальяны"
@@ -19,18 +90,18 @@ class Category(enum.Enum):
     TOBACCO = "Табак для кальяна"
 
 def generate_order_id():
-    return str(uuid.uuid4())[:8].upper()
+    return next_order_number()
 
 class User(Base):
     __tablename__ = 'users'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
-    user_id = Column(Integer, unique=True, nullable=False)
+    user_id = Column(BigInteger, unique=True, nullable=False)  # Telegram ID не помещается в 32 бита
     username = Column(String(100))
     first_name = Column(String(100))
     last_name = Column(String(100))
     password_hash = Column(String(200))
-    balance = Column(Float, default=0.0)
+    balance = Column(Money, default=0)  # копейки
     orders_count = Column(Integer, default=0)
     is_admin = Column(Boolean, default=False)
     is_banned = Column(Boolean, default=False)
@@ -51,14 +122,20 @@ class Product(Base):
     id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String(100), nullable=False)
     description = Column(Text)
-    price = Column(Float, nullable=False)
+    price = Column(Money, nullable=False)  # копейки
     photo_gif_id = Column(String(200))
+    # file_id картинки в Telegram, сохраняется после первой отправки (см. product_media.py)
+    photo_file_id = Column(String(200))
     external_url = Column(String(500))
     quantity = Column(Integer, default=0)
     category = Column(Enum(Category), nullable=False)
     is_active = Column(Boolean, default=False)
     created_at = Column(DateTime, default=datetime.now)
-    last_checked = Column(DateTime) 
+    last_checked = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_products_category_active', 'category', 'is_active'),
+    )
 
 class CartItem(Base):
     __tablename__ = 'cart_items'
@@ -71,12 +148,16 @@ class CartItem(Base):
     user = relationship("User", back_populates="cart_items")
     product = relationship("Product")
 
+    __table_args__ = (
+        Index('ix_cart_items_user_product', 'user_id', 'product_id'),
+    )
+
 class Order(Base):
     __tablename__ = 'orders'
     
     id = Column(Integer, primary_key=True, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'))
-    total_amount = Column(Float)
+    total_amount = Column(Money)  # копейки
     status = Column(String(50), default='pending')
     tracking_number = Column(String(100), nullable=True)
     shipping_address = Column(Text, nullable=True)
@@ -87,6 +168,12 @@ class Order(Base):
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order")
 
+    __table_args__ = (
+        Index('ix_orders_user_created', 'user_id', 'created_at'),
+        Index('ix_orders_status_created', 'status', 'created_at'),
+        Index('ix_orders_created', 'created_at'),
+    )
+
 class OrderItem(Base):
     __tablename__ = 'order_items'
     
@@ -94,59 +181,238 @@ class OrderItem(Base):
     order_id = Column(Integer, ForeignKey('orders.id'))
     product_id = Column(Integer, ForeignKey('products.id'))
     quantity = Column(Integer, default=1)
-    price = Column(Float, nullable=False)
+    price = Column(Money, nullable=False)  # копейки
     
     order = relationship("Order", back_populates="items")
     product = relationship("Product")
 
-def init_db():
-    db_path = 'shared_database.db'
-    engine = create_engine(f'sqlite:///{db_path}', echo=False)
-    Base.metadata.create_all(engine)
-    
-    Session = sessionmaker(bind=engine)
-    db = Session()
+    __table_args__ = (
+        Index('ix_order_items_order', 'order_id'),
+    )
+
+class OrderNote(Base):
+    __tablename__ = 'order_notes'
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id'))
+    text = Column(Text)
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_order_notes_order', 'order_id', 'created_at'),
+    )
+
+class OrderStatusHistory(Base):
+    __tablename__ = 'order_status_history'
+    id = Column(Integer, primary_key=True)
+    order_id = Column(Integer, ForeignKey('orders.id'))
+    status = Column(String(50))
+    changed_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        Index('ix_order_status_history_order', 'order_id', 'changed_at'),
+    )
+
+class WorkerLease(Base):
+    """Аренда роли ведущего: фоновую работу с этим именем выполняет только держатель"""
+    __tablename__ = 'worker_leases'
+    name = Column(String(50), primary_key=True)
+    holder = Column(String(100))
+    expires_at = Column(DateTime)  # UTC
+    heartbeat_at = Column(DateTime)  # UTC
+    info = Column(Text)  # JSON с состоянием, которое ведущий публикует для админ-панели
+
+class CatalogVersion(Base):
+    """Единственная строка (id = 1): версия каталога, растет при каждой записи товаров"""
+    __tablename__ = 'catalog_version'
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    version = Column(Integer, default=0, nullable=False)
+    updated_at = Column(DateTime, default=datetime.now)
+
+class UserState(Base):
+    """Состояние диалога пользователя бота при STATE_BACKEND = 'database'"""
+    __tablename__ = 'user_states'
+    user_id = Column(BigInteger, primary_key=True, autoincrement=False)  # Telegram ID
+    data = Column(Text)  # JSON
+    expires_at = Column(DateTime)  # UTC
+
+    __table_args__ = (
+        Index('ix_user_states_expires', 'expires_at'),
+    )
+
+class StockCheckRequest(Base):
+    """Заявка на проверку наличия из админ-панели; product_id = NULL - проверить все товары"""
+    __tablename__ = 'stock_check_requests'
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey('products.id'), nullable=True)
+    status = Column(String(20), default='pending')  # pending, done, failed
+    requested_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+    result = Column(Text)
+
+    __table_args__ = (
+        Index('ix_stock_check_requests_status', 'status', 'requested_at'),
+    )
+
+class BalanceTransaction(Base):
+    """
+    Запись журнала баланса. (source, external_id) уникальна: повторное
+    зачисление того же платежа или списание за тот же заказ невозможно.
+    User.balance - кэш суммы всех записей пользователя (см. ledger.py).
+    """
+    __tablename__ = 'balance_transactions'
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    amount = Column(Money, nullable=False)  # копейки, списания отрицательные
+    balance_after = Column(Money, nullable=False)
+    source = Column(String(20), nullable=False)  # payment, order, admin, opening
+    external_id = Column(String(100), nullable=False)  # id платежа, номер заказа, ключ формы админки
+    comment = Column(String(200))
+    created_at = Column(DateTime, default=datetime.now)
+
+    __table_args__ = (
+        UniqueConstraint('source', 'external_id', name='uq_balance_transactions_source_external'),
+        Index('ix_balance_transactions_user_created', 'user_id', 'created_at'),
+    )
+
+class Payment(Base):
+    """Пополнение баланса через платежного провайдера"""
+    __tablename__ = 'payments'
+    payment_id = Column(String(100), primary_key=True)
+    user_id = Column(BigInteger, nullable=False)  # Telegram ID
+    amount = Column(Money, nullable=False)  # запрошенная сумма, копейки
+    status = Column(String(20), default='pending')  # pending, completed, failed, expired
+    checks_done = Column(Integer, default=0)  # сколько раз статус опрошен у провайдера
+    next_check_at = Column(DateTime)  # когда задача сверки опросит платеж в следующий раз
+    created_at = Column(DateTime, default=datetime.now)
+    finished_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_payments_status_next_check', 'status', 'next_check_at'),
+    )
+
+class NotificationOutbox(Base):
+    """
+    Исходящее сообщение покупателю. Пишется в той же транзакции, что и
+    изменение заказа, и доставляется воркером (см. notifications.py)
+    """
+    __tablename__ = 'notification_outbox'
+    id = Column(Integer, primary_key=True)
+    chat_id = Column(BigInteger, nullable=False)  # Telegram ID получателя
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(20), default='HTML')
+    status = Column(String(20), default='pending')  # pending, sent, failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.now)  # раньше этого времени не отправлять
+    last_error = Column(String(300))
+    created_at = Column(DateTime, default=datetime.now)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_notification_outbox_status_next', 'status', 'next_attempt_at'),
+    )
+
+def sqlite_lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    # Встроенный lower() SQLite меняет регистр только латиницы - заменяем
+    # на питоновский, как lower() в PostgreSQL (нужен поиску по кириллице)
+    dbapi_connection.create_function('lower', 1, sqlite_lower, deterministic=True)
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+    finally:
+        cursor.close()
+
+def create_db_engine(role='bot', url=None):
+    """
+    Возвращает общий для процесса engine базы магазина.
+    role определяет размер пула: bot, admin, worker или cli.
+    url позволяет явно указать базу (например, для переноса данных).
+    """
+    url = url or get_database_url()
+    key = (role, url)
+    if key in engines:
+        return engines[key]
+
+    profile = ENGINE_PROFILES.get(role, ENGINE_PROFILES['bot'])
+    if url.startswith('sqlite'):
+        engine = create_engine(
+            url,
+            echo=False,
+            pool_size=profile['pool_size'],
+            max_overflow=profile['max_overflow'],
+            pool_pre_ping=True,
+            connect_args={'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000}
+        )
+        event.listen(engine, 'connect', apply_sqlite_pragmas)
+    else:
+        engine = create_engine(
+            url,
+            echo=False,
+            pool_size=profile['pool_size'] * POSTGRES_POOL['pool_size_factor'],
+            max_overflow=profile['max_overflow'],
+            pool_pre_ping=True,
+            pool_recycle=POSTGRES_POOL['pool_recycle'],
+            pool_timeout=POSTGRES_POOL['pool_timeout']
+        )
+    instrument_engine(engine)
+
+    engines[key] = engine
+    return engine
+
+def seed_initial_data(connection):
+    """
+    Начальные данные: тестовые товары (все неактивные, цены в копейках) и
+    строка версии каталога. Вызывается из run_migrations под блокировкой
+    схемы, поэтому одновременно стартующие процессы не добавят их дважды.
+    """
+    db = sessionmaker(bind=connection)()
     try:
-        # Тестовые данные для товаров - все неактивные по умолчанию
         if db.query(Product).count() == 0:
             test_products = [
-                Product(name="HQD CUVIE Plus", description="Одноразовый вейп 2000 затяжек", price=1290, category=Category.DISPOSABLE, is_active=False),
-                Product(name="ELF BAR 600", description="Одноразовый вейп с мятным вкусом", price=1490, category=Category.DISPOSABLE, is_active=False),
-                Product(name="Puff Bar", description="Компактный одноразовый вейп", price=1190, category=Category.DISPOSABLE, is_active=False),
-                Product(name="Maskking", description="Одноразовый вейп премиум класса", price=1690, category=Category.DISPOSABLE, is_active=False),
-                Product(name="IGET Legend", description="Мощный одноразовый вейп", price=1590, category=Category.DISPOSABLE, is_active=False),
-                Product(name="Vozol Star", description="Стильный одноразовый вейп", price=1390, category=Category.DISPOSABLE, is_active=False),
-                Product(name="Bang XXL", description="Одноразовый вейп на 3000 затяжек", price=1790, category=Category.DISPOSABLE, is_active=False),
-                Product(name="Lost Mary", description="Популярный одноразовый вейп", price=1490, category=Category.DISPOSABLE, is_active=False),
+                Product(name="HQD CUVIE Plus", description="Одноразовый вейп 2000 затяжек", price=129000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="ELF BAR 600", description="Одноразовый вейп с мятным вкусом", price=149000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="Puff Bar", description="Компактный одноразовый вейп", price=119000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="Maskking", description="Одноразовый вейп премиум класса", price=169000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="IGET Legend", description="Мощный одноразовый вейп", price=159000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="Vozol Star", description="Стильный одноразовый вейп", price=139000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="Bang XXL", description="Одноразовый вейп на 3000 затяжек", price=179000, category=Category.DISPOSABLE, is_active=False),
+                Product(name="Lost Mary", description="Популярный одноразовый вейп", price=149000, category=Category.DISPOSABLE, is_active=False),
                 
-                Product(name="IQOS ILUMA Prime", description="Премиум POD система", price=6990, category=Category.POD, is_active=False),
-                Product(name="JUUL Starter Kit", description="Набор для начала использования", price=2990, category=Category.POD, is_active=False),
-                Product(name="Vaporesso XROS", description="Современная POD система", price=2490, category=Category.POD, is_active=False),
-                Product(name="Uwell Caliburn", description="Популярная POD система", price=2190, category=Category.POD, is_active=False),
-                Product(name="Smok Novo", description="Компактная POD система", price=1990, category=Category.POD, is_active=False),
-                Product(name="Voopoo Drag", description="Мощная POD система", price=3490, category=Category.POD, is_active=False),
+                Product(name="IQOS ILUMA Prime", description="Премиум POD система", price=699000, category=Category.POD, is_active=False),
+                Product(name="JUUL Starter Kit", description="Набор для начала использования", price=299000, category=Category.POD, is_active=False),
+                Product(name="Vaporesso XROS", description="Современная POD система", price=249000, category=Category.POD, is_active=False),
+                Product(name="Uwell Caliburn", description="Популярная POD система", price=219000, category=Category.POD, is_active=False),
+                Product(name="Smok Novo", description="Компактная POD система", price=199000, category=Category.POD, is_active=False),
+                Product(name="Voopoo Drag", description="Мощная POD система", price=349000, category=Category.POD, is_active=False),
                 
-                Product(name="Jam Monster", description="Жидкость с вкусом джема", price=790, category=Category.LIQUIDS, is_active=False),
-                Product(name="Nasty Juice", description="Премиум жидкость", price=890, category=Category.LIQUIDS, is_active=False),
-                Product(name="Dinner Lady", description="Классическая жидкость", price=690, category=Category.LIQUIDS, is_active=False),
-                Product(name="Element", description="Американская жидкость", price=990, category=Category.LIQUIDS, is_active=False),
-                Product(name="Riot Squad", description="Энергетическая жидкость", price=850, category=Category.LIQUIDS, is_active=False),
-                Product(name="Doozy", description="Британская жидкость", price=750, category=Category.LIQUIDS, is_active=False),
+                Product(name="Jam Monster", description="Жидкость с вкусом джема", price=79000, category=Category.LIQUIDS, is_active=False),
+                Product(name="Nasty Juice", description="Премиум жидкость", price=89000, category=Category.LIQUIDS, is_active=False),
+                Product(name="Dinner Lady", description="Классическая жидкость", price=69000, category=Category.LIQUIDS, is_active=False),
+                Product(name="Element", description="Американская жидкость", price=99000, category=Category.LIQUIDS, is_active=False),
+                Product(name="Riot Squad", description="Энергетическая жидкость", price=85000, category=Category.LIQUIDS, is_active=False),
+                Product(name="Doozy", description="Британская жидкость", price=75000, category=Category.LIQUIDS, is_active=False),
                 
-                Product(name="JUUL Pods Mango", description="Картриджи с манговым вкусом", price=490, category=Category.CARTRIDGES, is_active=False),
-                Product(name="IQOS TEREA", description="Картриджи для IQOS", price=590, category=Category.CARTRIDGES, is_active=False),
-                Product(name="GLO Hyper", description="Картриджи для GLO", price=520, category=Category.CARTRIDGES, is_active=False),
-                Product(name="Ploom Tech", description="Картриджи для Ploom", price=480, category=Category.CARTRIDGES, is_active=False),
+                Product(name="JUUL Pods Mango", description="Картриджи с манговым вкусом", price=49000, category=Category.CARTRIDGES, is_active=False),
+                Product(name="IQOS TEREA", description="Картриджи для IQOS", price=59000, category=Category.CARTRIDGES, is_active=False),
+                Product(name="GLO Hyper", description="Картриджи для GLO", price=52000, category=Category.CARTRIDGES, is_active=False),
+                Product(name="Ploom Tech", description="Картриджи для Ploom", price=48000, category=Category.CARTRIDGES, is_active=False),
             ]
             db.add_all(test_products)
-            db.commit()
-            
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
-        db.rollback()
+
+        if db.query(CatalogVersion).count() == 0:
+            db.add(CatalogVersion(id=1, version=0))
+        # Фиксирует только работу сессии: транзакцию соединения завершает run_migrations
+        db.commit()
     finally:
         db.close()
-    
+
+def init_db(role='bot'):
+    engine = create_db_engine(role)
+    # Таблицы, миграции и начальные данные - под блокировкой схемы, см. migrations.py
+    run_migrations(engine, Base.metadata, seed=seed_initial_data)
     return engine
 
 def get_session(engine):
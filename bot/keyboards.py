@@ -1,6 +1,7 @@
 import urllib.parse
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup
 from database import Category
+from money import format_rub
 
 def main_menu_keyboard():
     keyboard = [
@@ -134,10 +135,10 @@ def cart_items_keyboard(cart_items):
     return InlineKeyboardMarkup(keyboard)
 
 def after_order_keyboard(order_number, total_amount, order_items):
-    order_info = f"Заказ #{order_number}\nСумма: {total_amount} руб.\nТовары:\n"
+    order_info = f"Заказ #{order_number}\nСумма: {format_rub(total_amount)} руб.\nТовары:\n"
     
     for item in order_items:
-        order_info += f"- {item.product.name} x{item.quantity} = {item.quantity * item.product.price} руб.\n"
+        order_info += f"- {item.product.name} x{item.quantity} = {format_rub(item.quantity * item.product.price)} руб.\n"
     
     order_info += "Адрес почты России: \nНомер телефона: "
     telegram_url = f"https://t.me/example?text={urllib.parse.quote(order_info)}"
@@ -0,0 +1,114 @@
+"""
+Выбор ведущего процесса через строку-аренду в таблице worker_leases.
+
+Процесс становится ведущим, если строки с нужным именем нет или срок
+аренды истек, и продлевает аренду, пока работает. Если ведущий упал,
+через ttl секунд роль забирает другой процесс. Время хранится в UTC,
+чтобы аренду могли сравнивать процессы на разных серверах.
+"""
+import os
+import json
+import socket
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import update, insert, or_
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from database import WorkerLease
+except ImportError:
+    from bot.database import WorkerLease
+
+def default_holder():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def acquire_lease(engine, name, holder, ttl):
+    """Берет или продлевает аренду. Возвращает True, если holder теперь ведущий."""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=ttl)
+
+    with engine.begin() as connection:
+        result = connection.execute(
+            update(WorkerLease)
+            .where(WorkerLease.name == name)
+            .where(or_(WorkerLease.holder == holder, WorkerLease.expires_at < now))
+            .values(holder=holder, expires_at=expires_at, heartbeat_at=now)
+        )
+        if result.rowcount:
+            return True
+
+    try:
+        with engine.begin() as connection:
+            connection.execute(
+                insert(WorkerLease).values(name=name, holder=holder, expires_at=expires_at, heartbeat_at=now)
+            )
+        return True
+    except IntegrityError:
+        # Строка уже есть и аренда принадлежит другому процессу
+        return False
+
+def release_lease(engine, name, holder):
+    """Досрочно освобождает аренду, чтобы другой процесс не ждал ttl"""
+    with engine.begin() as connection:
+        connection.execute(
+            update(WorkerLease)
+            .where(WorkerLease.name == name, WorkerLease.holder == holder)
+            .values(expires_at=datetime.utcnow())
+        )
+
+def publish_lease_info(engine, name, holder, info):
+    """Сохраняет состояние ведущего (JSON), пока он держит аренду"""
+    with engine.begin() as connection:
+        connection.execute(
+            update(WorkerLease)
+            .where(WorkerLease.name == name, WorkerLease.holder == holder)
+            .values(info=json.dumps(info, ensure_ascii=False, default=str))
+        )
+
+def read_lease(db, name):
+    """Состояние аренды для отображения: держатель, активна ли она и опубликованные данные"""
+    lease = db.query(WorkerLease).filter(WorkerLease.name == name).first()
+    if not lease:
+        return None
+    return {
+        'holder': lease.holder,
+        'active': bool(lease.expires_at and lease.expires_at > datetime.utcnow()),
+        'heartbeat_at': lease.heartbeat_at.isoformat() if lease.heartbeat_at else None,
+        'info': json.loads(lease.info) if lease.info else {}
+    }
+
+class LeaseKeeper:
+    """Фоновый поток, который держит аренду и продлевает ее каждые ttl/3 секунд"""
+
+    def __init__(self, engine, name, ttl=60, holder=None):
+        self.engine = engine
+        self.name = name
+        self.ttl = ttl
+        self.holder = holder or default_holder()
+        self.is_leader = False
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.renew()
+        self.thread.start()
+
+    def renew(self):
+        try:
+            leader = acquire_lease(self.engine, self.name, self.holder, self.ttl)
+        except Exception as e:
+            print(f"Ошибка продления аренды {self.name}: {e}")
+            leader = False
+        if leader != self.is_leader:
+            print(f"{'👑 Получена' if leader else '⚠️ Потеряна'} роль ведущего {self.name} ({self.holder})")
+        self.is_leader = leader
+
+    def run(self):
+        while not self.stop_event.wait(self.ttl / 3):
+            self.renew()
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_leader:
+            release_lease(self.engine, self.name, self.holder)
+            self.is_leader = False
@@ -0,0 +1,84 @@
+"""
+Журнал баланса пользователей (таблица balance_transactions).
+
+Любое изменение баланса - зачисление платежа, списание за заказ,
+пополнение из админ-панели - идет через apply_transaction в транзакции
+вызывающего кода: запись журнала и User.balance меняются вместе и
+фиксируются одним commit. Ключ (source, external_id) уникален, поэтому
+повторная обработка того же платежа (дубль опроса, ручная проверка,
+перезапуск бота) баланс не меняет.
+
+Строка пользователя должна быть заблокирована вызывающим кодом
+(with_for_update), тогда проверка ключа и изменение баланса атомарны;
+на случай гонки без блокировки остается уникальный индекс - commit
+упадет с IntegrityError, и операцию нужно считать уже выполненной.
+Баланс меняется UPDATE balance = balance + amount, а не записью
+прочитанного значения: SQLite не поддерживает with_for_update, и
+процессы бота и админ-панели иначе теряют изменения друг друга.
+"""
+from datetime import datetime
+from sqlalchemy import update, func, or_, and_
+from sqlalchemy.orm.attributes import set_committed_value
+
+try:
+    from database import BalanceTransaction, User
+except ImportError:
+    from bot.database import BalanceTransaction, User
+
+SOURCE_PAYMENT = 'payment'
+SOURCE_ORDER = 'order'
+SOURCE_ADMIN = 'admin'
+
+def find_transaction(db, source, external_id):
+    return db.query(BalanceTransaction).filter(
+        BalanceTransaction.source == source,
+        BalanceTransaction.external_id == str(external_id)
+    ).first()
+
+def apply_transaction(db, user, amount, source, external_id, comment=None):
+    """
+    Меняет баланс user на amount копеек (списание - отрицательная сумма) и
+    пишет запись журнала, не фиксируя транзакцию.
+    Возвращает (запись, True) или (существующая запись, False), если
+    операция с таким ключом уже была - тогда баланс не меняется.
+    """
+    existing = find_transaction(db, source, external_id)
+    if existing is not None:
+        return existing, False
+
+    balance = db.execute(
+        update(User).where(User.id == user.id)
+        .values(balance=func.coalesce(User.balance, 0) + amount)
+        .returning(User.balance)
+        .execution_options(synchronize_session=False)
+    ).scalar_one()
+    set_committed_value(user, 'balance', balance)
+    transaction = BalanceTransaction(
+        user_id=user.id,
+        amount=amount,
+        balance_after=user.balance,
+        source=source,
+        external_id=str(external_id),
+        comment=comment,
+        created_at=datetime.now()
+    )
+    db.add(transaction)
+    return transaction, True
+
+def balance_history(db, user_id, limit=20, before=None, before_id=None):
+    """
+    Последние записи журнала пользователя (User.id), новые первыми -
+    диапазон индекса ix_balance_transactions_user_created.
+    Следующая страница - before=created_at и before_id=id последней
+    полученной записи: записи с одинаковым временем упорядочены по id и
+    не теряются и не повторяются на границе страниц.
+    """
+    query = db.query(BalanceTransaction).filter(BalanceTransaction.user_id == user_id)
+    if before is not None and before_id is not None:
+        query = query.filter(or_(
+            BalanceTransaction.created_at < before,
+            and_(BalanceTransaction.created_at == before, BalanceTransaction.id < before_id)
+        ))
+    elif before is not None:
+        query = query.filter(BalanceTransaction.created_at < before)
+    return query.order_by(BalanceTransaction.created_at.desc(), BalanceTransaction.id.desc()).limit(limit).all()
@@ -5,10 +5,23 @@ import asyncio
 import time
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters, ConversationHandler
-from database import init_db, get_session, User, Product, CartItem, Order, OrderItem, Category
+from database import init_db, get_session, User, Product, CartItem, Order, OrderItem, Category, Payment
+from money import to_kopecks, format_rub
 from keyboards import main_menu_keyboard, categories_keyboard, products_keyboard, product_keyboard, profile_keyboard, orders_keyboard, cart_keyboard, search_keyboard, cart_items_keyboard, after_order_keyboard, balance_keyboard
-from datetime import datetime
-from payments import get_payment_qr_code, check_payment_status, get_payment_amount, cleanup_old_sessions
+from datetime import datetime, timedelta
+from telegram.request import HTTPXRequest
+from update_processor import PerUserUpdateProcessor
+from user_state import UserStateStore, DatabaseStateBackend
+from catalog_cache import search_product_ids
+from product_media import send_product_media, send_local_photo
+from ledger import apply_transaction, SOURCE_PAYMENT, SOURCE_ORDER
+from sqlalchemy import update, or_, and_
+from sqlalchemy.exc import IntegrityError
+from payment_callback import PAYMENT_CALLBACK_SECRET, start_callback_server
+from scheduler import instrument_scheduler, add_bot_job
+from metrics import TELEGRAM_API_SECONDS, PAYMENT_POLLS, PAYMENT_POLL_SECONDS, PAYMENT_RESULTS, gauge_function, start_metrics_server
+from payment_qr import get_qr_png
+from payments import get_payment_qr_code, check_payment_status, get_payment_amount, cleanup_old_sessions, close_payment_client
 
 try:
     from config import BOT_TOKEN, ADMIN_IDS
@@ -16,6 +29,24 @@ except ImportError:
     print("⚠️ Файл config.py не найден! Скопируйте config.example.py в config.py и заполните данные")
     BOT_TOKEN = "YOUR_BOT_TOKEN_HERE"
     ADMIN_IDS = []
+
+try:
+    from config import BOT_MODE, BOT_CONCURRENT_UPDATES
+except ImportError:
+    BOT_MODE = 'polling'
+    BOT_CONCURRENT_UPDATES = 16
+
+try:
+    from config import STATE_BACKEND
+except ImportError:
+    STATE_BACKEND = 'memory'
+
+try:
+    from config import METRICS_HOST, METRICS_PORT
+except ImportError:
+    METRICS_HOST = '127.0.0.1'
+    METRICS_PORT = 9100
+
 SEARCH_QUERY = 1
 PAYMENT_AMOUNT = 2 
 
@@ -24,15 +55,28 @@ PAYMENT_CONFIG = {
     'max_amount': 189000,
     'timeout_minutes': 15,
     'check_interval': 30,
-    'max_checks': 30
+    'max_checks': 30,
+    # С уведомлениями от провайдера опрос - только страховка от потерянных уведомлений
+    'callback_check_interval': 150,
+    'callback_max_checks': 8,
+    # Задача сверки просыпается часто, но каждый платеж опрашивает по его интервалу
+    'reconcile_interval': 10,
+    'reconcile_batch': 50,
+    'max_parallel_checks': 4,
+    # Оплату, пришедшую вскоре после истечения платежа, еще можно зачислить
+    'late_payment_grace': 3600
 }
 
+# Минимальная сумма заказа в копейках
+MIN_ORDER_AMOUNT = to_kopecks(1500)
+
 PHOTO_PATH = os.path.join('bot', 'img', 'ava.jpg')
 
-engine = init_db()
+engine = init_db('bot')
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-user_states = {}
+# Состояние диалогов: только id и курсоры, с вытеснением по LRU/TTL
+user_states = UserStateStore(backend=DatabaseStateBackend(engine) if STATE_BACKEND == 'database' else None)
 payment_sessions = {}
 
 async def check_user_banned(user_id: int) -> bool:
@@ -83,12 +127,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             db.commit()
             await update.message.reply_text("👋 Добро пожаловать! Вы были зарегистрированы в системе.")
         
-        with open(PHOTO_PATH, 'rb') as photo:
-            await update.message.reply_photo(
-                photo=photo,
-                caption="🚬 Добро пожаловать в магазин электронных сигарет - Vape Shop\n\nВыберите нужный раздел:",
-                reply_markup=main_menu_keyboard()
-            )
+        await send_local_photo(
+            update.message, PHOTO_PATH,
+            "🚬 Добро пожаловать в магазин электронных сигарет - Vape Shop\n\nВыберите нужный раздел:",
+            main_menu_keyboard()
+        )
     except Exception as e:
         logger.error(f"Error in start: {e}")
         await update.message.reply_text("🚬 Добро пожаловать в магазин электронных сигарет - Vape Shop\n\nВыберите нужный раздел:", reply_markup=main_menu_keyboard())
@@ -98,18 +141,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await handle_banned_user(update, context):
         return
-    with open(PHOTO_PATH, 'rb') as photo:
-        await update.message.reply_photo(
-            photo=photo,
-            caption="🚬 Главное меню:\n\nВыберите нужный раздел:",
-            reply_markup=main_menu_keyboard()
-        )
+    await send_local_photo(update.message, PHOTO_PATH, "🚬 Главное меню:\n\nВыберите нужный раздел:", main_menu_keyboard())
 
 async def show_shop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if await handle_banned_user(update, context):
         return
     user_id = update.effective_user.id
-    user_states[user_id] = {'category': None, 'page': 0, 'search_query': None}
+    await user_states.aset(user_id, category=None, page=0)
     
     db = get_session(engine)
     try:
@@ -158,7 +196,7 @@ async def show_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = db.query(User).filter(User.user_id == update.effective_user.id).first()
         text = (
             f"👤 *Ваш профиль*\n\n"
-            f"💳 *Баланс:* {user.balance} руб.\n"
+            f"💳 *Баланс:* {format_rub(user.balance)} руб.\n"
             f"📦 *Заказов:* {user.orders_count}\n"
             f"📅 *Регистрация:* {user.created_at.strftime('%d.%m.%Y')}\n\n"
             f"⚠️ *Временно автоматическое пополнение баланса не работает*\n"
@@ -182,7 +220,7 @@ async def show_profile_from_callback(query):
         
         text = (
             f"👤 *Ваш профиль*\n\n"
-            f"💳 *Баланс:* {user.balance} руб.\n"
+            f"💳 *Баланс:* {format_rub(user.balance)} руб.\n"
             f"📦 *Заказов:* {user.orders_count}\n"
             f"📅 *Регистрация:* {user.created_at.strftime('%d.%m.%Y')}\n"
         )
@@ -212,7 +250,7 @@ async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE):
             return
         text = "📦 Ваши заказы:\n\n"
         for order in orders:
-            text += f"🔖 #{order.order_number} - {order.total_amount} руб. - {translate_status(order.status)}\n"
+            text += f"🔖 #{order.order_number} - {format_rub(order.total_amount)} руб. - {translate_status(order.status)}\n"
             text += f"📅 {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
             if order.tracking_number:
                 text += f"📦 Трек-номер: {order.tracking_number}\n"
@@ -235,7 +273,7 @@ async def show_orders_from_callback(query):
             return
         text = "📦 Ваши заказы:\n\n"
         for order in orders:
-            text += f"🔖 #{order.order_number} - {order.total_amount} руб. - {translate_status(order.status)}\n"
+            text += f"🔖 #{order.order_number} - {format_rub(order.total_amount)} руб. - {translate_status(order.status)}\n"
             text += f"📅 {order.created_at.strftime('%d.%m.%Y %H:%M')}\n"
             if order.tracking_number:
                 text += f"📦 Трек-номер: {order.tracking_number}\n"
@@ -261,9 +299,9 @@ async def show_cart(update: Update, context: ContextTypes.DEFAULT_TYPE):
         total = 0
         text = "🛒 Ваша корзина:\n\n"
         for item in cart_items:
-            text += f"🚬 {item.product.name} - {item.quantity} шт. x {item.product.price} руб.\n"
+            text += f"🚬 {item.product.name} - {item.quantity} шт. x {format_rub(item.product.price)} руб.\n"
             total += item.quantity * item.product.price
-        text += f"\n💵 Итого: {total} руб."
+        text += f"\n💵 Итого: {format_rub(total)} руб."
         await update.message.reply_text(text, reply_markup=cart_keyboard())
     except Exception as e:
         logger.error(f"Error in show_cart: {e}")
@@ -284,10 +322,10 @@ async def show_cart_from_callback(query):
         text = "🛒 Ваша корзина:\n\n"
         for item in cart_items:
             item_total = item.quantity * item.product.price
-            text += f"🚬 {item.product.name} - {item.quantity} шт. x {item.product.price} руб. = {item_total} руб.\n"
+            text += f"🚬 {item.product.name} - {item.quantity} шт. x {format_rub(item.product.price)} руб. = {format_rub(item_total)} руб.\n"
             total += item_total
         
-        text += f"\n💵 Итого: {total} руб."
+        text += f"\n💵 Итого: {format_rub(total)} руб."
         
         reply_markup = cart_items_keyboard(cart_items)
         await query.message.reply_text(text, reply_markup=reply_markup)
@@ -319,10 +357,10 @@ async def remove_from_cart(query, cart_item_id):
             text = "🛒 Ваша корзина:\n\n"
             for item in cart_items:
                 item_total = item.quantity * item.product.price
-                text += f"🚬 {item.product.name} - {item.quantity} шт. x {item.product.price} руб. = {item_total} руб.\n"
+                text += f"🚬 {item.product.name} - {item.quantity} шт. x {format_rub(item.product.price)} руб. = {format_rub(item_total)} руб.\n"
                 total += item_total
             
-            text += f"\n💵 Итого: {total} руб."
+            text += f"\n💵 Итого: {format_rub(total)} руб."
             
             reply_markup = cart_items_keyboard(cart_items)
             await query.message.reply_text(text, reply_markup=reply_markup)
@@ -345,8 +383,7 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
     user_id = update.effective_user.id
     db = get_session(engine)
     try:
-        products = db.query(Product).filter(Product.name.ilike(f"%{search_text}%"), Product.is_active == True).all()
-        if not products:
+        if not search_product_ids(db, search_text):
             await update.message.reply_text(
                 f"🔍 По запросу '{search_text}' ничего не найдено.\n\n"
                 f"Попробуйте другой поисковый запрос или выберите категорию:",
@@ -357,7 +394,7 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
                 ])
             )
             return ConversationHandler.END
-        user_states[user_id] = {'search_results': products, 'search_query': search_text, 'page': 0}
+        await user_states.aset(user_id, search_query=search_text, page=0)
         await show_search_results(update, context, user_id, 0)
     except Exception as e:
         logger.error(f"Error in search: {e}")
@@ -366,11 +403,28 @@ async def handle_search_query(update: Update, context: ContextTypes.DEFAULT_TYPE
         db.close()
     return ConversationHandler.END
 
+def load_products_page(db, product_ids):
+    """Загружает одним запросом товары страницы в порядке product_ids (снятые с продажи пропускаются)"""
+    if not product_ids:
+        return []
+    products = db.query(Product).filter(Product.id.in_(product_ids), Product.is_active == True).all()
+    by_id = {product.id: product for product in products}
+    return [by_id[product_id] for product_id in product_ids if product_id in by_id]
+
 async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, page: int = 0):
-    state = user_states.get(user_id, {})
-    products = state.get('search_results', [])
+    state = await user_states.aget(user_id)
     search_query = state.get('search_query', '')
-    if not products:
+    db = get_session(engine)
+    try:
+        # Id берутся из общего кэша поиска, товары страницы - одним запросом
+        product_ids = search_product_ids(db, search_query)
+        total_pages = (len(product_ids) + 3) // 4
+        current_page = min(page, total_pages - 1) if total_pages > 0 else 0
+        start_idx = current_page * 4
+        page_products = load_products_page(db, product_ids[start_idx:start_idx + 4])
+    finally:
+        db.close()
+    if not product_ids:
         if update.callback_query:
             await update.callback_query.message.reply_text(
                 f"🔍 По запросу '{search_query}' ничего не найдено.\n\n"
@@ -392,15 +446,10 @@ async def show_search_results(update: Update, context: ContextTypes.DEFAULT_TYPE
                 ])
             )
         return
-    total_pages = (len(products) + 3) // 4
-    current_page = min(page, total_pages - 1) if total_pages > 0 else 0
-    start_idx = current_page * 4
-    end_idx = start_idx + 4
-    page_products = products[start_idx:end_idx]
     text = f"🔍 Результаты поиска по '{search_query}':\n"
     text += f"📄 Страница {current_page + 1} из {total_pages}\n\n"
     for product in page_products:
-        text += f"🚬 {product.name} - {product.price} руб.\n"
+        text += f"🚬 {product.name} - {format_rub(product.price)} руб.\n"
         text += f"   {product.description[:50]}...\n\n"
     keyboard = []
     for i in range(0, len(page_products), 2):
@@ -457,7 +506,7 @@ async def show_category_products(update: Update, context: ContextTypes.DEFAULT_T
         start_idx = current_page * 4
         end_idx = start_idx + 4
         page_products = products[start_idx:end_idx]
-        user_states[user_id] = {'category': category, 'page': current_page, 'search_query': None}
+        await user_states.aset(user_id, category=category.name, page=current_page)
         
         await query.edit_message_text(
             f"📦 Категория: {category.value}\n📄 Страница {current_page + 1} из {total_pages}",
@@ -482,24 +531,13 @@ async def show_product_detail(update: Update, context: ContextTypes.DEFAULT_TYPE
         message_text = (
             f"🚬 {product.name}\n\n"
             f"{product.description}\n\n"
-            f"💵 Цена: {product.price} руб.\n"
+            f"💵 Цена: {format_rub(product.price)} руб.\n"
             f"📂 Категория: {product.category.value}"
         )
         
         if product.photo_gif_id:
             try:
-                if product.photo_gif_id.endswith('.gif'):
-                    await query.message.reply_animation(
-                        animation=product.photo_gif_id,
-                        caption=message_text,
-                        reply_markup=product_keyboard(product.id)
-                    )
-                else:
-                    await query.message.reply_photo(
-                        photo=product.photo_gif_id,
-                        caption=message_text,
-                        reply_markup=product_keyboard(product.id)
-                    )
+                await send_product_media(engine, query.message, product, message_text, product_keyboard(product.id))
             except Exception as e:
                 logger.error(f"Error sending media: {e}")
                 await query.message.reply_text(
@@ -588,12 +626,11 @@ async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.answer("Произошла ошибка!")
 
 async def go_to_main_menu(query):
-    with open(PHOTO_PATH, 'rb') as photo:
-        await query.message.reply_photo(
-            photo=photo,
-            caption="🚬 Добро пожаловать в магазин электронных сигарет!\n\nВыберите нужный раздел:",
-            reply_markup=main_menu_keyboard()
-        )
+    await send_local_photo(
+        query.message, PHOTO_PATH,
+        "🚬 Добро пожаловать в магазин электронных сигарет!\n\nВыберите нужный раздел:",
+        main_menu_keyboard()
+    )
 
 async def add_to_cart(query, product_id):
     db = get_session(engine)
@@ -623,7 +660,7 @@ async def add_to_cart(query, product_id):
         await query.message.reply_text(
             f"✅ {product.name} добавлен в корзину!\n"
             f"📦 Количество: {new_quantity} шт.\n"
-            f"💵 Сумма: {new_quantity * product.price} руб."
+            f"💵 Сумма: {format_rub(new_quantity * product.price)} руб."
         )
         
         await query.answer(f"✅ {product.name} добавлен в корзину!")
@@ -637,22 +674,24 @@ async def add_to_cart(query, product_id):
 async def buy_now(query, product_id):
     db = get_session(engine)
     try:
-        user = db.query(User).filter(User.user_id == query.from_user.id).first()
+        # Блокируем строку пользователя до конца транзакции, чтобы параллельные
+        # покупки (в том числе из разных реплик бота) не списали баланс дважды
+        user = db.query(User).filter(User.user_id == query.from_user.id).with_for_update().first()
         product = db.query(Product).filter(Product.id == product_id).first()
         
         if not product:
             await query.answer("Товар не найден!")
             return
         
-        if product.price < 1500:
-            await query.answer("❌ Минимальная сумма заказа - 1500 рублей!")
+        if product.price < MIN_ORDER_AMOUNT:
+            await query.answer(f"❌ Минимальная сумма заказа - {format_rub(MIN_ORDER_AMOUNT)} рублей!")
             return
         
         if user.balance < product.price:
             await query.message.reply_text(
                 f"❌ Недостаточно средств на балансе!\n"
-                f"💵 Нужно: {product.price} руб.\n"
-                f"💳 На балансе: {user.balance} руб.\n\n"
+                f"💵 Нужно: {format_rub(product.price)} руб.\n"
+                f"💳 На балансе: {format_rub(user.balance)} руб.\n\n"
                 f"Пополните баланс в разделе 👤 Профиль",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("💵 Пополнить баланс", callback_data="add_balance")],
@@ -664,20 +703,20 @@ async def buy_now(query, product_id):
         
         order = Order(user_id=user.id, total_amount=product.price, status='pending')
         db.add(order)
-        db.commit()
+        db.flush()
         
         order_item = OrderItem(order_id=order.id, product_id=product_id, quantity=1, price=product.price)
         db.add(order_item)
         
-        user.balance -= product.price
+        apply_transaction(db, user, -product.price, SOURCE_ORDER, order.order_number, comment=f"Оплата заказа #{order.order_number}")
         user.orders_count += 1
         db.commit()
         
         order_info = (
             f"ФИО: \n"
             f"Заказ #{order.order_number}\n"
-            f"Сумма: {product.price} руб.\n"
-            f"Товар: {product.name} x1 = {product.price} руб.\n"
+            f"Сумма: {format_rub(product.price)} руб.\n"
+            f"Товар: {product.name} x1 = {format_rub(product.price)} руб.\n"
             f"Доставка: 500р\n"
             f"Адрес почты России: \n"
             f"Номер телефона: "
@@ -689,7 +728,7 @@ async def buy_now(query, product_id):
         
         await query.message.reply_text(
             f"✅ Заказ #{order.order_number} создан!\n"
-            f"💵 Сумма: {product.price} руб.\n\n"
+            f"💵 Сумма: {format_rub(product.price)} руб.\n\n"
             f"📦 Для указания адреса доставки и номера телефона нажмите кнопку ниже:",
             reply_markup=InlineKeyboardMarkup([
                 [InlineKeyboardButton("📦 Указать адрес и телефон", url=telegram_url)],
@@ -761,9 +800,7 @@ async def handle_payment_amount(update: Update, context: ContextTypes.DEFAULT_TY
         user_id = update.effective_user.id
         await update.message.reply_text("🔄 Создаем платеж...")
         
-        payment_result = await asyncio.get_event_loop().run_in_executor(
-            None, get_payment_qr_code, amount
-        )
+        payment_result = await get_payment_qr_code(amount)
         
         payment_id, payment_link, qr_link = payment_result
         
@@ -776,6 +813,7 @@ async def handle_payment_amount(update: Update, context: ContextTypes.DEFAULT_TY
             )
             return ConversationHandler.END
         
+        record_payment(payment_id, user_id, amount)
         payment_sessions[payment_id] = {
             'user_id': user_id,
             'amount': amount,
@@ -788,24 +826,29 @@ async def handle_payment_amount(update: Update, context: ContextTypes.DEFAULT_TY
             f"💰 Сумма: {amount} руб.\n"
             f"🔗 ID платежа: `{payment_id}`\n\n"
             f"📱 *Инструкция по оплате:*\n"
-            f"1. Отсканируйте QR-код ниже\n"
+            f"1. Отсканируйте QR-код на картинке\n"
             f"2. Или перейдите по ссылке: {qr_link}\n"
             f"3. Оплатите счет в течение 15 минут\n"
             f"4. Баланс пополнится автоматически\n\n"
             f"⏰ Время на оплату: 15 минут"
         )
         
-        await update.message.reply_text(
-            message_text,
-            parse_mode='Markdown',
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔗 Открыть ссылку оплаты", url=qr_link)],
-                [InlineKeyboardButton("🔄 Проверить статус", callback_data=f"check_payment_{payment_id}")],
-                [InlineKeyboardButton("🔙 Назад в профиль", callback_data="profile")]
-            ])
-        )
-        
-        asyncio.create_task(check_payment_status_loop(payment_id, user_id, amount))
+        payment_keyboard = InlineKeyboardMarkup([
+            [InlineKeyboardButton("🔗 Открыть ссылку оплаты", url=qr_link)],
+            [InlineKeyboardButton("🔄 Проверить статус", callback_data=f"check_payment_{payment_id}")],
+            [InlineKeyboardButton("🔙 Назад в профиль", callback_data="profile")]
+        ])
+        try:
+            # QR рисуется локально по найденной ссылке и кэшируется по payment_id
+            await update.message.reply_photo(
+                photo=get_qr_png(payment_id, qr_link),
+                caption=message_text,
+                parse_mode='Markdown',
+                reply_markup=payment_keyboard
+            )
+        except Exception as e:
+            logger.error(f"Error sending payment QR: {e}")
+            await update.message.reply_text(message_text, parse_mode='Markdown', reply_markup=payment_keyboard)
         
         return ConversationHandler.END
         
@@ -829,47 +872,160 @@ async def handle_payment_amount(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return ConversationHandler.END
     
-async def check_payment_status_loop(payment_id, user_id, expected_amount):
-    """Фоновая задача для проверки статуса платежа"""
+def record_payment(payment_id, user_id, amount):
+    """
+    Сохраняет созданный платеж: по нему уведомление провайдера найдет
+    пользователя, а задача сверки - время следующего опроса.
+    """
+    interval, _ = payment_check_schedule()
+    db = get_session(engine)
     try:
-        max_checks = 30
-        checks_done = 0
-        
-        for i in range(max_checks):
-            await asyncio.sleep(30) 
-            checks_done += 1
-            
-            status = await asyncio.get_event_loop().run_in_executor(
-                None, check_payment_status, payment_id
+        db.add(Payment(
+            payment_id=payment_id, user_id=user_id, amount=to_kopecks(amount),
+            checks_done=0, next_check_at=datetime.now() + timedelta(seconds=interval)
+        ))
+        db.commit()
+    finally:
+        db.close()
+
+def load_payment(payment_id):
+    db = get_session(engine)
+    try:
+        return db.query(Payment).filter(Payment.payment_id == payment_id).first()
+    finally:
+        db.close()
+
+def finish_payment(payment_id, status):
+    """Переводит ожидающий платеж в итоговый статус. False - его уже завершили раньше."""
+    with engine.begin() as connection:
+        result = connection.execute(
+            update(Payment)
+            .where(Payment.payment_id == payment_id, Payment.status == 'pending')
+            .values(status=status, finished_at=datetime.now())
+        )
+    return result.rowcount > 0
+
+async def handle_payment_event(event):
+    """Уведомление провайдера о платеже (см. payment_callback.py)"""
+    payment = load_payment(event['payment_id'])
+    if payment is None:
+        return 'unknown'
+
+    if event['status'] == 'completed':
+        # Зачисляется сумма, сохраненная при создании платежа; сумма из
+        # уведомления только сверяется с ней
+        if event.get('amount') is not None:
+            try:
+                amount = to_kopecks(event['amount'])
+            except ValueError:
+                return 'invalid'
+            if amount != payment.amount:
+                logger.warning(f"Сумма в уведомлении о платеже {payment.payment_id} ({event['amount']} руб.) "
+                               f"не совпадает с созданной ({format_rub(payment.amount)} руб.)")
+                return 'invalid'
+        result = await process_successful_payment(payment.payment_id, payment.user_id)
+        if result == 'credited':
+            PAYMENT_RESULTS.inc("completed")
+        return result
+
+    if finish_payment(payment.payment_id, 'failed'):
+        await process_failed_payment(payment.payment_id, payment.user_id)
+        PAYMENT_RESULTS.inc("failed")
+        return 'failed'
+    return 'duplicate'
+
+def payment_check_schedule():
+    """(интервал опроса, число опросов до истечения) с учетом уведомлений провайдера"""
+    if PAYMENT_CALLBACK_SECRET:
+        return PAYMENT_CONFIG['callback_check_interval'], PAYMENT_CONFIG['callback_max_checks']
+    return PAYMENT_CONFIG['check_interval'], PAYMENT_CONFIG['max_checks']
+
+def claim_due_payments():
+    """
+    Забирает ожидающие платежи, которым пора на проверку, и сразу назначает
+    им следующую. Условный UPDATE гарантирует, что при нескольких репликах
+    бота каждый платеж в этот раз проверит только одна.
+    """
+    interval, _ = payment_check_schedule()
+    now = datetime.now()
+    db = get_session(engine)
+    try:
+        due = db.query(Payment).filter(
+            Payment.status == 'pending', Payment.next_check_at <= now
+        ).order_by(Payment.next_check_at).limit(PAYMENT_CONFIG['reconcile_batch']).all()
+        claimed = []
+        for payment in due:
+            candidate = (payment.payment_id, payment.user_id, payment.amount, (payment.checks_done or 0) + 1)
+            result = db.execute(
+                update(Payment)
+                .where(Payment.payment_id == payment.payment_id, Payment.status == 'pending',
+                       Payment.next_check_at == payment.next_check_at)
+                .values(next_check_at=now + timedelta(seconds=interval), checks_done=Payment.checks_done + 1)
             )
-            
-            if status == "completed":
-                actual_amount = await asyncio.get_event_loop().run_in_executor(
-                    None, get_payment_amount, payment_id
-                )
-                
-                amount_to_add = actual_amount if actual_amount else expected_amount
-                
-                await process_successful_payment(payment_id, user_id, amount_to_add)
-                break
-                
-            elif status == "failed":
+            if result.rowcount:
+                claimed.append(candidate)
+        db.commit()
+        return claimed
+    finally:
+        db.close()
+
+async def reconcile_payment(payment_id, user_id, expected_amount, checks_done):
+    """Один опрос статуса платежа у провайдера"""
+    _, max_checks = payment_check_schedule()
+    loop = asyncio.get_running_loop()
+    try:
+        with PAYMENT_POLL_SECONDS.time():
+            status = await loop.run_in_executor(None, check_payment_status, payment_id)
+        PAYMENT_POLLS.inc(status if status in ("completed", "failed", "error", "pending") else "other")
+
+        if status == "completed":
+            actual_amount = await loop.run_in_executor(None, get_payment_amount, payment_id)
+            if actual_amount and to_kopecks(actual_amount) != expected_amount:
+                logger.warning(f"Сумма на странице платежа {payment_id} ({actual_amount} руб.) "
+                               f"не совпадает с созданной ({format_rub(expected_amount)} руб.)")
+            if await process_successful_payment(payment_id, user_id) == 'credited':
+                PAYMENT_RESULTS.inc("completed")
+            return
+
+        if status == "failed":
+            if finish_payment(payment_id, 'failed'):
                 await process_failed_payment(payment_id, user_id)
-                break
-                
-            elif status == "error":
-                print(f"Ошибка при проверке платежа {payment_id}")
-                
-            if payment_id in payment_sessions:
-                payment_sessions[payment_id]['status'] = status
-                payment_sessions[payment_id]['last_check'] = time.time()
-                payment_sessions[payment_id]['checks_done'] = checks_done
-            
-        else:
+                PAYMENT_RESULTS.inc("failed")
+            return
+
+        if status == "error":
+            print(f"Ошибка при проверке платежа {payment_id}")
+
+        if payment_id in payment_sessions:
+            payment_sessions[payment_id]['status'] = status
+            payment_sessions[payment_id]['last_check'] = time.time()
+            payment_sessions[payment_id]['checks_done'] = checks_done
+
+        if checks_done >= max_checks and finish_payment(payment_id, 'expired'):
             await process_expired_payment(payment_id, user_id)
-            
+            PAYMENT_RESULTS.inc("expired")
+
     except Exception as e:
-        logger.error(f"Error in check_payment_status_loop for {payment_id}: {e}")
+        logger.error(f"Error in reconcile_payment for {payment_id}: {e}")
+
+async def reconcile_payments(context: ContextTypes.DEFAULT_TYPE):
+    """
+    Задача планировщика: сверка ожидающих платежей с провайдером. Расписание
+    опросов хранится в таблице payments, поэтому переживает перезапуск бота.
+    Если включены уведомления провайдера, опрос редкий и только
+    подстраховывает потерянные уведомления.
+    """
+    claimed = claim_due_payments()
+    if not claimed:
+        return
+    # Каждая проверка открывает браузер - ограничиваем число одновременных
+    semaphore = asyncio.Semaphore(PAYMENT_CONFIG['max_parallel_checks'])
+
+    async def check(payment):
+        async with semaphore:
+            await reconcile_payment(*payment)
+
+    await asyncio.gather(*[check(payment) for payment in claimed])
 
 async def process_expired_payment(payment_id, user_id):
     """Обработка истекшего платежа"""
@@ -902,36 +1058,35 @@ async def process_expired_payment(payment_id, user_id):
     except Exception as e:
         logger.error(f"Error in process_expired_payment: {e}")
 
-async def cleanup_task():
-    """Фоновая задача для очистки старых сессий"""
-    while True:
-        try:
-            cleaned_count = await asyncio.get_event_loop().run_in_executor(
-                None, cleanup_old_sessions, payment_sessions, 30
-            )
-            if cleaned_count > 0:
-                logger.info(f"Очищено {cleaned_count} старых сессий платежей")
-            
-            await asyncio.sleep(3600)
-            
-        except Exception as e:
-            logger.error(f"Error in cleanup_task: {e}")
-            await asyncio.sleep(300)
+async def cleanup_sessions(context: ContextTypes.DEFAULT_TYPE):
+    """Задача планировщика: очистка старых сессий платежей и состояний пользователей"""
+    loop = asyncio.get_running_loop()
+    cleaned_count = await loop.run_in_executor(None, cleanup_old_sessions, payment_sessions, 30)
+    if cleaned_count > 0:
+        logger.info(f"Очищено {cleaned_count} старых сессий платежей")
+
+    expired_states = await loop.run_in_executor(None, user_states.purge_expired)
+    if expired_states > 0:
+        logger.info(f"Удалено {expired_states} устаревших состояний пользователей")
 
 async def send_payment_status_update(query, payment_id):
     """Отправляет обновление статуса платежа"""
     try:
-        if payment_id in payment_sessions:
-            session = payment_sessions[payment_id]
-            status = session['status']
+        payment = load_payment(payment_id)
+        if payment_id in payment_sessions or payment is not None:
+            session = payment_sessions.get(payment_id, {})
+            # Итог мог прийти уведомлением провайдера, в том числе на другую реплику
+            status = payment.status if payment is not None and payment.status != 'pending' else session.get('status', 'pending')
             
             if status == 'completed':
                 message = "✅ Платеж уже завершен и средства зачислены!"
             elif status == 'failed':
                 message = "❌ Платеж не прошел. Попробуйте создать новый."
+            elif status == 'expired':
+                message = "⏰ Время оплаты истекло. Создайте новый платеж."
             elif status == 'pending':
-                checks_done = session.get('checks_done', 0)
-                message = f"🔄 Платеж обрабатывается... (проверка {checks_done}/30)"
+                checks_done = payment.checks_done if payment is not None else session.get('checks_done', 0)
+                message = f"🔄 Платеж обрабатывается... (проверка {checks_done}/{payment_check_schedule()[1]})"
             else:
                 message = "⚡ Статус платежа неизвестен."
                 
@@ -943,45 +1098,82 @@ async def send_payment_status_update(query, payment_id):
         logger.error(f"Error in send_payment_status_update: {e}")
         await query.answer("❌ Ошибка при проверке статуса!")
 
-async def process_successful_payment(payment_id, user_id, amount):
-    """Обработка успешного платежа"""
+async def process_successful_payment(payment_id, user_id):
+    """
+    Зачисляет оплаченный платеж на сумму, сохраненную при его создании.
+    Зачисляется только ожидающий платеж или истекший не раньше чем
+    late_payment_grace секунд назад (оплата пришла после конца опроса).
+    Возвращает 'credited' - зачислено сейчас, 'duplicate' - уже зачислен,
+    'rejected' - платеж завершен иначе (failed или давно истек), 'error'.
+    """
+    result = 'error'
+    db = get_session(engine)
     try:
-        db = get_session(engine)
-        user = db.query(User).filter(User.user_id == user_id).first()
-        
-        if user:
-            user.balance += amount
+        user = db.query(User).filter(User.user_id == user_id).with_for_update().first()
+        if not user:
+            return result
+
+        grace_start = datetime.now() - timedelta(seconds=PAYMENT_CONFIG['late_payment_grace'])
+        claimed = db.query(Payment).filter(
+            Payment.payment_id == payment_id,
+            or_(Payment.status == 'pending',
+                and_(Payment.status == 'expired', Payment.finished_at >= grace_start))
+        ).update({'status': 'completed', 'finished_at': datetime.now()}, synchronize_session=False)
+        if not claimed:
+            db.rollback()
+            payment = load_payment(payment_id)
+            result = 'duplicate' if payment is not None and payment.status == 'completed' else 'rejected'
+            if result == 'rejected':
+                logger.warning(f"Оплата платежа {payment_id} в статусе {payment.status if payment else '?'} не зачислена")
+            return result
+
+        payment = db.query(Payment).filter(Payment.payment_id == payment_id).first()
+        amount = payment.amount
+        # Повторная обработка того же payment_id не найдет новой записи журнала и ничего не зачислит
+        _, credited = apply_transaction(db, user, amount, SOURCE_PAYMENT, payment_id, comment="Пополнение баланса")
+        try:
             db.commit()
-            
-            from telegram import Bot
-            bot = Bot(token=BOT_TOKEN)
-            
-            success_text = (
-                f"✅ *Платеж подтвержден!*\n\n"
-                f"💰 Зачислено: {amount} руб.\n"
-                f"💳 Новый баланс: {user.balance} руб.\n"
-                f"🔗 ID платежа: `{payment_id}`\n\n"
-                f"Теперь вы можете совершать покупки! 🎉"
-            )
-            
-            await bot.send_message(
-                chat_id=user_id,
-                text=success_text,
-                parse_mode='Markdown',
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🛍️ В магазин", callback_data="shop")],
-                    [InlineKeyboardButton("👤 Профиль", callback_data="profile")]
-                ])
-            )
-            
+        except IntegrityError:
+            db.rollback()
+            credited = False
+        if not credited:
             if payment_id in payment_sessions:
                 payment_sessions[payment_id]['status'] = 'completed'
-                payment_sessions[payment_id]['actual_amount'] = amount
-                
-            logger.info(f"Успешный платеж {payment_id} на сумму {amount} руб. для пользователя {user_id}")
+            logger.info(f"Платеж {payment_id} уже зачислен, повторное зачисление пропущено")
+            return 'duplicate'
+        result = 'credited'
+
+        from telegram import Bot
+        bot = Bot(token=BOT_TOKEN)
+        
+        success_text = (
+            f"✅ *Платеж подтвержден!*\n\n"
+            f"💰 Зачислено: {format_rub(amount)} руб.\n"
+            f"💳 Новый баланс: {format_rub(user.balance)} руб.\n"
+            f"🔗 ID платежа: `{payment_id}`\n\n"
+            f"Теперь вы можете совершать покупки! 🎉"
+        )
+        
+        await bot.send_message(
+            chat_id=user_id,
+            text=success_text,
+            parse_mode='Markdown',
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🛍️ В магазин", callback_data="shop")],
+                [InlineKeyboardButton("👤 Профиль", callback_data="profile")]
+            ])
+        )
+        
+        if payment_id in payment_sessions:
+            payment_sessions[payment_id]['status'] = 'completed'
+            payment_sessions[payment_id]['actual_amount'] = format_rub(amount)
+            
+        logger.info(f"Успешный платеж {payment_id} на сумму {format_rub(amount)} руб. для пользователя {user_id}")
+        return result
             
     except Exception as e:
         logger.error(f"Error in process_successful_payment: {e}")
+        return result
     finally:
         db.close()
 
@@ -1036,22 +1228,22 @@ async def cancel_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def confirm_order(query):
     db = get_session(engine)
     try:
-        user = db.query(User).filter(User.user_id == query.from_user.id).first()
+        user = db.query(User).filter(User.user_id == query.from_user.id).with_for_update().first()
         cart_items = db.query(CartItem).filter(CartItem.user_id == user.id).all()
         if not cart_items:
             await query.answer("❌ Корзина пуста!")
             return
         
         total_amount = sum(item.quantity * item.product.price for item in cart_items)
-        if total_amount < 1500:
-            await query.message.reply_text("❌ Минимальная сумма заказа - 1500 рублей. Добавьте еще товаров в корзину.")
+        if total_amount < MIN_ORDER_AMOUNT:
+            await query.message.reply_text(f"❌ Минимальная сумма заказа - {format_rub(MIN_ORDER_AMOUNT)} рублей. Добавьте еще товаров в корзину.")
             return
         
         if user.balance < total_amount:
             await query.message.reply_text(
                 f"❌ Недостаточно средств на балансе!\n"
-                f"💵 Нужно: {total_amount} руб.\n"
-                f"💳 На балансе: {user.balance} руб.\n\n"
+                f"💵 Нужно: {format_rub(total_amount)} руб.\n"
+                f"💳 На балансе: {format_rub(user.balance)} руб.\n\n"
                 f"Пополните баланс в разделе 👤 Профиль",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("💵 Пополнить баланс", callback_data="profile")],
@@ -1063,7 +1255,7 @@ async def confirm_order(query):
 
         order = Order(user_id=user.id, total_amount=total_amount, status='pending')
         db.add(order)
-        db.commit()
+        db.flush()
         
         order_items = []
         for item in cart_items:
@@ -1071,15 +1263,15 @@ async def confirm_order(query):
             db.add(order_item)
             order_items.append(item)
         
-        user.balance -= total_amount
+        apply_transaction(db, user, -total_amount, SOURCE_ORDER, order.order_number, comment=f"Оплата заказа #{order.order_number}")
         user.orders_count += 1
         db.query(CartItem).filter(CartItem.user_id == user.id).delete()
         db.commit()
         
-        order_info = f"ФИО: \nЗаказ #{order.order_number}\nСумма: {total_amount} руб.\nТовары:\n"
+        order_info = f"ФИО: \nЗаказ #{order.order_number}\nСумма: {format_rub(total_amount)} руб.\nТовары:\n"
         
         for item in order_items:
-            order_info += f"- {item.product.name} x{item.quantity} = {item.quantity * item.product.price} руб.\n"
+            order_info += f"- {item.product.name} x{item.quantity} = {format_rub(item.quantity * item.product.price)} руб.\n"
         
         order_info += "Доставка: 500р\nАдрес почты России: \nНомер телефона: "
         
@@ -1093,7 +1285,7 @@ async def confirm_order(query):
         
         await query.message.reply_text(
             f"✅ Заказ #{order.order_number} создан!\n"
-            f"💵 Сумма: {total_amount} руб.\n\n"
+            f"💵 Сумма: {format_rub(total_amount)} руб.\n\n"
             f"📦 Для указания адреса доставки и номера телефона нажмите кнопку ниже:",
             reply_markup=reply_markup
         )
@@ -1114,8 +1306,57 @@ async def cancel_payment_callback(update: Update, context: ContextTypes.DEFAULT_
     )
     return ConversationHandler.END
 
-def main():
-    application = Application.builder().token(BOT_TOKEN).build()
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest, который пишет время каждого вызова Bot API в метрики"""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        # В url есть токен бота, в метку идет только имя метода API
+        api_method = 'file' if '/file/bot' in url else url.rsplit('/', 1)[-1]
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            status = str(code)
+            return code, payload
+        finally:
+            TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, api_method, status)
+
+async def log_update_metrics(context: ContextTypes.DEFAULT_TYPE):
+    metrics = context.application.update_processor.get_metrics()
+    logger.info(
+        f"Обновления: в работе {metrics['in_flight']}/{metrics['max_workers']}, "
+        f"ожидают {metrics['pending'] - metrics['in_flight']}, "
+        f"пользователей в очереди {metrics['queued_users']}, "
+        f"макс. очередь пользователя {metrics['max_user_queue_depth']}"
+    )
+
+async def on_startup(application):
+    # В режиме webhook маршрут уведомлений живет на сервере webhook
+    if PAYMENT_CALLBACK_SECRET and BOT_MODE != 'webhook':
+        application.bot_data['payment_callback_runner'] = await start_callback_server(handle_payment_event)
+
+async def on_shutdown(application):
+    runner = application.bot_data.pop('payment_callback_runner', None)
+    if runner is not None:
+        await runner.cleanup()
+    await close_payment_client(application)
+
+def build_application():
+    # Разные пользователи обрабатываются параллельно, обновления одного - по порядку
+    update_processor = PerUserUpdateProcessor(BOT_CONCURRENT_UPDATES)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(update_processor)
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
+    gauge_function('shop_bot_updates_in_flight', 'Обновления в обработке', lambda: update_processor.in_flight)
+    gauge_function('shop_bot_updates_pending', 'Принятые и еще не обработанные обновления', lambda: update_processor.current_concurrent_updates)
+    gauge_function('shop_bot_user_states', 'Состояния пользователей в памяти', lambda: user_states.get_metrics()['entries'])
+    gauge_function('shop_bot_max_user_queue_depth', 'Самая длинная очередь обновлений одного пользователя', lambda: update_processor.get_metrics()['max_user_queue_depth'])
     
     search_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(start_search, pattern="^search$")],
@@ -1144,10 +1385,25 @@ def main():
     application.add_handler(payment_conv_handler)
     application.add_handler(CallbackQueryHandler(handle_callback))
     
-    application.job_queue.run_once(lambda context: asyncio.create_task(cleanup_task()), when=1)
+    # Все периодические задачи бота - на планировщике JobQueue с общими настройками
+    instrument_scheduler(application.job_queue.scheduler)
+    add_bot_job(application.job_queue, reconcile_payments, 'reconcile_payments', PAYMENT_CONFIG['reconcile_interval'], jitter=2)
+    add_bot_job(application.job_queue, cleanup_sessions, 'cleanup_sessions', 3600, first=10, jitter=300)
+    add_bot_job(application.job_queue, log_update_metrics, 'log_update_metrics', 60)
     
-    logger.info("Бот запущен с полной платежной системой!")
-    application.run_polling()
+    return application
+
+def main():
+    application = build_application()
+    start_metrics_server(METRICS_PORT, METRICS_HOST)
+
+    if BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        logger.info("Бот запущен в режиме webhook с полной платежной системой!")
+        run_webhook(application, payment_handler=handle_payment_event if PAYMENT_CALLBACK_SECRET else None)
+    else:
+        logger.info("Бот запущен с полной платежной системой!")
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
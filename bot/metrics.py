@@ -0,0 +1,199 @@
+"""
+Метрики процессов магазина в текстовом формате Prometheus.
+
+Только стандартная библиотека: счетчики и гистограммы с метками хранятся в
+памяти процесса, render() отдает их в формате text exposition 0.0.4.
+Бот и воркер поднимают для этого маленький HTTP-сервер
+(start_metrics_server), админ-панель отдает метрики маршрутом /metrics.
+
+Время работы с БД привязывается к месту вызова через contextvar
+db_call_site: обработчик бота, маршрут админки или задача воркера
+выставляют его через call_site(), а события пула SQLAlchemy
+(instrument_engine) пишут с этой меткой, сколько соединение было занято -
+от выдачи из пула до возврата. Замер на каждый запрос (события курсора)
+стоил десятки процентов времени простого запроса SQLite, а выдача
+соединения бывает одна на обработчик.
+"""
+import time
+import bisect
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+registry = []
+registry_lock = threading.Lock()
+
+db_call_site = ContextVar('db_call_site', default='other')
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def format_labels(labelnames, values, extra=None):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            items = list(self.values.items())
+        for labels, value in items:
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labels -> [счетчики по корзинам (последняя +Inf), сумма]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.values.get(labels)
+            if series is None:
+                series = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            items = [(labels, list(series[0]), series[1]) for labels, series in self.values.items()]
+        for labels, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = format_labels(self.labelnames, labels, f'le="{le}"')
+                lines.append(f'{self.name}_bucket{bucket_labels} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+class GaugeFunction:
+    """Значение считается в момент отдачи метрик вызовом function()"""
+
+    def __init__(self, name, documentation, function):
+        self.name = name
+        self.documentation = documentation
+        self.function = function
+
+    def render(self):
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.function()}']
+
+def register(metric):
+    with registry_lock:
+        registry.append(metric)
+    return metric
+
+def counter(name, documentation, labelnames=()):
+    return register(Counter(name, documentation, labelnames))
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, documentation, labelnames, buckets))
+
+def gauge_function(name, documentation, function):
+    return register(GaugeFunction(name, documentation, function))
+
+def render():
+    with registry_lock:
+        metrics = list(registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Общие метрики всех процессов
+HANDLER_SECONDS = histogram('shop_bot_handler_seconds', 'Время обработки обновления ботом', ['handler'])
+TELEGRAM_API_SECONDS = histogram('shop_telegram_api_seconds', 'Время запросов к Telegram Bot API', ['method', 'status'])
+DB_SESSION_SECONDS = histogram('shop_db_session_seconds', 'Время работы с соединением БД по месту вызова', ['call_site'],
+                               buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0))
+ADMIN_REQUEST_SECONDS = histogram('shop_admin_request_seconds', 'Время ответа админ-панели', ['endpoint', 'status'])
+CRAWLER_FETCH_SECONDS = histogram('shop_crawler_fetch_seconds', 'Загрузка страниц поставщиков', ['host', 'outcome'])
+CRAWLER_PARSE_SECONDS = histogram('shop_crawler_parse_seconds', 'Разбор страниц поставщиков', ['host'])
+PAYMENT_POLLS = counter('shop_payment_polls_total', 'Проверки статуса платежей по результату', ['status'])
+PAYMENT_POLL_SECONDS = histogram('shop_payment_poll_seconds', 'Время проверки статуса платежа')
+PAYMENT_RESULTS = counter('shop_payment_results_total', 'Завершенные платежи по исходу', ['outcome'])
+
+@contextmanager
+def call_site(name):
+    """Помечает запросы к БД внутри блока меткой call_site"""
+    token = db_call_site.set(name)
+    try:
+        yield
+    finally:
+        db_call_site.reset(token)
+
+def instrument_engine(engine):
+    """Вешает на пул engine замер времени, пока соединение занято, по месту вызова"""
+    from sqlalchemy import event
+
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        connection_record.info['metrics_checkout'] = (time.perf_counter(), db_call_site.get())
+
+    def on_checkin(dbapi_connection, connection_record):
+        checkout = connection_record.info.pop('metrics_checkout', None)
+        if checkout is not None:
+            DB_SESSION_SECONDS.observe(time.perf_counter() - checkout[0], checkout[1])
+
+    event.listen(engine, 'checkout', on_checkout)
+    event.listen(engine, 'checkin', on_checkin)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port, host='127.0.0.1'):
+    """Отдает /metrics на host:port из фонового потока"""
+    try:
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        # Порт занят другой репликой на этом же сервере - работаем без /metrics
+        print(f"⚠️ Не удалось открыть порт метрик {host}:{port}: {e}")
+        return None
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
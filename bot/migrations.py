@@ -0,0 +1,202 @@
+"""
+Версионные миграции схемы базы магазина (SQLite или PostgreSQL).
+
+Base.metadata.create_all создает только отсутствующие таблицы и не меняет
+существующие, поэтому изменения схемы для уже работающих баз описываются
+здесь. Примененные версии хранятся в таблице schema_version. Новая база,
+только что созданная по моделям, просто помечается последней версией.
+
+Бот, воркеры админ-панели и воркер проверки наличия стартуют одновременно
+и каждый вызывает init_db, поэтому подготовка схемы (создание таблиц,
+проверка schema_version и миграции) выполняется целиком под межпроцессной
+блокировкой и в одной транзакции: на PostgreSQL - advisory-блокировка
+транзакции, на SQLite - BEGIN IMMEDIATE (эксклюзивная блокировка записи).
+Следующий процесс получает блокировку после коммита первого и видит уже
+примененные версии.
+"""
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import OperationalError
+
+def migration_001_hot_indexes(connection):
+    """Индексы для частых выборок бота и админ-панели"""
+    indexes = [
+        ('ix_products_category_active', 'products', 'category, is_active'),
+        ('ix_cart_items_user_product', 'cart_items', 'user_id, product_id'),
+        ('ix_orders_user_created', 'orders', 'user_id, created_at'),
+        ('ix_orders_status_created', 'orders', 'status, created_at'),
+        ('ix_orders_created', 'orders', 'created_at'),
+        ('ix_order_items_order', 'order_items', 'order_id'),
+        ('ix_order_status_history_order', 'order_status_history', 'order_id, changed_at'),
+        ('ix_order_notes_order', 'order_notes', 'order_id, created_at')
+    ]
+    for name, table, columns in indexes:
+        connection.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+
+# Денежные колонки, которые переводятся из рублей (FLOAT) в копейки
+MONEY_COLUMNS = [
+    ('users', 'balance'),
+    ('products', 'price'),
+    ('orders', 'total_amount'),
+    ('order_items', 'price')
+]
+
+def migration_002_money_in_kopecks(connection):
+    """Рубли с плавающей точкой -> целые копейки"""
+    for table, column in MONEY_COLUMNS:
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(
+                f"ALTER TABLE {table} ALTER COLUMN {column} TYPE BIGINT "
+                f"USING ROUND({column}::numeric * 100)::bigint"
+            ))
+        else:
+            # SQLite не меняет тип колонки, но значения становятся целыми
+            connection.execute(text(
+                f"UPDATE {table} SET {column} = CAST(ROUND({column} * 100) AS INTEGER) "
+                f"WHERE {column} IS NOT NULL"
+            ))
+
+def migration_003_product_photo_file_id(connection):
+    """Колонка для кэша Telegram file_id картинок товаров"""
+    columns = [column['name'] for column in inspect(connection).get_columns('products')]
+    if 'photo_file_id' not in columns:
+        connection.execute(text("ALTER TABLE products ADD COLUMN photo_file_id VARCHAR(200)"))
+
+def migration_004_opening_balances(connection):
+    """
+    Начальные записи журнала баланса, чтобы сумма журнала совпадала с
+    балансами. Повторный запуск не добавляет записи второй раз.
+    """
+    connection.execute(text(
+        "INSERT INTO balance_transactions (user_id, amount, balance_after, source, external_id, comment, created_at) "
+        "SELECT id, balance, balance, 'opening', CAST(id AS VARCHAR(100)), 'Баланс до ведения журнала', :now "
+        "FROM users WHERE balance IS NOT NULL AND balance <> 0 "
+        "AND NOT EXISTS (SELECT 1 FROM balance_transactions bt "
+        "WHERE bt.source = 'opening' AND bt.external_id = CAST(users.id AS VARCHAR(100)))"
+    ), {'now': datetime.now()})
+
+def migration_005_payment_checks(connection):
+    """Расписание сверки платежей хранится в самой таблице payments"""
+    columns = [column['name'] for column in inspect(connection).get_columns('payments')]
+    if 'checks_done' not in columns:
+        connection.execute(text("ALTER TABLE payments ADD COLUMN checks_done INTEGER DEFAULT 0"))
+    if 'next_check_at' not in columns:
+        connection.execute(text("ALTER TABLE payments ADD COLUMN next_check_at TIMESTAMP"))
+    connection.execute(text("DROP INDEX IF EXISTS ix_payments_status_created"))
+    connection.execute(text("CREATE INDEX IF NOT EXISTS ix_payments_status_next_check ON payments (status, next_check_at)"))
+    connection.execute(text(
+        "UPDATE payments SET checks_done = 0, next_check_at = :now WHERE status = 'pending' AND next_check_at IS NULL"
+    ), {'now': datetime.now()})
+
+def migration_006_drop_scheduled_jobs(connection):
+    """Общее хранилище задач APScheduler больше не используется"""
+    connection.execute(text("DROP TABLE IF EXISTS scheduled_jobs"))
+
+MIGRATIONS = [
+    (1, 'Индексы для частых выборок', migration_001_hot_indexes),
+    (2, 'Денежные суммы в копейках', migration_002_money_in_kopecks),
+    (3, 'file_id картинок товаров', migration_003_product_photo_file_id),
+    (4, 'Начальные записи журнала баланса', migration_004_opening_balances),
+    (5, 'Расписание сверки платежей', migration_005_payment_checks),
+    (6, 'Удаление таблицы scheduled_jobs', migration_006_drop_scheduled_jobs)
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+# Произвольный ключ advisory-блокировки миграций в PostgreSQL
+MIGRATION_LOCK_KEY = 420001
+
+# Сколько ждать, пока другой процесс закончит миграции на SQLite, секунд
+MIGRATION_LOCK_TIMEOUT = 600
+
+def ensure_version_table(connection):
+    connection.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_version ("
+        "version INTEGER PRIMARY KEY, "
+        "description VARCHAR(200), "
+        "applied_at TIMESTAMP)"
+    ))
+
+def get_schema_version(engine):
+    """Возвращает текущую версию схемы (0 если миграции не применялись)"""
+    if not inspect(engine).has_table('schema_version'):
+        return 0
+    with engine.connect() as connection:
+        version = connection.execute(text("SELECT MAX(version) FROM schema_version")).scalar()
+    return version or 0
+
+def begin_immediate(connection):
+    """BEGIN IMMEDIATE с ожиданием: busy_timeout может быть короче долгой миграции"""
+    deadline = time.monotonic() + MIGRATION_LOCK_TIMEOUT
+    while True:
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            return
+        except OperationalError as e:
+            if 'locked' not in str(e) or time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+@contextmanager
+def schema_lock(engine):
+    """Соединение в транзакции, которую одновременно держит только один процесс"""
+    if engine.dialect.name == 'sqlite':
+        # Транзакцией управляем сами: драйвер sqlite3 не умеет BEGIN IMMEDIATE
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            begin_immediate(connection)
+            try:
+                yield connection
+            except BaseException:
+                connection.exec_driver_sql("ROLLBACK")
+                raise
+            connection.exec_driver_sql("COMMIT")
+        return
+
+    with engine.begin() as connection:
+        if engine.dialect.name == 'postgresql':
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': MIGRATION_LOCK_KEY})
+        yield connection
+
+def run_migrations(engine, metadata=None, fresh=None, seed=None):
+    """
+    Создает недостающие таблицы по metadata, применяет недостающие
+    миграции по порядку и вызывает seed(connection) для начальных данных -
+    все под блокировкой схемы и в одной транзакции.
+    fresh=None - определить самостоятельно: база новая, если в ней еще нет
+    таблицы users; тогда схема создается по моделям и миграции только
+    отмечаются как примененные. Возвращает список примененных версий.
+    """
+    with schema_lock(engine) as connection:
+        if fresh is None:
+            fresh = not inspect(connection).has_table('users')
+        if metadata is not None:
+            metadata.create_all(connection)
+        applied = apply_migrations(connection, fresh)
+        if seed is not None:
+            seed(connection)
+        return applied
+
+def apply_migrations(connection, fresh):
+    ensure_version_table(connection)
+    applied_versions = {
+        row[0] for row in connection.execute(text("SELECT version FROM schema_version"))
+    }
+
+    applied = []
+    for version, description, migrate in MIGRATIONS:
+        if version in applied_versions:
+            continue
+
+        if not fresh:
+            print(f"🔄 Применяем миграцию {version}: {description}")
+            migrate(connection)
+
+        connection.execute(
+            text("INSERT INTO schema_version (version, description, applied_at) VALUES (:version, :description, :applied_at)"),
+            {'version': version, 'description': description, 'applied_at': datetime.now()}
+        )
+        applied.append(version)
+
+    return applied
@@ -0,0 +1,45 @@
+"""
+Денежные суммы магазина.
+
+Цены, балансы и суммы заказов хранятся целым числом копеек: сложение и
+агрегаты в базе получаются точными, без накопления ошибок округления float.
+Рубли появляются только на границах - при вводе суммы и при выводе текста.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from sqlalchemy import BigInteger
+from sqlalchemy.types import TypeDecorator
+
+KOPECKS_IN_RUBLE = 100
+
+class Money(TypeDecorator):
+    """Сумма в копейках. В старых базах SQLite колонка объявлена как FLOAT,
+    поэтому значение всегда приводится к int при чтении."""
+    impl = BigInteger
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return int(value) if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return int(value) if value is not None else None
+
+def to_kopecks(value):
+    """Переводит сумму в рублях (число или строку '1290.50' / '1290,50') в копейки"""
+    try:
+        rubles = Decimal(str(value).strip().replace(' ', '').replace(',', '.'))
+        if not rubles.is_finite():
+            raise ValueError(f"Некорректная сумма: {value}")
+        # quantize бросает InvalidOperation и на числах вроде '1e100000'
+        kopecks = (rubles * KOPECKS_IN_RUBLE).quantize(Decimal('1'), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError(f"Некорректная сумма: {value}")
+    return int(kopecks)
+
+def format_rub(kopecks):
+    """Сумма в копейках для вывода: 129000 -> '1290', 129050 -> '1290.50'"""
+    kopecks = int(kopecks or 0)
+    sign = '-' if kopecks < 0 else ''
+    rubles, rest = divmod(abs(kopecks), KOPECKS_IN_RUBLE)
+    if rest:
+        return f"{sign}{rubles}.{rest:02d}"
+    return f"{sign}{rubles}"
@@ -0,0 +1,252 @@
+"""
+Очередь исходящих уведомлений покупателям (таблица notification_outbox).
+
+Код, меняющий заказ, вызывает enqueue_notification в своей транзакции:
+сообщение фиксируется тем же commit, что и изменение, и не теряется, даже
+если отправитель или Telegram недоступны. Доставляет очередь воркер
+(задача deliver_notifications): забирает пачку, отправляет не чаще
+rate_per_second сообщений в секунду и не чаще одного сообщения в
+per_chat_interval одному покупателю, при 429 ждет retry_after, сетевые
+ошибки и 5xx повторяет с растущей паузой. Ошибки 400/403 (бот
+заблокирован, чат не найден) не повторяются.
+
+Доставка "хотя бы один раз": каждое сообщение отмечается отправленным
+сразу после успешной отправки; если воркер упал посреди пачки, остальные
+сообщения будут отправлены снова через claim_timeout секунд, а повторно
+может уйти не больше одного.
+"""
+import time
+from datetime import datetime, timedelta
+import requests
+from sqlalchemy import insert, update, delete, func
+
+try:
+    from database import NotificationOutbox
+    from metrics import counter, histogram
+except ImportError:
+    from bot.database import NotificationOutbox
+    from bot.metrics import counter, histogram
+
+try:
+    from config import BOT_TOKEN
+except ImportError:
+    BOT_TOKEN = None
+
+NOTIFICATION_CONFIG = {
+    'poll_interval': 2,
+    'batch_size': 100,
+    # Telegram допускает около 30 сообщений в секунду от бота и 1 в секунду в один чат
+    'rate_per_second': 25,
+    'per_chat_interval': 1.0,
+    'claim_timeout': 120,
+    'max_attempts': 8,
+    'retry_base': 5,
+    'retry_max': 1800,
+    # Дольше retry_after из ответа 429 доставку не откладываем
+    'max_retry_after': 300,
+    'timeout': 10,
+    'keep_sent_days': 7
+}
+
+NOTIFICATIONS = counter('shop_notifications_total', 'Попытки доставки уведомлений по исходу', ['outcome'])
+NOTIFICATION_DELAY = histogram('shop_notification_delay_seconds', 'Время от постановки уведомления в очередь до отправки',
+                               buckets=(0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0))
+
+http = None
+last_sent_to_chat = {}
+
+def enqueue_notification(db, chat_id, text, parse_mode='HTML'):
+    """Ставит сообщение в очередь в транзакции db (без commit)"""
+    notification = NotificationOutbox(
+        chat_id=int(chat_id),
+        text=text,
+        parse_mode=parse_mode,
+        next_attempt_at=datetime.now()
+    )
+    db.add(notification)
+    return notification
+
+def enqueue_notifications(db, messages, parse_mode='HTML'):
+    """Ставит в очередь много сообщений [(chat_id, text), ...] одним INSERT (без commit)"""
+    now = datetime.now()
+    rows = [
+        {'chat_id': int(chat_id), 'text': text, 'parse_mode': parse_mode, 'next_attempt_at': now}
+        for chat_id, text in messages
+    ]
+    if rows:
+        db.execute(insert(NotificationOutbox), rows)
+    return len(rows)
+
+def pending_notifications(db):
+    return db.query(func.count(NotificationOutbox.id)).filter(NotificationOutbox.status == 'pending').scalar()
+
+def retry_delay(attempts):
+    return min(NOTIFICATION_CONFIG['retry_base'] * 2 ** (attempts - 1), NOTIFICATION_CONFIG['retry_max'])
+
+def claim_notifications(Session):
+    """
+    Забирает пачку сообщений, которым пора на отправку, и откладывает их на
+    claim_timeout: если отправитель упадет, сообщения вернутся в очередь сами
+    """
+    now = datetime.now()
+    db = Session()
+    try:
+        due = db.query(
+            NotificationOutbox.id, NotificationOutbox.chat_id, NotificationOutbox.text,
+            NotificationOutbox.parse_mode, NotificationOutbox.attempts,
+            NotificationOutbox.created_at, NotificationOutbox.next_attempt_at
+        ).filter(
+            NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= now
+        ).order_by(NotificationOutbox.next_attempt_at, NotificationOutbox.id).limit(NOTIFICATION_CONFIG['batch_size']).all()
+        claimed = []
+        for row in due:
+            result = db.execute(
+                update(NotificationOutbox)
+                .where(NotificationOutbox.id == row.id, NotificationOutbox.status == 'pending',
+                       NotificationOutbox.next_attempt_at == row.next_attempt_at)
+                .values(next_attempt_at=now + timedelta(seconds=NOTIFICATION_CONFIG['claim_timeout']))
+            )
+            if result.rowcount:
+                claimed.append(row)
+        db.commit()
+        return claimed
+    finally:
+        db.close()
+
+def parse_retry_after(data):
+    """retry_after из ответа 429 в секундах: от 1 до max_retry_after"""
+    try:
+        retry_after = int((data.get('parameters') or {}).get('retry_after', 1))
+    except (TypeError, ValueError, AttributeError):
+        retry_after = 1
+    return min(max(retry_after, 1), NOTIFICATION_CONFIG['max_retry_after'])
+
+def send_message(chat_id, text, parse_mode):
+    """
+    Один вызов sendMessage. Возвращает (исход, пауза до повтора, ошибка):
+    'sent', 'retry' или 'failed'
+    """
+    global http
+    if http is None:
+        # Одна сессия на процесс - соединение с api.telegram.org переиспользуется
+        http = requests.Session()
+    payload = {'chat_id': chat_id, 'text': text}
+    if parse_mode:
+        payload['parse_mode'] = parse_mode
+    try:
+        response = http.post(
+            f"https://api.telegram.org/bot{BOT_TOKEN}/sendMessage",
+            json=payload,
+            timeout=NOTIFICATION_CONFIG['timeout']
+        )
+    except requests.exceptions.RequestException as e:
+        return 'retry', None, f"Ошибка сети: {e}"
+
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
+    if response.status_code == 200 and data.get('ok'):
+        return 'sent', None, None
+    error = f"{response.status_code}: {data.get('description', response.text[:200])}"
+    if response.status_code == 429:
+        return 'retry', parse_retry_after(data), error
+    if response.status_code >= 500:
+        return 'retry', None, error
+    return 'failed', None, error
+
+def deliver_notifications(Session, send=None):
+    """
+    Отправляет одну пачку из очереди. Возвращает статистику или None, если
+    отправлять нечего. send(chat_id, text, parse_mode) можно подменить.
+    """
+    send = send or send_message
+    if send is send_message and not BOT_TOKEN:
+        return None
+    claimed = claim_notifications(Session)
+    if not claimed:
+        return None
+
+    stats = {'sent': 0, 'retry': 0, 'failed': 0, 'deferred': 0}
+    # id -> значения для UPDATE в конце пачки; отправленные отмечаются сразу
+    updates = {}
+    gap = 1.0 / NOTIFICATION_CONFIG['rate_per_second']
+    next_slot = time.monotonic()
+    for chat_id, sent_at in list(last_sent_to_chat.items()):
+        if next_slot - sent_at >= NOTIFICATION_CONFIG['per_chat_interval']:
+            del last_sent_to_chat[chat_id]
+    paused_until = None
+
+    db = Session()
+    try:
+        for row in claimed:
+            now = datetime.now()
+            if paused_until is not None:
+                # Telegram попросил подождать - остаток пачки возвращается в очередь
+                updates[row.id] = {'next_attempt_at': paused_until}
+                stats['deferred'] += 1
+                continue
+            since_last = time.monotonic() - last_sent_to_chat.get(row.chat_id, float('-inf'))
+            if since_last < NOTIFICATION_CONFIG['per_chat_interval']:
+                # Следующее сообщение тому же покупателю - в следующей пачке, порядок сохраняется
+                updates[row.id] = {'next_attempt_at': now + timedelta(seconds=NOTIFICATION_CONFIG['per_chat_interval'])}
+                stats['deferred'] += 1
+                continue
+
+            wait = next_slot - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            next_slot = time.monotonic() + gap
+            outcome, retry_after, error = send(row.chat_id, row.text, row.parse_mode)
+            last_sent_to_chat[row.chat_id] = time.monotonic()
+            attempts = (row.attempts or 0) + 1
+
+            if outcome == 'sent':
+                # Отмечается сразу: если воркер упадет дальше в пачке, повторно
+                # уйдет не больше одного сообщения, а не вся пачка
+                db.execute(
+                    update(NotificationOutbox)
+                    .where(NotificationOutbox.id == row.id)
+                    .values(status='sent', sent_at=datetime.now(), attempts=NotificationOutbox.attempts + 1, last_error=None)
+                )
+                db.commit()
+                NOTIFICATION_DELAY.observe((datetime.now() - row.created_at).total_seconds())
+            elif outcome == 'retry' and retry_after is not None:
+                # Ограничение скорости - не вина сообщения, попытка не засчитывается
+                paused_until = datetime.now() + timedelta(seconds=retry_after)
+                updates[row.id] = {'last_error': error[:300], 'next_attempt_at': paused_until}
+            elif outcome == 'retry' and attempts < NOTIFICATION_CONFIG['max_attempts']:
+                updates[row.id] = {'attempts': attempts, 'last_error': error[:300],
+                                   'next_attempt_at': datetime.now() + timedelta(seconds=retry_delay(attempts))}
+            else:
+                outcome = 'failed'
+                updates[row.id] = {'attempts': attempts, 'last_error': error[:300], 'status': 'failed'}
+                print(f"Уведомление {row.id} пользователю {row.chat_id} не доставлено: {error}")
+            stats[outcome] += 1
+            NOTIFICATIONS.inc(outcome)
+
+        if stats['deferred']:
+            NOTIFICATIONS.inc('deferred', amount=stats['deferred'])
+
+        for notification_id, values in updates.items():
+            db.execute(update(NotificationOutbox).where(NotificationOutbox.id == notification_id).values(**values))
+        db.commit()
+    finally:
+        db.close()
+    return stats
+
+def purge_sent_notifications(Session):
+    """Удаляет отправленные сообщения старше keep_sent_days"""
+    cutoff = datetime.now() - timedelta(days=NOTIFICATION_CONFIG['keep_sent_days'])
+    db = Session()
+    try:
+        result = db.execute(
+            delete(NotificationOutbox)
+            .where(NotificationOutbox.status == 'sent', NotificationOutbox.sent_at < cutoff)
+        )
+        db.commit()
+        return result.rowcount
+    finally:
+        db.close()
@@ -0,0 +1,104 @@
+"""
+Генератор номеров заказов.
+
+Номер собирается из времени в миллисекундах, номера узла (ORDER_NODE_ID),
+PID процесса и счетчика внутри миллисекунды, поэтому два процесса не могут
+выдать одинаковый номер и повторная попытка при вставке не нужна. Время
+стоит в старших разрядах: номера растут монотонно и новые записи ложатся в
+конец индекса order_number, а не в случайное место, как uuid4.
+
+Номер записывается в Crockford base32 фиксированной длины (16 символов) и
+дополняется контрольным символом Luhn mod 32, который ловит опечатки
+при ручном вводе номера.
+"""
+import os
+import time
+import threading
+
+try:
+    from config import ORDER_NODE_ID
+except ImportError:
+    ORDER_NODE_ID = 0
+
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+
+# Разрядность частей номера: 42 + 6 + 22 + 10 = 80 бит = 16 символов base32
+ORDER_NUMBER_CONFIG = {
+    'epoch_ms': 1704067200000,  # 2024-01-01 UTC
+    'time_bits': 42,
+    'node_bits': 6,
+    'pid_bits': 22,
+    'sequence_bits': 10,
+    'length': 16
+}
+
+generator_state = {'pid': None, 'last_ms': -1, 'sequence': 0}
+generator_lock = threading.Lock()
+
+def get_node_id():
+    node_id = int(os.environ.get('ORDER_NODE_ID', ORDER_NODE_ID))
+    if not 0 <= node_id < (1 << ORDER_NUMBER_CONFIG['node_bits']):
+        raise ValueError(f"ORDER_NODE_ID должен быть от 0 до {(1 << ORDER_NUMBER_CONFIG['node_bits']) - 1}")
+    return node_id
+
+def encode_base32(value, length):
+    chars = []
+    for _ in range(length):
+        value, index = divmod(value, 32)
+        chars.append(ALPHABET[index])
+    return ''.join(reversed(chars))
+
+def luhn_check_char(body):
+    """Контрольный символ Luhn mod 32 для строки в алфавите ALPHABET"""
+    total = 0
+    factor = 2
+    for char in reversed(body):
+        addend = factor * ALPHABET.index(char)
+        total += addend // 32 + addend % 32
+        factor = 1 if factor == 2 else 2
+    return ALPHABET[(32 - total % 32) % 32]
+
+def is_valid_order_number(value):
+    """Проверяет формат и контрольный символ номера заказа"""
+    value = (value or '').strip().upper()
+    if len(value) != ORDER_NUMBER_CONFIG['length'] + 1 or any(char not in ALPHABET for char in value):
+        return False
+    return luhn_check_char(value[:-1]) == value[-1]
+
+def next_sequence():
+    """Возвращает (миллисекунда, номер в ней) для текущего процесса"""
+    pid = os.getpid()
+    sequence_limit = 1 << ORDER_NUMBER_CONFIG['sequence_bits']
+
+    with generator_lock:
+        # После fork счетчик родителя не наследуется
+        if generator_state['pid'] != pid:
+            generator_state.update(pid=pid, last_ms=-1, sequence=0)
+
+        while True:
+            now_ms = int(time.time() * 1000) - ORDER_NUMBER_CONFIG['epoch_ms']
+            # Если часы ушли назад, продолжаем с последней выданной миллисекунды
+            now_ms = max(now_ms, generator_state['last_ms'])
+
+            if now_ms != generator_state['last_ms']:
+                generator_state.update(last_ms=now_ms, sequence=0)
+                return pid, now_ms, 0
+
+            if generator_state['sequence'] + 1 < sequence_limit:
+                generator_state['sequence'] += 1
+                return pid, now_ms, generator_state['sequence']
+
+            # Счетчик миллисекунды исчерпан - ждем следующую
+            time.sleep(0.0001)
+
+def next_order_number():
+    config = ORDER_NUMBER_CONFIG
+    pid, timestamp_ms, sequence = next_sequence()
+
+    value = timestamp_ms & ((1 << config['time_bits']) - 1)
+    value = (value << config['node_bits']) | get_node_id()
+    value = (value << config['pid_bits']) | (pid & ((1 << config['pid_bits']) - 1))
+    value = (value << config['sequence_bits']) | sequence
+
+    body = encode_base32(value, config['length'])
+    return body + luhn_check_char(body)
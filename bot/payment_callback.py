@@ -0,0 +1,132 @@
+"""
+Прием уведомлений о платежах от провайдера (или ретранслятора).
+
+Провайдер присылает POST на PAYMENT_CALLBACK_CONFIG['path'] с JSON
+{"payment_id": ..., "status": "completed" | "failed", "amount": ...}
+и заголовками X-Payment-Timestamp (unix time) и X-Payment-Signature -
+hex HMAC-SHA256 от "<timestamp>.<тело запроса>" с ключом
+PAYMENT_CALLBACK_SECRET. Запросы с неверной подписью или старше max_age
+секунд отклоняются. Обработка идемпотентна (зачисление идет через журнал
+баланса), поэтому повторная доставка того же события безопасна.
+
+В режиме webhook маршрут добавляется в сервер webhook, в режиме polling
+бот поднимает для него отдельный сервер на PAYMENT_CALLBACK_PORT.
+
+Имитация провайдера для локальной проверки:
+
+    python bot/payment_callback.py http://127.0.0.1:8081/payments/callback <payment_id> completed [сумма]
+"""
+import sys
+import hmac
+import json
+import time
+import hashlib
+import logging
+from aiohttp import web
+
+try:
+    from config import PAYMENT_CALLBACK_SECRET
+except ImportError:
+    PAYMENT_CALLBACK_SECRET = None
+
+try:
+    from config import PAYMENT_CALLBACK_HOST, PAYMENT_CALLBACK_PORT
+except ImportError:
+    PAYMENT_CALLBACK_HOST = '0.0.0.0'
+    PAYMENT_CALLBACK_PORT = 8081
+
+PAYMENT_CALLBACK_CONFIG = {
+    'path': '/payments/callback',
+    'max_age': 300,
+    'max_body_size': 64 * 1024
+}
+
+TIMESTAMP_HEADER = 'X-Payment-Timestamp'
+SIGNATURE_HEADER = 'X-Payment-Signature'
+
+EVENT_STATUSES = ('completed', 'failed')
+
+logger = logging.getLogger(__name__)
+
+def sign_payload(secret, timestamp, body):
+    message = str(timestamp).encode() + b'.' + body
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+def verify_signature(secret, timestamp, signature, body, now=None):
+    """Проверяет подпись и свежесть запроса"""
+    if not secret or not timestamp or not signature:
+        return False
+    try:
+        age = abs((now or time.time()) - int(timestamp))
+    except ValueError:
+        return False
+    if age > PAYMENT_CALLBACK_CONFIG['max_age']:
+        return False
+    return hmac.compare_digest(sign_payload(secret, timestamp, body), signature)
+
+def create_callback_handler(on_event, secret=None):
+    """
+    Обработчик aiohttp. on_event(event) - корутина бота, возвращает итог:
+    'credited', 'failed', 'duplicate', 'unknown' (платеж не найден),
+    'invalid' (некорректная сумма или не та, что при создании), 'rejected'
+    (платеж уже завершен без оплаты или давно истек) или 'error'.
+    """
+    secret = secret or PAYMENT_CALLBACK_SECRET
+
+    async def handle_payment_callback(request):
+        body = await request.read()
+        if not verify_signature(secret, request.headers.get(TIMESTAMP_HEADER),
+                                request.headers.get(SIGNATURE_HEADER), body):
+            logger.warning("Уведомление о платеже с неверной подписью отклонено")
+            return web.json_response({'error': 'invalid signature'}, status=401)
+
+        try:
+            event = json.loads(body)
+        except ValueError:
+            return web.json_response({'error': 'invalid json'}, status=400)
+        if not isinstance(event, dict) or not event.get('payment_id') or event.get('status') not in EVENT_STATUSES:
+            return web.json_response({'error': 'invalid event'}, status=400)
+
+        result = await on_event(event)
+        logger.info(f"Уведомление о платеже {event['payment_id']} ({event['status']}): {result}")
+        # На 'error' провайдер повторит доставку, повтор безопасен
+        status = {'unknown': 404, 'invalid': 400, 'rejected': 409, 'error': 500}.get(result, 200)
+        return web.json_response({'result': result}, status=status)
+
+    return handle_payment_callback
+
+def add_callback_route(web_app, on_event, secret=None):
+    web_app.router.add_post(PAYMENT_CALLBACK_CONFIG['path'], create_callback_handler(on_event, secret))
+
+async def start_callback_server(on_event, host=None, port=None):
+    """Отдельный сервер уведомлений для режима polling; возвращает runner для остановки"""
+    web_app = web.Application(client_max_size=PAYMENT_CALLBACK_CONFIG['max_body_size'])
+    add_callback_route(web_app, on_event)
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    site = web.TCPSite(runner, host or PAYMENT_CALLBACK_HOST, port or PAYMENT_CALLBACK_PORT)
+    await site.start()
+    logger.info(f"Уведомления о платежах принимаются на {host or PAYMENT_CALLBACK_HOST}:{port or PAYMENT_CALLBACK_PORT}{PAYMENT_CALLBACK_CONFIG['path']}")
+    return runner
+
+def send_test_event(url, payment_id, status, amount=None, secret=None):
+    """Подписанное событие как от провайдера - для локальной проверки"""
+    import requests
+    event = {'payment_id': payment_id, 'status': status}
+    if amount is not None:
+        event['amount'] = amount
+    body = json.dumps(event).encode()
+    timestamp = str(int(time.time()))
+    response = requests.post(url, data=body, timeout=10, headers={
+        'Content-Type': 'application/json',
+        TIMESTAMP_HEADER: timestamp,
+        SIGNATURE_HEADER: sign_payload(secret or PAYMENT_CALLBACK_SECRET, timestamp, body)
+    })
+    return response.status_code, response.text
+
+if __name__ == '__main__':
+    if len(sys.argv) < 4 or not PAYMENT_CALLBACK_SECRET:
+        print("Использование: python bot/payment_callback.py <url> <payment_id> <completed|failed> [сумма]")
+        print("PAYMENT_CALLBACK_SECRET должен быть задан в config.py")
+        sys.exit(1)
+    print(send_test_event(sys.argv[1], sys.argv[2], sys.argv[3], sys.argv[4] if len(sys.argv) > 4 else None))
@@ -0,0 +1,189 @@
+"""
+Долгоживущий асинхронный клиент steam-trader.com для создания платежей.
+
+Один экземпляр на процесс бота: пул соединений httpx.AsyncClient
+переиспользует TLS-соединения между пополнениями, куки из
+STEAM_TRADER_COOKIES загружаются и проверяются один раз при создании
+клиента. CSRF-токен кэшируется; если сайт отверг запрос из-за токена,
+клиент один раз загружает страницу пополнения, берет свежий токен и
+повторяет запрос.
+
+Методы асинхронные и вызываются прямо из обработчиков бота, без
+run_in_executor. base_url можно подменить, например, на локальную
+заглушку провайдера.
+"""
+import re
+import time
+import asyncio
+import httpx
+
+try:
+    from metrics import histogram
+except ImportError:
+    from bot.metrics import histogram
+
+PAYMENT_CLIENT_CONFIG = {
+    'base_url': 'https://steam-trader.com',
+    'receipt_url': 'https://payment.tome.ge/{payment_id}/receipt',
+    'payment_type': '28',
+    'timeout': 30,
+    'max_connections': 10,
+    'max_keepalive_connections': 10,
+    'keepalive_expiry': 300
+}
+
+REQUIRED_COOKIES = ['sid', 'csrf_token']
+
+DEFAULT_HEADERS = {
+    'accept': 'application/json, text/javascript, */*; q=0.01',
+    'accept-language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
+    'sec-ch-ua': '"Chromium";v="136", "Google Chrome";v="136", "Not:A-Brand";v="99"',
+    'sec-ch-ua-mobile': '?0',
+    'sec-ch-ua-platform': '"Windows"',
+    'sec-fetch-dest': 'empty',
+    'sec-fetch-mode': 'cors',
+    'sec-fetch-site': 'same-origin',
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36',
+    'x-requested-with': 'XMLHttpRequest'
+}
+
+CSRF_PATTERNS = [
+    re.compile(r'name=["\']csrf_token["\'][^>]*value=["\']([^"\']+)'),
+    re.compile(r'name=["\']csrf-token["\'][^>]*content=["\']([^"\']+)'),
+    re.compile(r'csrf_token["\']?\s*[:=]\s*["\']([^"\']+)')
+]
+
+PAYMENT_PROVIDER_SECONDS = histogram(
+    'shop_payment_provider_seconds', 'Запросы к платежному провайдеру', ['operation', 'outcome'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+)
+
+class PaymentProviderError(Exception):
+    """Провайдер не создал платеж"""
+
+class CsrfRejected(PaymentProviderError):
+    """Провайдер отверг CSRF-токен"""
+
+def extract_csrf_token(html):
+    for pattern in CSRF_PATTERNS:
+        match = pattern.search(html)
+        if match:
+            return match.group(1)
+    return None
+
+def payment_id_from_redirect(url):
+    return url.rstrip('/').split('/')[-1]
+
+class SteamTraderClient:
+    def __init__(self, cookies, base_url=None, timeout=None):
+        missing = [name for name in REQUIRED_COOKIES if name not in cookies]
+        if missing:
+            raise ValueError(f"В STEAM_TRADER_COOKIES нет обязательных куки: {', '.join(missing)}")
+        self.base_url = (base_url or PAYMENT_CLIENT_CONFIG['base_url']).rstrip('/')
+        self.timeout = timeout or PAYMENT_CLIENT_CONFIG['timeout']
+        self.cookies = httpx.Cookies()
+        for name, value in cookies.items():
+            self.cookies.set(name, value)
+        self.csrf_token = cookies['csrf_token']
+        self.client = None
+        self.csrf_lock = None
+        self.csrf_refreshes = 0
+
+    def get_client(self):
+        # AsyncClient привязывается к циклу событий, поэтому создается при первом запросе
+        if self.client is None:
+            self.client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers=DEFAULT_HEADERS,
+                cookies=self.cookies,
+                timeout=self.timeout,
+                limits=httpx.Limits(
+                    max_connections=PAYMENT_CLIENT_CONFIG['max_connections'],
+                    max_keepalive_connections=PAYMENT_CLIENT_CONFIG['max_keepalive_connections'],
+                    keepalive_expiry=PAYMENT_CLIENT_CONFIG['keepalive_expiry']
+                )
+            )
+            self.csrf_lock = asyncio.Lock()
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+
+    async def refresh_csrf_token(self, rejected_token):
+        """Берет свежий токен со страницы пополнения (один запрос на все ждущие корутины)"""
+        async with self.csrf_lock:
+            if self.csrf_token != rejected_token:
+                return self.csrf_token
+            started = time.perf_counter()
+            outcome = 'error'
+            try:
+                response = await self.get_client().get('/deposit/', headers={'accept': 'text/html'})
+                token = response.cookies.get('csrf_token') or self.client.cookies.get('csrf_token')
+                if not token or token == rejected_token:
+                    token = extract_csrf_token(response.text) or token
+                if not token or token == rejected_token:
+                    # Повтор с тем же токеном будет отвергнут снова
+                    raise PaymentProviderError("Не удалось получить новый CSRF-токен со страницы пополнения")
+                self.csrf_token = token
+                self.csrf_refreshes += 1
+                outcome = 'ok'
+                print(f"🔑 CSRF-токен обновлен: {token[:20]}...")
+                return token
+            finally:
+                PAYMENT_PROVIDER_SECONDS.observe(time.perf_counter() - started, 'refresh_csrf', outcome)
+
+    async def post_payment(self, amount, csrf_token):
+        response = await self.get_client().post(
+            '/deposit/pay/',
+            headers={
+                'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                'origin': self.base_url,
+                'referer': f'{self.base_url}/deposit/'
+            },
+            data={
+                'payment_type': PAYMENT_CLIENT_CONFIG['payment_type'],
+                'amount': str(amount),
+                'fee': '1',
+                'csrf_token': csrf_token
+            }
+        )
+        if response.status_code in (403, 419):
+            raise CsrfRejected(f"HTTP {response.status_code}")
+        if response.status_code != 200:
+            raise PaymentProviderError(f"HTTP {response.status_code}: {response.text[:200]}")
+        try:
+            data = response.json()
+        except ValueError:
+            raise PaymentProviderError(f"Ответ не JSON: {response.text[:200]}")
+        if not data.get('success'):
+            error = str(data.get('error', 'Неизвестная ошибка'))
+            if 'csrf' in error.lower() or 'token' in error.lower():
+                raise CsrfRejected(error)
+            raise PaymentProviderError(error)
+        if not data.get('redirect'):
+            raise PaymentProviderError("В ответе нет redirect ссылки")
+        return data['redirect']
+
+    async def create_payment(self, amount):
+        """Создает платеж и возвращает (payment_id, ссылка на оплату) или (None, None)"""
+        print(f"💰 Создаем платеж на сумму: {amount} руб.")
+        started = time.perf_counter()
+        outcome = 'error'
+        try:
+            csrf_token = self.csrf_token
+            try:
+                redirect = await self.post_payment(amount, csrf_token)
+            except CsrfRejected as e:
+                print(f"⚠️ CSRF-токен отвергнут ({e}), обновляем и повторяем")
+                redirect = await self.post_payment(amount, await self.refresh_csrf_token(csrf_token))
+            payment_id = payment_id_from_redirect(redirect)
+            outcome = 'ok'
+            print(f"✅ Платеж создан! ID: {payment_id}")
+            return payment_id, PAYMENT_CLIENT_CONFIG['receipt_url'].format(payment_id=payment_id)
+        except (PaymentProviderError, httpx.HTTPError) as e:
+            print(f"❌ Ошибка при создании платежа: {e}")
+            return None, None
+        finally:
+            PAYMENT_PROVIDER_SECONDS.observe(time.perf_counter() - started, 'create_payment', outcome)
@@ -0,0 +1,128 @@
+"""
+QR-код оплаты: поиск ссылки на странице платежа и собственная картинка.
+
+Ссылка для QR ищется в данных, которые страница и так получает, - в
+JSON-ответах API платежной страницы и в DOM (href, src, data-атрибуты,
+картинка data:URI или ссылка на генератор QR с параметром data). Только
+если ничего не нашлось, распознается картинка QR-элемента через pyzbar.
+Найденная ссылка рисуется в PNG локально (библиотека qrcode), картинки
+кэшируются по payment_id.
+"""
+import re
+import json
+import base64
+import threading
+from io import BytesIO
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs, unquote
+
+import qrcode
+
+try:
+    from pyzbar import pyzbar
+    from PIL import Image
+except ImportError:
+    # Без zbar последний шаг (распознавание картинки) просто пропускается
+    pyzbar = None
+
+QR_CONFIG = {
+    'cache_size': 500,
+    'box_size': 10,
+    'border': 2
+}
+
+# Ссылки, которые кодируются в QR платежной страницы (СБП и т.п.)
+QR_LINK_PATTERN = re.compile(r'https?://qr\.nspk\.ru/[^\s"\'<>\\]+')
+
+# Ключи JSON-ответов, в которых платежные страницы отдают содержимое QR
+QR_JSON_KEYS = ('qr', 'qr_link', 'qrLink', 'qr_url', 'qrUrl', 'qr_payload', 'qrPayload', 'payload', 'deeplink')
+
+# Параметры генераторов QR-картинок вида ...?data=<ссылка>
+QR_DATA_PARAMS = ('data', 'text', 'chl', 'url')
+
+def find_qr_link_in_text(text):
+    match = QR_LINK_PATTERN.search(text or '')
+    return unquote(match.group(0)) if match else None
+
+def find_qr_link_in_json(data):
+    """Ищет ссылку для QR в ответе API: сначала по известным ключам, затем в любом значении"""
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            for key in QR_JSON_KEYS:
+                candidate = value.get(key)
+                if isinstance(candidate, str) and candidate.startswith(('http://', 'https://')):
+                    return candidate
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+        elif isinstance(value, str):
+            link = find_qr_link_in_text(value)
+            if link:
+                return link
+    return None
+
+def link_from_image_src(src):
+    """Ссылка из src картинки QR: параметр data у генератора или распознавание data:URI"""
+    if not src:
+        return None
+    if src.startswith('data:image/'):
+        try:
+            return decode_qr_image(base64.b64decode(src.split(',', 1)[1]))
+        except (ValueError, IndexError):
+            return None
+    query = parse_qs(urlparse(src).query)
+    for param in QR_DATA_PARAMS:
+        if query.get(param):
+            return query[param][0]
+    return None
+
+def decode_qr_image(image_data):
+    """Последний шаг: распознает QR на картинке через pyzbar"""
+    if pyzbar is None or not image_data:
+        return None
+    try:
+        decoded_objects = pyzbar.decode(Image.open(BytesIO(image_data)))
+    except Exception as e:
+        print(f"❌ Ошибка при декодировании QR-кода: {str(e)}")
+        return None
+    return decoded_objects[0].data.decode('utf-8') if decoded_objects else None
+
+def link_from_response_body(body, content_type):
+    if 'json' in (content_type or ''):
+        try:
+            return find_qr_link_in_json(json.loads(body))
+        except ValueError:
+            pass
+    return find_qr_link_in_text(body)
+
+def render_qr_png(link):
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_M,
+        box_size=QR_CONFIG['box_size'],
+        border=QR_CONFIG['border']
+    )
+    qr.add_data(link)
+    qr.make(fit=True)
+    buffer = BytesIO()
+    qr.make_image(fill_color='black', back_color='white').save(buffer, format='PNG')
+    return buffer.getvalue()
+
+qr_images = OrderedDict()
+qr_images_lock = threading.Lock()
+
+def get_qr_png(payment_id, link):
+    """PNG с QR-кодом платежа; рисуется один раз на payment_id"""
+    with qr_images_lock:
+        cached = qr_images.get(payment_id)
+        if cached and cached[0] == link:
+            qr_images.move_to_end(payment_id)
+            return cached[1]
+
+    png = render_qr_png(link)
+    with qr_images_lock:
+        qr_images[payment_id] = (link, png)
+        while len(qr_images) > QR_CONFIG['cache_size']:
+            qr_images.popitem(last=False)
+    return png
@@ -1,183 +1,131 @@
 import time
-import requests
-import pyzbar.pyzbar as pyzbar
+import asyncio
 import re
 from playwright.sync_api import sync_playwright
-from io import BytesIO
-from PIL import Image
 from config import STEAM_TRADER_COOKIES
+from payment_client import SteamTraderClient
+from payment_qr import find_qr_link_in_text, link_from_image_src, link_from_response_body, decode_qr_image
 
-def get_valid_session():
-    """Используем готовые рабочие куки"""
-    try:
-        print("🔄 Используем готовые куки из конфига...")
-        
-        required_cookies = ['sid', 'csrf_token']
-        for req_cookie in required_cookies:
-            if req_cookie not in STEAM_TRADER_COOKIES:
-                print(f"❌ Отсутствует важное куки в конфиге: {req_cookie}")
-                return None, None
-        
-        cookies = STEAM_TRADER_COOKIES
-        csrf_token = STEAM_TRADER_COOKIES['csrf_token']
-        
-        print(f"✅ Используем куки: {len(cookies)} шт.")
-        print(f"✅ CSRF токен: {csrf_token[:20]}...")
-        
-        return cookies, csrf_token
-        
-    except Exception as e:
-        print(f"❌ Ошибка при загрузке куки из конфига: {str(e)}")
-        return None, None
+payment_client = None
+
+def get_payment_client():
+    """Общий клиент steam-trader на весь процесс (куки проверяются один раз)"""
+    global payment_client
+    if payment_client is None:
+        try:
+            payment_client = SteamTraderClient(STEAM_TRADER_COOKIES)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return None
+        print(f"✅ Клиент платежей создан, куки: {len(STEAM_TRADER_COOKIES)} шт.")
+    return payment_client
 
-def create_payment(amount):
+async def close_payment_client(application=None):
+    """Закрывает пул соединений клиента при остановке бота"""
+    if payment_client is not None:
+        await payment_client.close()
+
+async def create_payment(amount):
     """Создает платеж и возвращает payment_id и ссылку на оплату"""
-    try:
-        print(f"💰 Создаем платеж на сумму: {amount} руб.")
-        
-        cookies, csrf_token = get_valid_session()
-        
-        if not cookies or not csrf_token:
-            print("❌ Не удалось получить валидную сессию")
-            return None, None
-        
-        headers = {
-            'accept': 'application/json, text/javascript, */*; q=0.01',
-            'accept-language': 'ru-RU,ru;q=0.9,en-US;q=0.8,en;q=0.7',
-            'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-            'origin': 'https://steam-trader.com',
-            'referer': 'https://steam-trader.com/deposit/',
-            'sec-ch-ua': '"Chromium";v="136", "Google Chrome";v="136", "Not:A-Brand";v="99"',
-            'sec-ch-ua-mobile': '?0',
-            'sec-ch-ua-platform': '"Windows"',
-            'sec-fetch-dest': 'empty',
-            'sec-fetch-mode': 'cors',
-            'sec-fetch-site': 'same-origin',
-            'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/136.0.0.0 Safari/537.36',
-            'x-requested-with': 'XMLHttpRequest'
-        }
-        
-        data = {
-            'payment_type': '28',
-            'amount': str(amount),
-            'fee': '1', 
-            'csrf_token': csrf_token,
-        }
-        
-        print(f"📤 Отправляем запрос на создание платежа...")
-        print(f"🔑 Используем CSRF: {csrf_token[:20]}...")
-        print(f"🍪 Используем куки: {len(cookies)} шт.")
-        
-        session = requests.Session()
-        
-        for name, value in cookies.items():
-            session.cookies.set(name, value)
-        
-        response = session.post(
-            'https://steam-trader.com/deposit/pay/',
-            headers=headers,
-            data=data,
-            timeout=30
-        )
-        
-        print(f"📥 Статус ответа: {response.status_code}")
-        
-        if response.status_code == 200:
-            try:
-                response_data = response.json()
-                print(f"✅ Ответ JSON: {response_data}")
-                
-                if response_data.get('success'):
-                    payment_url = response_data.get('redirect')
-                    if payment_url:
-                        payment_id = payment_url.split('/')[-2] if payment_url.endswith('/') else payment_url.split('/')[-1]
-                        payment_link = f'https://payment.tome.ge/{payment_id}/receipt'
-                        print(f"✅ Платеж создан! ID: {payment_id}")
-                        return payment_id, payment_link
-                    else:
-                        print("❌ В ответе нет redirect ссылки")
-                else:
-                    error_msg = response_data.get('error', 'Неизвестная ошибка')
-                    print(f"❌ Ошибка при создании платежа: {error_msg}")
-            except Exception as e:
-                print(f"❌ Ошибка парсинга JSON: {str(e)}")
-                print(f"📄 Текст ответа: {response.text}")
-        else:
-            print(f"❌ HTTP ошибка: {response.status_code}")
-            print(f"📄 Текст ответа: {response.text}")
-                
-        return None, None
-        
-    except Exception as e:
-        print(f"❌ Исключение при создании платежа: {str(e)}")
+    client = get_payment_client()
+    if client is None:
         return None, None
+    return await client.create_payment(amount)
 
-def decode_qr_code(image_data):
-    """Декодирует QR-код из изображения и возвращает ссылку."""
-    try:
-        image = Image.open(BytesIO(image_data))
-        decoded_objects = pyzbar.decode(image)
-        if decoded_objects:
-            return decoded_objects[0].data.decode('utf-8')
-        else:
-            print("❌ QR-код не найден в изображении.")
-            return None
-    except Exception as e:
-        print(f"❌ Ошибка при декодировании QR-кода: {str(e)}")
-        return None
+QR_PAGE_CONFIG = {
+    # Сколько ждать появления ссылки на странице платежа
+    'timeout': 15,
+    'poll_interval': 0.25
+}
+
+# Элементы страницы, в которых может быть QR-код
+QR_ELEMENT_SELECTORS = ['img[src*="qr" i]', 'img[alt*="qr" i]', '[class*="qr" i] img', '[class*="qr" i] canvas', 'canvas']
+
+def find_qr_link_on_page(page):
+    """Ищет ссылку для QR в DOM: ссылки, атрибуты, src картинок"""
+    link = find_qr_link_in_text(page.content())
+    if link:
+        return link
+    for src in page.eval_on_selector_all('img', 'images => images.map(image => image.src)'):
+        link = link_from_image_src(src)
+        if link:
+            return link
+    return None
+
+def scan_qr_element(page):
+    """Последний шаг: снимок найденного QR-элемента и распознавание pyzbar"""
+    for selector in QR_ELEMENT_SELECTORS:
+        element = page.query_selector(selector)
+        if element is None:
+            continue
+        try:
+            link = decode_qr_image(element.screenshot())
+        except Exception as e:
+            print(f"⚠️ Ошибка при снимке QR-элемента {selector}: {str(e)}")
+            continue
+        if link:
+            return link
+    return None
 
 def get_qr_code_from_payment(payment_link):
-    """Получает QR-код со страницы платежа"""
+    """
+    Получает ссылку из QR-кода страницы платежа: из ответов API страницы
+    или DOM, как только она там появится; pyzbar - только если не нашлась.
+    """
     with sync_playwright() as p:
         browser = p.chromium.launch(headless=True)
         page = browser.new_page()
-        
+        responses = []
+
+        # Тела ответов читаются в цикле ниже, а не в обработчике события
+        page.on('response', lambda response: responses.append(response)
+                if response.request.resource_type in ('xhr', 'fetch', 'document') else None)
+
+        def link_from_responses():
+            while responses:
+                response = responses.pop(0)
+                try:
+                    link = link_from_response_body(response.text(), response.headers.get('content-type'))
+                except Exception:
+                    continue
+                if link:
+                    return link
+            return None
+
         try:
             print(f"🌐 Открываем страницу платежа: {payment_link}")
-            page.goto(payment_link, wait_until="networkidle")
-            time.sleep(3)
-            
-            qr_areas = [
-                {'x': 500, 'y': 100, 'width': 300, 'height': 300},
-                {'x': 450, 'y': 80, 'width': 350, 'height': 350},
-                {'x': 400, 'y': 50, 'width': 400, 'height': 400},
-                {'x': 300, 'y': 0, 'width': 500, 'height': 500},
-            ]
-            
+            page.goto(payment_link, wait_until="domcontentloaded")
+
             qr_data = None
-            for clip in qr_areas:
-                try:
-                    print(f"📸 Делаем скриншот области: {clip}")
-                    screenshot = page.screenshot(clip=clip)
-                    qr_data = decode_qr_code(screenshot)
-                    if qr_data:
-                        print(f"✅ QR-код найден!")
-                        break
-                except Exception as e:
-                    print(f"⚠️ Ошибка при скриншоте: {str(e)}")
-                    continue
-            
+            deadline = time.monotonic() + QR_PAGE_CONFIG['timeout']
+            while time.monotonic() < deadline:
+                qr_data = link_from_responses() or find_qr_link_on_page(page)
+                if qr_data:
+                    break
+                page.wait_for_timeout(QR_PAGE_CONFIG['poll_interval'] * 1000)
+
+            qr_data = qr_data or scan_qr_element(page)
             if qr_data:
                 print(f"🔗 Ссылка из QR-кода: {qr_data}")
                 return qr_data
-            else:
-                print("❌ Не удалось найти QR-код, возвращаем ссылку на оплату")
-                return payment_link
-                
+            print("❌ Не удалось найти QR-код, возвращаем ссылку на оплату")
+            return payment_link
+
         except Exception as e:
             print(f"❌ Ошибка при получении QR-кода: {str(e)}")
             return payment_link
         finally:
             browser.close()
 
-def get_payment_qr_code(amount):
+async def get_payment_qr_code(amount):
     """Основная функция для получения QR-кода оплаты"""
-    payment_id, payment_link = create_payment(amount)
+    payment_id, payment_link = await create_payment(amount)
     
     if not payment_link:
         return None, None, None
     
-    qr_link = get_qr_code_from_payment(payment_link)
+    # Playwright синхронный - страница оплаты разбирается в пуле потоков
+    qr_link = await asyncio.get_running_loop().run_in_executor(None, get_qr_code_from_payment, payment_link)
     
     return payment_id, payment_link, qr_link
 
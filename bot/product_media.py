@@ -0,0 +1,102 @@
+"""
+Отправка фото и GIF товаров через кэш Telegram file_id.
+
+В photo_gif_id админы обычно вставляют внешнюю ссылку, и Telegram заново
+скачивает файл у поставщика при каждом просмотре товара. После первой
+удачной отправки (или прогрева из админ-панели) file_id из ответа Telegram
+сохраняется в Product.photo_file_id, и дальше отправляется он - без
+обращения к сайту поставщика. file_id привязан к токену бота; если
+Telegram его не принимает, он сбрасывается и файл снова отправляется по
+ссылке.
+"""
+import time
+from sqlalchemy import update
+from telegram.error import BadRequest
+
+try:
+    from database import Product
+    from metrics import histogram
+except ImportError:
+    from bot.database import Product
+    from bot.metrics import histogram
+
+MEDIA_SEND_SECONDS = histogram(
+    'shop_media_send_seconds', 'Отправка фото и GIF товаров', ['kind', 'source', 'outcome'],
+    buckets=(0.1, 0.25, 0.5, 1.0, 2.0, 3.0, 5.0, 10.0, 20.0, 60.0)
+)
+
+# file_id локальных картинок бота (аватар главного меню), путь -> file_id
+local_file_ids = {}
+
+def media_kind(source):
+    """'animation' для GIF, иначе 'photo'"""
+    return 'animation' if source and source.lower().split('?')[0].endswith('.gif') else 'photo'
+
+def extract_file_id(message, kind):
+    """file_id отправленного файла из ответа Telegram (для фото - самый большой размер)"""
+    if kind == 'animation':
+        media = message.animation or message.document
+        return media.file_id if media else None
+    return message.photo[-1].file_id if message.photo else None
+
+def save_file_id(engine, product_id, source, file_id):
+    """
+    Запоминает file_id товара, если ссылка на файл с тех пор не поменялась
+    (иначе админ успел заменить картинку и file_id относится к старой).
+    """
+    with engine.begin() as connection:
+        connection.execute(
+            update(Product)
+            .where(Product.id == product_id, Product.photo_gif_id == source)
+            .values(photo_file_id=file_id)
+        )
+
+async def send_media(message, kind, media, caption, reply_markup, source_label):
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        if kind == 'animation':
+            sent = await message.reply_animation(animation=media, caption=caption, reply_markup=reply_markup)
+        else:
+            sent = await message.reply_photo(photo=media, caption=caption, reply_markup=reply_markup)
+        outcome = 'ok'
+        return sent
+    finally:
+        MEDIA_SEND_SECONDS.observe(time.perf_counter() - started, kind, source_label, outcome)
+
+async def send_product_media(engine, message, product, caption, reply_markup):
+    """
+    Отправляет картинку товара с подписью: по сохраненному file_id, а если
+    его нет или Telegram его отверг - по ссылке, запоминая новый file_id.
+    """
+    source = product.photo_gif_id
+    kind = media_kind(source)
+
+    if product.photo_file_id:
+        try:
+            return await send_media(message, kind, product.photo_file_id, caption, reply_markup, 'file_id')
+        except BadRequest:
+            # file_id от другого бота или устарел - забываем и шлем по ссылке
+            save_file_id(engine, product.id, source, None)
+
+    sent = await send_media(message, kind, source, caption, reply_markup, 'url')
+    file_id = extract_file_id(sent, kind)
+    if file_id:
+        save_file_id(engine, product.id, source, file_id)
+    return sent
+
+async def send_local_photo(message, path, caption, reply_markup):
+    """Отправляет локальную картинку: файл загружается один раз, дальше - по file_id"""
+    file_id = local_file_ids.get(path)
+    if file_id:
+        try:
+            return await send_media(message, 'photo', file_id, caption, reply_markup, 'file_id')
+        except BadRequest:
+            local_file_ids.pop(path, None)
+
+    with open(path, 'rb') as photo:
+        sent = await send_media(message, 'photo', photo, caption, reply_markup, 'upload')
+    file_id = extract_file_id(sent, 'photo')
+    if file_id:
+        local_file_ids[path] = file_id
+    return sent
@@ -0,0 +1,99 @@
+"""
+Общие настройки фоновых задач на APScheduler.
+
+Все периодические задачи регистрируются через add_interval_job или
+add_bot_job с едиными правилами: пропущенные запуски склеиваются в один (coalesce), запуск,
+опоздавший больше чем на misfire_grace_time, пропускается, одновременно
+выполняется не больше max_instances копий задачи, а jitter разводит
+по времени одинаковые задачи разных реплик.
+
+Бот использует планировщик своего JobQueue (AsyncIOScheduler внутри
+python-telegram-bot), воркер - BackgroundScheduler, который создает
+только ведущий. Задачи хранятся в памяти процесса: общее хранилище
+задач APScheduler не поддерживает для нескольких работающих
+планировщиков, а то, что должно пережить перезапуск, хранится в своих
+таблицах (расписание сверки - в payments, время последней проверки
+наличия - в аренде воркера). instrument_scheduler вешает на планировщик
+метрики времени выполнения и исходов по каждой задаче.
+"""
+import time
+import threading
+from apscheduler.events import (
+    EVENT_JOB_SUBMITTED, EVENT_JOB_EXECUTED, EVENT_JOB_ERROR, EVENT_JOB_MISSED, EVENT_JOB_MAX_INSTANCES
+)
+
+try:
+    from metrics import counter, histogram
+except ImportError:
+    from bot.metrics import counter, histogram
+
+SCHEDULER_CONFIG = {
+    'misfire_grace_time': 60,
+    'coalesce': True,
+    'max_instances': 1
+}
+
+JOB_RUNS = counter('shop_job_runs_total', 'Запуски фоновых задач по исходу', ['job', 'outcome'])
+JOB_SECONDS = histogram('shop_job_seconds', 'Время выполнения фоновых задач', ['job'],
+                        buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0))
+
+def job_options(**overrides):
+    """Параметры add_job по умолчанию с переопределениями для конкретной задачи"""
+    options = {
+        'misfire_grace_time': SCHEDULER_CONFIG['misfire_grace_time'],
+        'coalesce': SCHEDULER_CONFIG['coalesce'],
+        'max_instances': SCHEDULER_CONFIG['max_instances']
+    }
+    options.update(overrides)
+    return options
+
+def add_interval_job(scheduler, func, job_id, seconds, jitter=None, first_run=None, **overrides):
+    """Периодическая задача; first_run - время первого запуска (по умолчанию через seconds)"""
+    options = job_options(**overrides)
+    if first_run is not None:
+        options['next_run_time'] = first_run
+    return scheduler.add_job(
+        func, 'interval', seconds=seconds, jitter=jitter,
+        id=job_id, name=job_id, replace_existing=True, **options
+    )
+
+def add_bot_job(job_queue, callback, name, seconds, first=None, jitter=None, **overrides):
+    """Периодическая задача бота на планировщике JobQueue (callback получает context)"""
+    return job_queue.run_repeating(
+        callback, interval=seconds, first=first if first is not None else seconds, name=name,
+        job_kwargs=job_options(id=name, jitter=jitter, **overrides)
+    )
+
+def instrument_scheduler(scheduler):
+    """Метрики задач: время от запуска до завершения и исход (ok, error, missed, max_instances)"""
+    started = {}
+    lock = threading.Lock()
+
+    def job_name(job_id):
+        job = scheduler.get_job(job_id)
+        return job.name if job is not None else job_id
+
+    def on_submitted(event):
+        name = job_name(event.job_id)
+        now = time.perf_counter()
+        with lock:
+            for run_time in event.scheduled_run_times:
+                started[(event.job_id, run_time)] = (name, now)
+
+    def on_finished(event):
+        with lock:
+            name, began = started.pop((event.job_id, event.scheduled_run_time), (None, None))
+        name = name or job_name(event.job_id)
+        if began is not None:
+            JOB_SECONDS.observe(time.perf_counter() - began, name)
+        JOB_RUNS.inc(name, 'error' if event.code == EVENT_JOB_ERROR else 'ok')
+        if event.code == EVENT_JOB_ERROR:
+            print(f"Ошибка в фоновой задаче {name}: {event.exception}")
+
+    def on_skipped(event):
+        JOB_RUNS.inc(job_name(event.job_id), 'missed' if event.code == EVENT_JOB_MISSED else 'max_instances')
+
+    scheduler.add_listener(on_submitted, EVENT_JOB_SUBMITTED)
+    scheduler.add_listener(on_finished, EVENT_JOB_EXECUTED | EVENT_JOB_ERROR)
+    scheduler.add_listener(on_skipped, EVENT_JOB_MISSED | EVENT_JOB_MAX_INSTANCES)
+    return scheduler
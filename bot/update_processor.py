@@ -0,0 +1,120 @@
+"""
+Параллельная обработка обновлений с сохранением порядка для каждого пользователя.
+
+Обновления разных пользователей обрабатываются одновременно, но не более
+чем max_workers штук, поэтому долгий обработчик (создание платежа через
+Playwright) не задерживает остальных. Обновления одного пользователя
+выполняются строго по очереди в порядке поступления - корзина и оформление
+заказа не видят гонок между соседними нажатиями кнопок.
+
+Application создает задачу на каждое обновление в порядке получения, и
+do_process_update до первого await ставит обновление в цепочку своего
+пользователя, поэтому порядок внутри цепочки совпадает с порядком прихода.
+"""
+import asyncio
+from collections import defaultdict
+from telegram.ext import BaseUpdateProcessor
+from metrics import HANDLER_SECONDS, call_site
+
+UPDATE_PROCESSOR_CONFIG = {
+    # Сколько обновлений может ждать своей очереди и выполняться одновременно
+    'max_pending': 1024
+}
+
+# Callback-данные с идентификатором в конце: метрика пишется по префиксу
+CALLBACK_PREFIXES = [
+    'check_payment_', 'category_', 'product_', 'search_page_', 'page_',
+    'add_cart_', 'buy_now_', 'remove_cart_'
+]
+
+# Команды пишутся по имени, остальной текст пользователя - общей меткой
+KNOWN_COMMANDS = {'/start', '/menu', '/shop', '/profile', '/orders', '/cart', '/cancel'}
+
+def update_label(update):
+    """Имя обработчика для метрик: префикс callback-данных, команда или тип сообщения"""
+    query = getattr(update, 'callback_query', None)
+    if query and query.data:
+        for prefix in CALLBACK_PREFIXES:
+            if query.data.startswith(prefix):
+                return prefix.rstrip('_')
+        return query.data if query.data.replace('_', '').isalpha() and len(query.data) <= 32 else 'other'
+
+    message = getattr(update, 'message', None)
+    if message and message.text:
+        command = message.text.split()[0].split('@')[0] if message.text.startswith('/') else None
+        if command in KNOWN_COMMANDS:
+            return command
+        return 'text'
+    return 'other'
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Ограниченная параллельность между пользователями, строгий порядок внутри пользователя"""
+
+    def __init__(self, max_workers, max_pending=None):
+        super().__init__(max_pending or UPDATE_PROCESSOR_CONFIG['max_pending'])
+        self.max_workers = max_workers
+        self.workers = None
+        self.tails = {}
+        self.queue_depths = defaultdict(int)
+        self.in_flight = 0
+        self.processed = 0
+
+    async def initialize(self):
+        self.workers = asyncio.Semaphore(self.max_workers)
+
+    async def shutdown(self):
+        pass
+
+    def ordering_key(self, update):
+        user = getattr(update, 'effective_user', None)
+        if user:
+            return ('user', user.id)
+        chat = getattr(update, 'effective_chat', None)
+        if chat:
+            return ('chat', chat.id)
+        return None
+
+    async def do_process_update(self, update, coroutine):
+        key = self.ordering_key(update)
+        label = update_label(update)
+        if key is None:
+            await self.run(coroutine, label)
+            return
+
+        previous = self.tails.get(key)
+        done = asyncio.get_running_loop().create_future()
+        self.tails[key] = done
+        self.queue_depths[key] += 1
+
+        try:
+            if previous is not None:
+                await asyncio.shield(previous)
+            await self.run(coroutine, label)
+        finally:
+            done.set_result(None)
+            self.queue_depths[key] -= 1
+            if self.queue_depths[key] == 0:
+                del self.queue_depths[key]
+            if self.tails.get(key) is done:
+                del self.tails[key]
+
+    async def run(self, coroutine, label):
+        async with self.workers:
+            self.in_flight += 1
+            try:
+                with call_site(f'bot:{label}'), HANDLER_SECONDS.time(label):
+                    await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+    def get_metrics(self):
+        depths = list(self.queue_depths.values())
+        return {
+            'in_flight': self.in_flight,
+            'max_workers': self.max_workers,
+            'pending': self.current_concurrent_updates,
+            'queued_users': len(depths),
+            'max_user_queue_depth': max(depths) if depths else 0,
+            'processed': self.processed
+        }
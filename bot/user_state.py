@@ -0,0 +1,165 @@
+"""
+Состояние диалога пользователей бота (текущий поиск, категория, страница).
+
+В состоянии хранятся только компактные значения - строки, числа и кортежи
+id товаров, без ORM-объектов, поэтому цены и наличие всегда читаются из БД
+заново. Записи живут в памяти процесса с вытеснением по LRU и TTL. При
+STATE_BACKEND = 'database' состояние хранится только в таблице user_states
+и читается из нее при каждом обращении: оно переживает перезапуск, а запись
+одной реплики бота сразу видна остальным. Из async-обработчиков состояние
+читается и пишется через aget/aset - запросы к БД уходят в поток.
+"""
+import json
+import time
+import asyncio
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, insert, delete
+from sqlalchemy.exc import IntegrityError
+
+try:
+    from database import UserState
+except ImportError:
+    from bot.database import UserState
+
+STATE_CONFIG = {
+    'max_entries': 50000,
+    'ttl': 6 * 3600
+}
+
+class DatabaseStateBackend:
+    """Хранение состояния в таблице user_states (JSON)"""
+
+    def __init__(self, engine):
+        self.engine = engine
+
+    def load(self, user_id):
+        with self.engine.connect() as connection:
+            row = connection.execute(
+                select(UserState.data, UserState.expires_at).where(UserState.user_id == user_id)
+            ).first()
+        if row is None or row.expires_at < datetime.utcnow():
+            return None
+        return json.loads(row.data)
+
+    def save(self, user_id, state, ttl):
+        data = json.dumps(state, ensure_ascii=False)
+        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
+        with self.engine.begin() as connection:
+            result = connection.execute(
+                update(UserState).where(UserState.user_id == user_id).values(data=data, expires_at=expires_at)
+            )
+            if result.rowcount:
+                return
+        try:
+            with self.engine.begin() as connection:
+                connection.execute(insert(UserState).values(user_id=user_id, data=data, expires_at=expires_at))
+        except IntegrityError:
+            # Другая реплика успела вставить строку - перезаписываем
+            with self.engine.begin() as connection:
+                connection.execute(
+                    update(UserState).where(UserState.user_id == user_id).values(data=data, expires_at=expires_at)
+                )
+
+    def delete(self, user_id):
+        with self.engine.begin() as connection:
+            connection.execute(delete(UserState).where(UserState.user_id == user_id))
+
+    def purge_expired(self):
+        with self.engine.begin() as connection:
+            result = connection.execute(delete(UserState).where(UserState.expires_at < datetime.utcnow()))
+        return result.rowcount
+
+class UserStateStore:
+    """LRU-кэш состояний с TTL или, если задан backend, чтение и запись сразу в него"""
+
+    def __init__(self, max_entries=None, ttl=None, backend=None):
+        self.max_entries = max_entries or STATE_CONFIG['max_entries']
+        self.ttl = ttl or STATE_CONFIG['ttl']
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id):
+        """Возвращает копию состояния пользователя или пустой словарь"""
+        if self.backend is not None:
+            # Без кэша в памяти: другая реплика могла изменить состояние
+            state = self.backend.load(user_id)
+            with self.lock:
+                if state is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return state or {}
+
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                expires_at, state = entry
+                if expires_at > now:
+                    self.entries.move_to_end(user_id)
+                    self.hits += 1
+                    return dict(state)
+                del self.entries[user_id]
+            self.misses += 1
+        return {}
+
+    def set(self, user_id, **state):
+        """Заменяет состояние пользователя. Значения должны сериализоваться в JSON."""
+        if self.backend is not None:
+            self.backend.save(user_id, state, self.ttl)
+        else:
+            self.remember(user_id, state)
+
+    def delete(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+        if self.backend is not None:
+            self.backend.delete(user_id)
+
+    async def aget(self, user_id):
+        """get для async-обработчиков: запрос к backend выполняется в потоке"""
+        if self.backend is None:
+            return self.get(user_id)
+        return await asyncio.to_thread(self.get, user_id)
+
+    async def aset(self, user_id, **state):
+        """set для async-обработчиков: запись в backend выполняется в потоке"""
+        if self.backend is None:
+            self.set(user_id, **state)
+            return
+        await asyncio.to_thread(lambda: self.set(user_id, **state))
+
+    def remember(self, user_id, state):
+        with self.lock:
+            self.entries[user_id] = (time.monotonic() + self.ttl, state)
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def purge_expired(self):
+        """Удаляет просроченные записи из памяти и хранилища, возвращает число удаленных"""
+        now = time.monotonic()
+        with self.lock:
+            expired = [user_id for user_id, (expires_at, _) in self.entries.items() if expires_at <= now]
+            for user_id in expired:
+                del self.entries[user_id]
+        removed = len(expired)
+        if self.backend is not None:
+            removed += self.backend.purge_expired()
+        return removed
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
@@ -0,0 +1,127 @@
+"""
+Прием обновлений Telegram через webhook.
+
+Вместо long polling Telegram сам присылает обновления POST-запросом на
+WEBHOOK_URL + WEBHOOK_CONFIG['path']. Сервер на aiohttp проверяет заголовок
+X-Telegram-Bot-Api-Secret-Token, кладет обновление в очередь приложения и
+сразу отвечает 200 - обработка идет асинхронно в Application. Так несколько
+реплик бота можно поставить за балансировщик.
+
+При SIGTERM/SIGINT сервер перестает принимать новые обновления (отвечает
+503, Telegram повторит доставку позже), дожидается обработки уже принятых
+и только после этого останавливает приложение.
+"""
+import hmac
+import signal
+import asyncio
+import logging
+import secrets
+from aiohttp import web
+from telegram import Update
+from payment_callback import add_callback_route
+
+try:
+    from config import WEBHOOK_URL, WEBHOOK_SECRET
+except ImportError:
+    WEBHOOK_URL = None
+    WEBHOOK_SECRET = None
+
+try:
+    from config import WEBHOOK_HOST, WEBHOOK_PORT
+except ImportError:
+    WEBHOOK_HOST = '0.0.0.0'
+    WEBHOOK_PORT = 8443
+
+WEBHOOK_CONFIG = {
+    'path': '/telegram',
+    'max_connections': 40,
+    'max_body_size': 1024 * 1024
+}
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+async def handle_update(request):
+    """Принимает одно обновление от Telegram"""
+    if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), request.app['secret_token']):
+        return web.Response(status=403)
+
+    if request.app['draining']:
+        return web.Response(status=503)
+
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+
+    application = request.app['application']
+    update = Update.de_json(data, application.bot)
+    await application.update_queue.put(update)
+    return web.Response(status=200)
+
+async def handle_healthz(request):
+    if request.app['draining']:
+        return web.json_response({'status': 'draining'}, status=503)
+    application = request.app['application']
+    return web.json_response({
+        'status': 'ok',
+        'pending_updates': application.update_queue.qsize(),
+        'processing': application.update_processor.get_metrics()
+    })
+
+def create_web_app(application, secret_token, payment_handler=None):
+    web_app = web.Application(client_max_size=WEBHOOK_CONFIG['max_body_size'])
+    web_app['application'] = application
+    web_app['secret_token'] = secret_token
+    web_app['draining'] = False
+    web_app.router.add_post(WEBHOOK_CONFIG['path'], handle_update)
+    web_app.router.add_get('/healthz', handle_healthz)
+    if payment_handler is not None:
+        # Уведомления провайдера о платежах принимаются тем же сервером
+        add_callback_route(web_app, payment_handler)
+    return web_app
+
+async def serve_webhook(application, payment_handler=None):
+    if not WEBHOOK_URL:
+        raise RuntimeError("Для режима webhook укажите WEBHOOK_URL в config.py")
+
+    # Без общего WEBHOOK_SECRET каждая реплика перерегистрирует webhook со своим
+    # секретом, поэтому для нескольких реплик секрет обязательно задается в config.py
+    secret_token = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    web_app = create_web_app(application, secret_token, payment_handler)
+    runner = web.AppRunner(web_app)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    await application.initialize()
+    await application.bot.set_webhook(
+        url=WEBHOOK_URL.rstrip('/') + WEBHOOK_CONFIG['path'],
+        secret_token=secret_token,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=WEBHOOK_CONFIG['max_connections']
+    )
+    await application.start()
+
+    await runner.setup()
+    site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT)
+    await site.start()
+    logger.info(f"Webhook слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_CONFIG['path']}")
+
+    try:
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook: дожидаемся обработки принятых обновлений")
+        web_app['draining'] = True
+        await runner.cleanup()
+        # stop() дожидается разбора очереди и завершения запущенных обработчиков
+        await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+def run_webhook(application, payment_handler=None):
+    asyncio.run(serve_webhook(application, payment_handler))
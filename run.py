@@ -1,18 +1,287 @@
+"""
+Супервизор магазина: запускает бота, админ-панель и воркер проверки
+наличия товаров отдельными процессами и следит за ними.
+
+    python run.py           - запустить все сервисы
+    python run.py status    - показать состояние запущенного супервизора
+
+Упавший процесс перезапускается с экспоненциальной задержкой. Сервисы с
+health_url дополнительно проверяются HTTP-запросом; после нескольких
+неудачных проверок подряд процесс перезапускается. По SIGTERM/SIGINT
+супервизор передает SIGTERM всем процессам, ждет их завершения и добивает
+зависшие. Состояние пишется в RUN_STATUS_FILE для команды status.
+"""
+import os
+import sys
+import json
+import time
+import signal
 import subprocess
-import threading
+import importlib.util
+import urllib.request
+from datetime import datetime
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, ROOT_DIR)
+
+try:
+    from config import FLASK_HOST, FLASK_PORT
+except ImportError:
+    FLASK_HOST = '0.0.0.0'
+    FLASK_PORT = 5000
+
+try:
+    from config import ADMIN_WORKERS
+except ImportError:
+    ADMIN_WORKERS = 2
+
+try:
+    from config import BOT_MODE, WEBHOOK_PORT
+except ImportError:
+    BOT_MODE = 'polling'
+    WEBHOOK_PORT = 8443
+
+RUN_STATUS_FILE = os.path.join(ROOT_DIR, 'run_status.json')
+
+SUPERVISOR_CONFIG = {
+    'poll_interval': 1,
+    'health_interval': 15,
+    'health_timeout': 5,
+    'health_failures': 3,
+    'startup_grace': 5,
+    'backoff_base': 1,
+    'backoff_max': 60,
+    'stable_after': 120,
+    'shutdown_timeout': 30
+}
+
+def admin_command():
+    """gunicorn с несколькими воркерами, если он установлен (на Windows его нет)"""
+    if importlib.util.find_spec('gunicorn'):
+        return [
+            sys.executable, '-m', 'gunicorn',
+            '--workers', str(ADMIN_WORKERS),
+            '--bind', f'{FLASK_HOST}:{FLASK_PORT}',
+            '--graceful-timeout', str(SUPERVISOR_CONFIG['shutdown_timeout']),
+            'admin_panel.app:app'
+        ]
+    print("⚠️ gunicorn не установлен, админ-панель запускается сервером разработки")
+    return [sys.executable, os.path.join('admin_panel', 'app.py')]
+
+def build_services():
+    return [
+        ManagedProcess(
+            'bot',
+            [sys.executable, os.path.join('bot', 'main.py')],
+            health_url=f'http://127.0.0.1:{WEBHOOK_PORT}/healthz' if BOT_MODE == 'webhook' else None
+        ),
+        ManagedProcess(
+            'admin',
+            admin_command(),
+            health_url=f'http://127.0.0.1:{FLASK_PORT}/healthz'
+        ),
+        ManagedProcess(
+            'worker',
+            [sys.executable, 'worker.py']
+        )
+    ]
+
+class ManagedProcess:
+    """Один дочерний процесс и его история перезапусков"""
+
+    def __init__(self, name, command, health_url=None):
+        self.name = name
+        self.command = command
+        self.health_url = health_url
+        self.process = None
+        self.state = 'stopped'
+        self.started_at = None
+        self.restarts = 0
+        self.failures_in_row = 0
+        self.next_start_at = 0.0
+        self.next_health_at = 0.0
+        self.health_failures = 0
+        self.healthy = None
+        self.last_exit_code = None
+
+    def start(self):
+        env = dict(os.environ)
+        # config.py лежит в корне проекта, дочерним процессам он нужен на sys.path
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+        self.process = subprocess.Popen(
+            self.command,
+            cwd=ROOT_DIR,
+            env=env,
+            start_new_session=True
+        )
+        self.state = 'running'
+        self.started_at = time.monotonic()
+        self.next_health_at = self.started_at + SUPERVISOR_CONFIG['startup_grace']
+        self.health_failures = 0
+        self.healthy = None
+        print(f"▶️ {self.name} запущен (pid {self.process.pid})")
+
+    def check_exit(self):
+        """Возвращает True, если процесс завершился с прошлой проверки"""
+        if self.process is None or self.process.poll() is None:
+            return False
+        self.last_exit_code = self.process.returncode
+        self.process = None
+        return True
+
+    def schedule_restart(self, reason):
+        # Процесс, проработавший дольше stable_after, считается стабильным,
+        # и задержка перезапуска начинается заново
+        if self.started_at and time.monotonic() - self.started_at >= SUPERVISOR_CONFIG['stable_after']:
+            self.failures_in_row = 0
+        delay = min(SUPERVISOR_CONFIG['backoff_max'], SUPERVISOR_CONFIG['backoff_base'] * (2 ** self.failures_in_row))
+        self.failures_in_row += 1
+        self.restarts += 1
+        self.state = 'backoff'
+        self.next_start_at = time.monotonic() + delay
+        print(f"⚠️ {self.name}: {reason}, перезапуск через {delay} с")
+
+    def check_health(self):
+        if not self.health_url or self.process is None or time.monotonic() < self.next_health_at:
+            return True
+
+        self.next_health_at = time.monotonic() + SUPERVISOR_CONFIG['health_interval']
+        try:
+            with urllib.request.urlopen(self.health_url, timeout=SUPERVISOR_CONFIG['health_timeout']) as response:
+                self.healthy = response.status == 200
+        except Exception:
+            self.healthy = False
+
+        self.health_failures = 0 if self.healthy else self.health_failures + 1
+        return self.health_failures < SUPERVISOR_CONFIG['health_failures']
+
+    def terminate(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        if self.process is not None and self.process.poll() is None:
+            print(f"⛔ {self.name} не завершился вовремя, принудительная остановка")
+            self.process.kill()
+
+    def is_ready(self):
+        if self.state != 'running':
+            return False
+        return self.healthy is True if self.health_url else True
+
+    def to_status(self):
+        return {
+            'name': self.name,
+            'state': self.state,
+            'pid': self.process.pid if self.process else None,
+            'uptime': int(time.monotonic() - self.started_at) if self.process and self.started_at else 0,
+            'restarts': self.restarts,
+            'healthy': self.healthy,
+            'last_exit_code': self.last_exit_code
+        }
+
+class Supervisor:
+    def __init__(self, services):
+        self.services = services
+        self.stopping = False
+
+    def request_stop(self, signum, frame):
+        self.stopping = True
+
+    def write_status(self):
+        status = {
+            'pid': os.getpid(),
+            'updated_at': datetime.now().isoformat(),
+            'ready': all(service.is_ready() for service in self.services),
+            'services': [service.to_status() for service in self.services]
+        }
+        temp_path = RUN_STATUS_FILE + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, RUN_STATUS_FILE)
+
+    def tick(self):
+        now = time.monotonic()
+        for service in self.services:
+            if service.state == 'backoff' and now >= service.next_start_at:
+                service.start()
+            elif service.state == 'running':
+                if service.check_exit():
+                    service.schedule_restart(f"завершился с кодом {service.last_exit_code}")
+                elif not service.check_health():
+                    service.terminate()
+                    self.wait_for([service], SUPERVISOR_CONFIG['shutdown_timeout'])
+                    service.check_exit()
+                    service.schedule_restart("не отвечает на проверку живости")
+
+    def wait_for(self, services, timeout):
+        deadline = time.monotonic() + timeout
+        for service in services:
+            if service.process is None:
+                continue
+            try:
+                service.process.wait(timeout=max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                service.kill()
+                service.process.wait()
+
+    def shutdown(self):
+        print("🛑 Остановка сервисов...")
+        for service in self.services:
+            service.terminate()
+        self.wait_for(self.services, SUPERVISOR_CONFIG['shutdown_timeout'])
+        for service in self.services:
+            service.check_exit()
+            service.state = 'stopped'
+        self.write_status()
+        print("✅ Все сервисы остановлены")
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.request_stop)
+        signal.signal(signal.SIGINT, self.request_stop)
+
+        for service in self.services:
+            service.start()
+
+        try:
+            while not self.stopping:
+                self.tick()
+                self.write_status()
+                time.sleep(SUPERVISOR_CONFIG['poll_interval'])
+        finally:
+            self.shutdown()
+
+def is_process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+def show_status():
+    if not os.path.exists(RUN_STATUS_FILE):
+        print("❌ Супервизор не запускался")
+        return 1
+
+    with open(RUN_STATUS_FILE, encoding='utf-8') as f:
+        status = json.load(f)
 
-def run_bot():
-    # Функция для запуска Telegram-бота.
-    subprocess.run(["python", "bot/main.py"])
+    if not is_process_alive(status['pid']):
+        print(f"❌ Супервизор не запущен (последнее состояние от {status['updated_at']})")
+        return 1
 
-def run_admin_panel():
-    # Функция для запуска админ-панели.
-    subprocess.run(["python", "admin_panel/app.py"])
+    print(f"Супервизор pid {status['pid']}, готов: {'да' if status['ready'] else 'нет'}, обновлено {status['updated_at']}")
+    for service in status['services']:
+        health = {True: 'ok', False: 'ошибка', None: '-'}[service['healthy']]
+        print(
+            f"  {service['name']:<8} {service['state']:<8} pid {service['pid'] or '-':<7} "
+            f"аптайм {service['uptime']} с, перезапусков {service['restarts']}, "
+            f"проверка {health}, последний код выхода {service['last_exit_code']}"
+        )
+    return 0 if status['ready'] else 1
 
 if __name__ == '__main__':
-    # Запуск Telegram-бота в отдельном потоке
-    bot_thread = threading.Thread(target=run_bot)
-    bot_thread.start()
+    if len(sys.argv) > 1 and sys.argv[1] == 'status':
+        sys.exit(show_status())
 
-    # Запуск админ-панели в основном потоке
-    run_admin_panel()
\ No newline at end of file
+    Supervisor(build_services()).run()
@@ -0,0 +1,201 @@
+"""
+Нагрузочная проверка записи заказов из нескольких процессов (SQLite + WAL).
+
+    python scripts/bench_db_contention.py [--processes 8] [--orders 500] [--numbers 100000]
+    python scripts/bench_db_contention.py --baseline   # сначала с прежними настройками
+
+Две части:
+1. Каждый процесс в плотном цикле генерирует --numbers номеров заказов
+   (bot/order_numbers.py); родитель проверяет, что среди всех номеров нет
+   повторов, в том числе при исчерпании счетчика миллисекунды.
+2. Процессы одновременно оформляют --orders заказов каждый в общей базе
+   (заказ и позиция в одной транзакции, между ними чтение "мои заказы") через
+   create_db_engine. Еще один процесс, как синхронизация каталога в
+   админ-панели, держит транзакцию записи --sync-seconds секунд. Печатается
+   пропускная способность, задержки и число ошибок "database is locked" и
+   нарушений уникальности order_number.
+   С --baseline та же нагрузка сначала идет на отдельную базу, открытую
+   как раньше - create_engine без прагм (журнал отката, таймаут драйвера
+   5 с), чтобы сравнить число ошибок блокировки.
+
+Код выхода 1 при повторе номера, ошибке блокировки или потерянном заказе
+в прогоне с create_db_engine; ошибки прогона --baseline на него не влияют.
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_db_contention.db')
+
+def generate_numbers(count):
+    from bot.order_numbers import next_order_number
+    return [next_order_number() for _ in range(count)]
+
+def place_orders(worker, count, start_event, baseline_url=None):
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.exc import IntegrityError, OperationalError
+    from sqlalchemy.orm import sessionmaker
+    from bot.database import create_db_engine, User, Order, OrderItem
+
+    # Прежние точки входа открывали базу так, без прагм и busy_timeout
+    engine = create_engine(baseline_url) if baseline_url else create_db_engine('bot')
+    Session = sessionmaker(bind=engine)
+    db = Session()
+    try:
+        user = User(user_id=900000000 + worker, username=f"bench{worker}")
+        db.add(user)
+        db.commit()
+        user_id = user.id
+    finally:
+        db.close()
+
+    stats = {'orders': 0, 'locked': 0, 'duplicates': 0, 'errors': 0, 'latencies': []}
+    start_event.wait()
+    for _ in range(count):
+        started = time.perf_counter()
+        db = Session()
+        try:
+            db.query(func.count(Order.id)).filter(Order.user_id == user_id).scalar()
+            order = Order(user_id=user_id, total_amount=129000, status='pending',
+                          shipping_address='Тестовый адрес', phone_number='+70000000000')
+            db.add(order)
+            db.flush()
+            db.add(OrderItem(order_id=order.id, product_id=1, quantity=1, price=129000))
+            db.commit()
+            stats['orders'] += 1
+        except IntegrityError:
+            db.rollback()
+            stats['duplicates'] += 1
+        except OperationalError as e:
+            db.rollback()
+            if 'locked' in str(e):
+                stats['locked'] += 1
+            else:
+                stats['errors'] += 1
+        finally:
+            db.close()
+        stats['latencies'].append(time.perf_counter() - started)
+    return stats
+
+def sync_catalog(seconds, start_event, baseline_url=None):
+    """Долгая транзакция записи, как синхронизация товаров из админ-панели"""
+    from datetime import datetime
+    from sqlalchemy import create_engine, insert, update
+    from sqlalchemy.exc import OperationalError
+    from bot.database import create_db_engine, Product, Category
+
+    engine = create_engine(baseline_url) if baseline_url else create_db_engine('admin')
+    with engine.begin() as connection:
+        connection.execute(insert(Product), [
+            {'name': f"Синхронизация {number}", 'price': 129000, 'category': Category.POD}
+            for number in range(200)
+        ])
+    start_event.wait()
+    # Заказы уже идут
+    time.sleep(0.5)
+    started = time.perf_counter()
+    try:
+        with engine.begin() as connection:
+            while time.perf_counter() - started < seconds:
+                connection.execute(update(Product).values(last_checked=datetime.now()))
+                time.sleep(0.2)
+    except OperationalError as e:
+        return f"ошибка: {e.orig}"
+    return f"{time.perf_counter() - started:.1f} с"
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def run_orders(context, args, engine, baseline_url=None):
+    """Одновременное оформление заказов; возвращает True, если что-то пошло не так"""
+    from sqlalchemy import func
+    from sqlalchemy.orm import sessionmaker
+    from bot.database import Order
+
+    manager = context.Manager()
+    start_event = manager.Event()
+    with context.Pool(args.processes + 1) as pool:
+        pending = [pool.apply_async(place_orders, (worker, args.orders, start_event, baseline_url))
+                   for worker in range(args.processes)]
+        sync = pool.apply_async(sync_catalog, (args.sync_seconds, start_event, baseline_url))
+        # Все процессы создали пользователя и ждут - начинаем одновременно
+        time.sleep(2)
+        started = time.perf_counter()
+        start_event.set()
+        results = [result.get() for result in pending]
+        elapsed = time.perf_counter() - started
+        sync_result = sync.get()
+    manager.shutdown()
+
+    total = {key: sum(result[key] for result in results) for key in ('orders', 'locked', 'duplicates', 'errors')}
+    latencies = [latency for result in results for latency in result['latencies']]
+    db = sessionmaker(bind=engine)()
+    try:
+        stored = db.query(func.count(Order.id)).scalar()
+        distinct = db.query(func.count(func.distinct(Order.order_number))).scalar()
+    finally:
+        db.close()
+
+    print(f"Заказы: {total['orders']} за {elapsed:.2f} с ({total['orders'] / elapsed:.0f} в секунду), "
+          f"p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+    print(f"Ошибок блокировки: {total['locked']}, повторов номера: {total['duplicates']}, прочих ошибок: {total['errors']}")
+    print(f"В базе заказов: {stored}, разных номеров: {distinct}")
+    print(f"Транзакция синхронизации: {sync_result}")
+    return bool(total['locked'] or total['duplicates'] or total['errors']) or \
+        not (stored == distinct == args.processes * args.orders)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--orders', type=int, default=500, help='заказов на процесс')
+    parser.add_argument('--numbers', type=int, default=100000, help='номеров на процесс в первой части')
+    parser.add_argument('--sync-seconds', type=float, default=8.0,
+                        help='длительность транзакции синхронизации каталога (0 - без нее)')
+    parser.add_argument('--baseline', action='store_true',
+                        help='сначала прогнать заказы на базе с прежними настройками (без WAL и busy_timeout)')
+    args = parser.parse_args()
+
+    from sqlalchemy import create_engine, text
+    from bot.database import init_db, Base
+
+    engine = init_db()
+    print(f"База: {engine.url}, процессов: {args.processes}")
+    failed = False
+    context = multiprocessing.get_context('spawn')
+
+    started = time.perf_counter()
+    with context.Pool(args.processes) as pool:
+        batches = pool.map(generate_numbers, [args.numbers] * args.processes)
+    elapsed = time.perf_counter() - started
+    numbers = [number for batch in batches for number in batch]
+    repeated = len(numbers) - len(set(numbers))
+    print(f"Номера: {len(numbers)} за {elapsed:.2f} с, повторов {repeated}")
+    failed |= repeated > 0
+
+    if args.baseline:
+        if engine.dialect.name != 'sqlite':
+            print("--baseline имеет смысл только для SQLite, пропущено")
+        else:
+            # Отдельный файл: режим WAL сохраняется в самой базе
+            baseline_url = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_db_contention_baseline.db')
+            baseline_engine = create_engine(baseline_url)
+            Base.metadata.create_all(baseline_engine)
+            with baseline_engine.connect() as connection:
+                journal_mode = connection.execute(text('PRAGMA journal_mode')).scalar()
+            print(f"Прежние настройки: {baseline_url}, journal_mode={journal_mode}, таймаут драйвера 5 с")
+            run_orders(context, args, baseline_engine, baseline_url)
+            print("create_db_engine:")
+
+    failed |= run_orders(context, args, engine)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+"""
+Нагрузочная проверка журнала баланса (bot/ledger.py).
+
+    python scripts/bench_ledger.py [--transactions 5000] [--processes 8] [--payments 300]
+
+1. Пропускная способность apply_transaction в одном процессе: новая запись
+   с commit на каждую операцию (как зачисление платежа) и повтор уже
+   учтенного ключа (дубль опроса провайдера).
+2. Несколько процессов одновременно зачисляют один и тот же набор платежей
+   одному пользователю, каждый в своем порядке. Ключ (source, external_id)
+   должен попасть в журнал ровно один раз, а User.balance - совпасть с
+   суммой журнала.
+
+Код выхода 1 при повторе ключа или расхождении баланса.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_ledger.db')
+
+AMOUNT = 50000  # копейки
+
+def credit(Session, user_id, external_id):
+    """
+    Зачисление как в process_successful_payment: блокировка строки
+    пользователя, apply_transaction, commit. Возвращает 'credited',
+    'duplicate' или 'conflict' (гонка - нужно повторить).
+    """
+    from sqlalchemy.exc import IntegrityError, OperationalError
+    from bot.database import User
+    from bot.ledger import apply_transaction, SOURCE_PAYMENT
+
+    db = Session()
+    try:
+        user = db.query(User).filter(User.id == user_id).with_for_update().first()
+        _, created = apply_transaction(db, user, AMOUNT, SOURCE_PAYMENT, external_id)
+        db.commit()
+        return 'credited' if created else 'duplicate'
+    except IntegrityError:
+        # Ключ успел записать другой процесс - операция уже выполнена
+        db.rollback()
+        return 'duplicate'
+    except OperationalError as e:
+        db.rollback()
+        if 'locked' not in str(e):
+            raise
+        return 'conflict'
+    finally:
+        db.close()
+
+def credit_payments(worker, user_id, payment_ids, start_event):
+    from sqlalchemy.orm import sessionmaker
+    from bot.database import create_db_engine
+
+    Session = sessionmaker(bind=create_db_engine('bot'))
+    payment_ids = list(payment_ids)
+    random.Random(worker).shuffle(payment_ids)
+    stats = {'credited': 0, 'duplicate': 0, 'conflict': 0}
+    start_event.wait()
+    for payment_id in payment_ids:
+        while True:
+            outcome = credit(Session, user_id, payment_id)
+            stats[outcome] += 1
+            if outcome != 'conflict':
+                break
+    return stats
+
+def create_user(Session, telegram_id):
+    from bot.database import User
+    db = Session()
+    try:
+        user = User(user_id=telegram_id, username=f"bench{telegram_id}", balance=0)
+        db.add(user)
+        db.commit()
+        return user.id
+    finally:
+        db.close()
+
+def check_user(Session, user_id):
+    """Возвращает (баланс, сумма журнала, записей, повторов ключа)"""
+    from sqlalchemy import func
+    from bot.database import User, BalanceTransaction
+
+    db = Session()
+    try:
+        balance = db.query(User.balance).filter(User.id == user_id).scalar()
+        rows = db.query(func.count(BalanceTransaction.id), func.coalesce(func.sum(BalanceTransaction.amount), 0)) \
+            .filter(BalanceTransaction.user_id == user_id).one()
+        repeated = db.query(BalanceTransaction.source, BalanceTransaction.external_id) \
+            .group_by(BalanceTransaction.source, BalanceTransaction.external_id) \
+            .having(func.count(BalanceTransaction.id) > 1).count()
+        return balance, rows[1], rows[0], repeated
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--transactions', type=int, default=5000)
+    parser.add_argument('--processes', type=int, default=8)
+    parser.add_argument('--payments', type=int, default=300, help='платежей, которые зачисляют все процессы')
+    args = parser.parse_args()
+
+    from sqlalchemy.orm import sessionmaker
+    from bot.database import init_db
+
+    engine = init_db()
+    Session = sessionmaker(bind=engine)
+    print(f"База: {engine.url}")
+    failed = False
+
+    user_id = create_user(Session, 910000001)
+    started = time.perf_counter()
+    for number in range(args.transactions):
+        credit(Session, user_id, f"bench-{number}")
+    elapsed = time.perf_counter() - started
+    print(f"Новые операции: {args.transactions / elapsed:.0f} в секунду ({elapsed / args.transactions * 1000:.2f} мс)")
+
+    started = time.perf_counter()
+    for number in range(args.transactions):
+        credit(Session, user_id, f"bench-{number}")
+    elapsed = time.perf_counter() - started
+    print(f"Повторы учтенных операций: {args.transactions / elapsed:.0f} в секунду ({elapsed / args.transactions * 1000:.2f} мс)")
+
+    balance, total, rows, repeated = check_user(Session, user_id)
+    failed |= not (rows == args.transactions and balance == total == args.transactions * AMOUNT and repeated == 0)
+
+    user_id = create_user(Session, 910000002)
+    payment_ids = [f"race-{number}" for number in range(args.payments)]
+    context = multiprocessing.get_context('spawn')
+    start_event = context.Manager().Event()
+    with context.Pool(args.processes) as pool:
+        pending = [pool.apply_async(credit_payments, (worker, user_id, payment_ids, start_event))
+                   for worker in range(args.processes)]
+        time.sleep(2)
+        started = time.perf_counter()
+        start_event.set()
+        results = [result.get() for result in pending]
+    elapsed = time.perf_counter() - started
+
+    totals = {key: sum(result[key] for result in results) for key in ('credited', 'duplicate', 'conflict')}
+    balance, total, rows, repeated = check_user(Session, user_id)
+    print(f"{args.processes} процессов x {args.payments} платежей за {elapsed:.2f} с: зачислено {totals['credited']}, "
+          f"дублей {totals['duplicate']}, повторов после конфликта {totals['conflict']}")
+    print(f"Записей журнала: {rows}, повторов ключа: {repeated}, баланс {balance}, сумма журнала {total}")
+    failed |= not (totals['credited'] == rows == args.payments and repeated == 0
+                   and balance == total == args.payments * AMOUNT)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
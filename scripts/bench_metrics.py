@@ -0,0 +1,211 @@
+"""
+Накладные расходы сбора метрик (bot/metrics.py) на обработчик бота.
+
+    python scripts/bench_metrics.py [--rounds 30] [--budget 1.0]
+
+Обработчик - как просмотр категории в bot/main.py без обращения к
+Telegram: сессия, пользователь, товары категории, число позиций в
+корзине. Его время меряется на engine без метрик. Отдельно, в плотных
+циклах, меряется то, что метрики добавляют к каждому обработчику:
+call_site, HANDLER_SECONDS.time, две записи TELEGRAM_API_SECONDS (ответ
+и редактирование сообщения) и события пула instrument_engine на каждую
+выдачу соединения. Доля этих расходов от времени обработчика сравнивается
+с бюджетом --budget (в процентах); код выхода 1, если он превышен.
+
+Для справки печатается и прямое сравнение обработчика с метриками и без
+них - на общей машине его разброс больше самой надбавки. Также печатается
+стоимость отдельных операций и время render().
+"""
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_metrics.db')
+
+from sqlalchemy import create_engine, event, func
+from sqlalchemy.orm import sessionmaker
+from bot.database import (
+    init_db, create_db_engine, get_database_url, apply_sqlite_pragmas, SQLITE_PRAGMAS,
+    User, Product, CartItem, Category
+)
+from bot.metrics import (
+    Counter, Histogram, call_site, HANDLER_SECONDS, TELEGRAM_API_SECONDS, DEFAULT_BUCKETS
+)
+
+def best_per_call(function, iterations, repeats=5):
+    """Лучшее из нескольких повторов время одного вызова, за вычетом пустого цикла"""
+    def empty(n):
+        for _ in range(n):
+            pass
+
+    def measure(target):
+        timings = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            target(iterations)
+            timings.append(time.perf_counter() - started)
+        return min(timings) / iterations
+
+    return max(measure(function) - measure(empty), 0.0)
+
+def seed(Session):
+    db = Session()
+    try:
+        db.add(User(user_id=920000001, balance=0))
+        for number in range(200):
+            db.add(Product(name=f"Товар {number}", price=129000, category=Category.POD, is_active=True))
+        db.commit()
+    finally:
+        db.close()
+
+def plain_engine():
+    """Engine с теми же настройками, что create_db_engine, но без instrument_engine"""
+    url = get_database_url()
+    if not url.startswith('sqlite'):
+        return create_engine(url, pool_pre_ping=True)
+    engine = create_engine(url, pool_pre_ping=True, connect_args={'timeout': SQLITE_PRAGMAS['busy_timeout'] / 1000})
+    event.listen(engine, 'connect', apply_sqlite_pragmas)
+    return engine
+
+def category_handler(Session):
+    db = Session()
+    try:
+        db.query(User).filter(User.user_id == 920000001).first()
+        db.query(Product).filter(Product.category == Category.POD, Product.is_active == True).all()
+        db.query(func.count(CartItem.id)).filter(CartItem.user_id == 920000001).scalar()
+    finally:
+        db.close()
+
+def instrumented_handler(Session):
+    with call_site('bot:category'), HANDLER_SECONDS.time('category'):
+        category_handler(Session)
+        TELEGRAM_API_SECONDS.observe(0.05, 'answerCallbackQuery', '200')
+        TELEGRAM_API_SECONDS.observe(0.05, 'editMessageText', '200')
+
+def handler_time(handler, Session, calls):
+    started = time.perf_counter()
+    for _ in range(calls):
+        handler(Session)
+    return (time.perf_counter() - started) / calls
+
+def count_checkouts(engine, Session):
+    checkouts = []
+    listener = lambda *args: checkouts.append(1)
+    event.listen(engine, 'checkout', listener)
+    category_handler(Session)
+    event.remove(engine, 'checkout', listener)
+    return len(checkouts)
+
+def pool_event_cost(engine, iterations):
+    """Время событий checkout/checkin instrument_engine на одну выдачу соединения"""
+    proxy = engine.raw_connection()
+    try:
+        record = proxy._connection_record
+        dispatch = engine.pool.dispatch
+
+        def cycle(n):
+            for _ in range(n):
+                dispatch.checkout(proxy.dbapi_connection, record, proxy)
+                dispatch.checkin(proxy.dbapi_connection, record)
+        return best_per_call(cycle, iterations)
+    finally:
+        proxy.close()
+
+def handler_overhead(args):
+    instrumented = create_db_engine('bot')
+    InstrumentedSession = sessionmaker(bind=instrumented)
+    seed(InstrumentedSession)
+    PlainSession = sessionmaker(bind=plain_engine())
+
+    for _ in range(3):
+        category_handler(PlainSession)
+        instrumented_handler(InstrumentedSession)
+    plain_rounds = []
+    instrumented_rounds = []
+    for _ in range(args.rounds):
+        plain_rounds.append(handler_time(category_handler, PlainSession, args.calls))
+        instrumented_rounds.append(handler_time(instrumented_handler, InstrumentedSession, args.calls))
+    base = statistics.median(plain_rounds)
+
+    def site(n):
+        for _ in range(n):
+            with call_site('bot:category'):
+                pass
+
+    def handler_timer(n):
+        for _ in range(n):
+            with HANDLER_SECONDS.time('category'):
+                pass
+
+    def telegram(n):
+        for _ in range(n):
+            TELEGRAM_API_SECONDS.observe(0.05, 'editMessageText', '200')
+
+    checkouts = count_checkouts(instrumented, InstrumentedSession)
+    costs = {
+        'call_site': best_per_call(site, args.iterations),
+        'HANDLER_SECONDS.time': best_per_call(handler_timer, args.iterations),
+        'TELEGRAM_API_SECONDS x2': 2 * best_per_call(telegram, args.iterations),
+        f'события пула x{checkouts}': checkouts * pool_event_cost(instrumented, args.iterations),
+    }
+    total = sum(costs.values())
+    overhead = total / base * 100
+
+    print(f"Обработчик без метрик: {base * 1e6:.0f} мкс (медиана {args.rounds} серий по {args.calls})")
+    for title, cost in costs.items():
+        print(f"  {title}: {cost * 1e6:.2f} мкс")
+    print(f"Надбавка метрик: {total * 1e6:.1f} мкс на обработчик, {overhead:.2f}% (бюджет {args.budget}%)")
+    direct = (statistics.median(instrumented_rounds) / base - 1) * 100
+    print(f"Для справки, прямое сравнение медиан: {direct:+.1f}%")
+    return overhead
+
+def bench_operations(iterations):
+    counter = Counter('bench_total', 'bench', ['outcome'])
+    histogram = Histogram('bench_seconds', 'bench', ['handler'])
+
+    def inc(n):
+        for _ in range(n):
+            counter.inc('sent')
+
+    def observe(n):
+        for _ in range(n):
+            histogram.observe(0.012, 'category')
+
+    for title, function in (('Counter.inc', inc), ('Histogram.observe', observe)):
+        print(f"{title}: {best_per_call(function, iterations) * 1e9:.0f} нс")
+
+def bench_render(series):
+    histograms = [Histogram(f'bench_render_{index}_seconds', 'bench', ['handler', 'status']) for index in range(4)]
+    for histogram in histograms:
+        for number in range(series):
+            histogram.observe(0.01, f'handler_{number}', '200')
+    started = time.perf_counter()
+    body = '\n'.join(line for histogram in histograms for line in histogram.render())
+    elapsed = time.perf_counter() - started
+    print(f"render: 4 гистограммы x {series} рядов x {len(DEFAULT_BUCKETS) + 1} корзин - "
+          f"{elapsed * 1000:.1f} мс, {len(body) / 1024:.0f} КБ")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rounds', type=int, default=30)
+    parser.add_argument('--calls', type=int, default=50, help='вызовов обработчика в серии')
+    parser.add_argument('--iterations', type=int, default=100000)
+    parser.add_argument('--series', type=int, default=50, help='рядов (значений меток) на гистограмму')
+    parser.add_argument('--budget', type=float, default=1.0, help='допустимая надбавка, %%')
+    args = parser.parse_args()
+
+    init_db()
+    overhead = handler_overhead(args)
+    bench_operations(args.iterations)
+    bench_render(args.series)
+    return 1 if overhead > args.budget else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
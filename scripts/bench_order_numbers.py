@@ -0,0 +1,69 @@
+"""
+Скорость и уникальность номеров заказов (bot/order_numbers.py).
+
+    python scripts/bench_order_numbers.py [--numbers 200000] [--processes 8]
+
+Сначала один процесс генерирует --numbers номеров в плотном цикле, затем
+--processes процессов делают то же одновременно (с общим ORDER_NODE_ID, как
+бот, воркер и админ-панель на одной машине). Печатается число номеров в
+секунду. Проверяется, что среди всех номеров нет повторов, у каждого
+верный контрольный символ и в каждом процессе номера возрастают.
+
+Код выхода 1 при повторе, неверном номере или нарушении порядка.
+"""
+import os
+import sys
+import time
+import argparse
+import multiprocessing
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def generate_numbers(count):
+    from bot.order_numbers import next_order_number
+    started = time.perf_counter()
+    numbers = [next_order_number() for _ in range(count)]
+    return numbers, time.perf_counter() - started
+
+def check_batch(numbers):
+    """Возвращает (неверных номеров, нарушений порядка) в номерах одного процесса"""
+    from bot.order_numbers import is_valid_order_number
+    invalid = sum(1 for number in numbers if not is_valid_order_number(number))
+    # Тело номера - base32 фиксированной длины, поэтому строки сравниваются как числа
+    unordered = sum(1 for previous, number in zip(numbers, numbers[1:]) if number[:-1] <= previous[:-1])
+    return invalid, unordered
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--numbers', type=int, default=200000, help='номеров на процесс')
+    parser.add_argument('--processes', type=int, default=8)
+    args = parser.parse_args()
+
+    numbers, elapsed = generate_numbers(args.numbers)
+    invalid, unordered = check_batch(numbers)
+    repeated = len(numbers) - len(set(numbers))
+    print(f"Один процесс: {len(numbers)} номеров за {elapsed:.2f} с ({len(numbers) / elapsed:.0f} в секунду)")
+    print(f"  повторов {repeated}, неверных {invalid}, нарушений порядка {unordered}")
+    failed = bool(repeated or invalid or unordered)
+
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(args.processes) as pool:
+        # Процессы уже запущены - в замер не попадает их старт
+        pool.map(generate_numbers, [1] * args.processes)
+        started = time.perf_counter()
+        results = pool.map(generate_numbers, [args.numbers] * args.processes)
+        elapsed = time.perf_counter() - started
+
+    numbers = [number for batch, _ in results for number in batch]
+    repeated = len(numbers) - len(set(numbers))
+    checks = [check_batch(batch) for batch, _ in results]
+    invalid = sum(check[0] for check in checks)
+    unordered = sum(check[1] for check in checks)
+    print(f"{args.processes} процессов: {len(numbers)} номеров за {elapsed:.2f} с ({len(numbers) / elapsed:.0f} в секунду)")
+    print(f"  повторов {repeated}, неверных {invalid}, нарушений порядка {unordered}")
+    failed |= bool(repeated or invalid or unordered)
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,143 @@
+"""
+Проверка и замер SteamTraderClient на заглушке провайдера.
+
+    python scripts/bench_payment_client.py [--payments 500] [--concurrency 10] [--latency-ms 50]
+
+Сначала сценарии на scripts/fake_payment_provider.py: обычный платеж,
+токен отвергнут ответом 403 и ответом JSON (клиент один раз обновляет
+токен и повторяет), одновременные отказы (одно обновление на всех), 500
+провайдера и страница без токена (платеж не создан). Затем задержка
+create_payment: --payments платежей по --concurrency одновременно, токен
+меняется каждые 100 платежей. Печатаются p50/p95/p99, число
+TCP-соединений к заглушке и обновлений токена.
+
+Код выхода 1, если какой-то сценарий повел себя не так.
+"""
+import io
+import os
+import sys
+import time
+import asyncio
+import argparse
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+sys.path.insert(0, ROOT)
+
+from bot.payment_client import SteamTraderClient
+from fake_payment_provider import FakeProvider, start_fake_provider
+
+COOKIES = {'sid': 'bench-session', 'csrf_token': 'stale-token'}
+
+async def with_provider(provider, scenario):
+    runner, base_url = await start_fake_provider(provider)
+    client = SteamTraderClient(COOKIES, base_url=base_url)
+    try:
+        # Сообщения клиента о каждом платеже не нужны в отчете
+        with contextlib.redirect_stdout(io.StringIO()):
+            return await scenario(client)
+    finally:
+        await client.close()
+        await runner.cleanup()
+
+async def check_scenarios():
+    """Возвращает список (сценарий, успех, подробности)"""
+    results = []
+
+    async def single(client):
+        client.csrf_token = provider.token
+        return await client.create_payment(100)
+    provider = FakeProvider()
+    payment_id, url = await with_provider(provider, single)
+    results.append(("Обычный платеж", bool(payment_id) and payment_id in url and provider.pages == 0,
+                    f"id {payment_id}, страниц {provider.pages}"))
+
+    for reject in ('status', 'json'):
+        provider = FakeProvider(reject=reject)
+
+        async def stale(client):
+            payment = await client.create_payment(100)
+            return payment, client.csrf_refreshes, client.csrf_token
+        (payment_id, _), refreshes, token = await with_provider(provider, stale)
+        results.append((f"Токен отвергнут ({reject})",
+                        bool(payment_id) and refreshes == 1 and provider.rejected == 1 and token == provider.token,
+                        f"отказов {provider.rejected}, обновлений {refreshes}"))
+
+    provider = FakeProvider(latency=0.02)
+
+    async def concurrent(client):
+        payments = await asyncio.gather(*(client.create_payment(100) for _ in range(20)))
+        return payments, client.csrf_refreshes
+    payments, refreshes = await with_provider(provider, concurrent)
+    results.append(("20 одновременных отказов", all(payment_id for payment_id, _ in payments) and refreshes == 1,
+                    f"создано {sum(1 for payment_id, _ in payments if payment_id)}, обновлений {refreshes}, "
+                    f"загрузок страницы {provider.pages}"))
+
+    provider = FakeProvider(error_rate=1.0)
+
+    async def failing(client):
+        client.csrf_token = provider.token
+        return await client.create_payment(100)
+    payment = await with_provider(provider, failing)
+    results.append(("Ошибка 500 провайдера", payment == (None, None) and provider.errors == 1,
+                    f"ответов 500: {provider.errors}"))
+
+    provider = FakeProvider(page_token=False)
+
+    async def no_token(client):
+        return await client.create_payment(100)
+    payment = await with_provider(provider, no_token)
+    results.append(("Страница без токена", payment == (None, None) and provider.rejected == 1,
+                    f"отказов {provider.rejected}, загрузок страницы {provider.pages}"))
+    return results
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+async def bench_latency(payments, concurrency, latency):
+    provider = FakeProvider(latency=latency, rotate_every=100)
+
+    async def run(client):
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                payment_id, _ = await client.create_payment(100)
+                latencies.append(time.perf_counter() - started)
+                return payment_id
+
+        started = time.perf_counter()
+        created = await asyncio.gather(*(one() for _ in range(payments)))
+        return created, latencies, time.perf_counter() - started, client.csrf_refreshes
+
+    created, latencies, elapsed, refreshes = await with_provider(provider, run)
+    ok = sum(1 for payment_id in created if payment_id)
+    print(f"Платежей: {ok} из {payments} за {elapsed:.2f} с ({payments / elapsed:.0f} в секунду), "
+          f"одновременно {concurrency}, задержка провайдера {latency * 1000:.0f} мс")
+    print(f"create_payment: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, p95 {percentile(latencies, 0.95) * 1000:.1f} мс, "
+          f"p99 {percentile(latencies, 0.99) * 1000:.1f} мс")
+    print(f"TCP-соединений: {len(provider.connections)}, обновлений токена: {refreshes}, отказов по токену: {provider.rejected}")
+    return ok == payments
+
+async def run(args):
+    failed = False
+    for title, ok, details in await check_scenarios():
+        print(f"{'OK  ' if ok else 'FAIL'} {title}: {details}")
+        failed |= not ok
+    failed |= not await bench_latency(args.payments, args.concurrency, args.latency_ms / 1000)
+    return 1 if failed else 0
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--payments', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='задержка ответа заглушки')
+    args = parser.parse_args()
+    return asyncio.run(run(args))
+
+if __name__ == '__main__':
+    sys.exit(main())
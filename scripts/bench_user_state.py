@@ -0,0 +1,136 @@
+"""
+Нагрузочная проверка хранилища состояний диалога (bot/user_state.py).
+
+    python scripts/bench_user_state.py [--users 100000] [--db-users 2000]
+
+Заполняет UserStateStore состояниями --users пользователей (поиск и
+страница, категория и страница - как в bot/main.py) и печатает память на
+запись (tracemalloc), время get/set и число вытеснений при лимите
+STATE_CONFIG['max_entries']. Для сравнения считается память прежнего
+хранения - словарь со списком ORM-объектов Product на пользователя.
+С --db-users > 0 дополнительно меряется DatabaseStateBackend на временной
+базе SQLite двумя хранилищами, как две реплики бота: код выхода 1, если
+запись одной не видна другой сразу.
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_user_state.db')
+
+from bot.database import Product, Category, init_db
+from bot.user_state import UserStateStore, DatabaseStateBackend, STATE_CONFIG
+
+QUERIES = ['elf bar', 'husky', 'картридж', 'жидкость 30 мл', 'снюс мята', 'табак для кальяна']
+CATEGORIES = [category.name for category in Category]
+
+def typical_state(user_id):
+    """Состояние, которое бот хранит после поиска или выбора категории"""
+    if user_id % 2:
+        return {'search_query': random.choice(QUERIES), 'page': random.randint(0, 5)}
+    return {'category': random.choice(CATEGORIES), 'page': random.randint(0, 5)}
+
+def fill(store, users):
+    started = time.perf_counter()
+    for user_id in range(1, users + 1):
+        store.set(100000000 + user_id, **typical_state(user_id))
+    return time.perf_counter() - started
+
+def measure_memory(users, max_entries):
+    store = UserStateStore(max_entries=max_entries)
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    elapsed = fill(store, users)
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return store, size, elapsed
+
+def measure_get(store, users, reads=200000):
+    ids = [100000000 + random.randint(1, users) for _ in range(reads)]
+    started = time.perf_counter()
+    for user_id in ids:
+        store.get(user_id)
+    return time.perf_counter() - started, reads
+
+def measure_legacy(users, products_per_user=10):
+    """Прежний вариант: словарь состояний со списками ORM-объектов товаров"""
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    states = {}
+    for user_id in range(1, users + 1):
+        states[100000000 + user_id] = {
+            'search_results': [
+                Product(id=i, name=f"Товар {i}", price=99900, quantity=10, category=Category.POD,
+                        description='Описание товара ' * 5)
+                for i in range(products_per_user)
+            ],
+            'page': 0
+        }
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    size = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    return size
+
+def measure_database(users):
+    """Две реплики на одной базе: (время set, время get, сколько чужих записей видно сразу)"""
+    engine = init_db()
+    writer = UserStateStore(max_entries=users, backend=DatabaseStateBackend(engine))
+    reader = UserStateStore(max_entries=users, backend=DatabaseStateBackend(engine))
+    # Читающая реплика уже видела этих пользователей без состояния
+    for user_id in range(1, users + 1):
+        reader.get(100000000 + user_id)
+    set_time = fill(writer, users)
+    started = time.perf_counter()
+    visible = 0
+    for user_id in range(1, users + 1):
+        state = reader.get(100000000 + user_id)
+        visible += bool(state) and state == writer.get(100000000 + user_id)
+    return set_time, (time.perf_counter() - started) / 2, visible
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--legacy-users', type=int, default=10000,
+                        help='пользователей для замера прежнего хранения (ORM-объекты)')
+    parser.add_argument('--db-users', type=int, default=2000)
+    args = parser.parse_args()
+    random.seed(1)
+
+    print(f"Пользователей: {args.users}")
+    store, size, elapsed = measure_memory(args.users, args.users)
+    print(f"Без вытеснения: {size / 1024 / 1024:.1f} МБ, {size / args.users:.0f} байт на запись, "
+          f"set {elapsed / args.users * 1e6:.2f} мкс")
+    get_time, reads = measure_get(store, args.users)
+    print(f"get: {get_time / reads * 1e6:.2f} мкс")
+
+    limit = STATE_CONFIG['max_entries']
+    store, size, elapsed = measure_memory(args.users, limit)
+    metrics = store.get_metrics()
+    print(f"С лимитом {limit}: {size / 1024 / 1024:.1f} МБ, записей {metrics['entries']}, "
+          f"вытеснено {metrics['evictions']}")
+
+    if args.legacy_users:
+        legacy = measure_legacy(args.legacy_users)
+        print(f"Прежнее хранение (10 ORM-объектов на пользователя): {legacy / args.legacy_users:.0f} байт на запись, "
+              f"на {args.users} пользователей ~{legacy / args.legacy_users * args.users / 1024 / 1024:.0f} МБ")
+
+    if args.db_users:
+        set_time, get_time, visible = measure_database(args.db_users)
+        print(f"DatabaseStateBackend ({args.db_users} пользователей): set {set_time / args.db_users * 1000:.2f} мс, "
+              f"get {get_time / args.db_users * 1000:.2f} мс")
+        print(f"Записи одной реплики, сразу видные другой: {visible} из {args.db_users}")
+        if visible != args.db_users:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
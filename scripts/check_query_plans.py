@@ -0,0 +1,95 @@
+"""
+Проверка планов частых запросов (EXPLAIN QUERY PLAN, SQLite).
+
+    python scripts/check_query_plans.py
+
+Создает схему во временной базе (или в DATABASE_URL, если это SQLite) и
+проверяет, что горячие запросы бота, воркера и админ-панели идут по
+индексам из bot/database.py, а не полным просмотром таблицы. Код выхода 1,
+если хотя бы один запрос не использует ожидаемый индекс.
+"""
+import os
+import sys
+import tempfile
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'check_query_plans.db')
+
+from sqlalchemy import select, func, text, or_, and_
+from bot.database import (
+    init_db, Product, Category, Order, Payment, BalanceTransaction,
+    NotificationOutbox, StockCheckRequest, UserState
+)
+
+NOW = datetime(2026, 1, 1)
+
+# (описание, запрос, индекс, который должен быть в плане)
+HOT_QUERIES = [
+    ("Заказы пользователя (мои заказы)",
+     select(Order).where(Order.user_id == 1).order_by(Order.created_at.desc()),
+     'ix_orders_user_created'),
+    ("Заказы по статусу (админ-панель)",
+     select(Order).where(Order.status == 'pending').order_by(Order.created_at.desc()),
+     'ix_orders_status_created'),
+    ("Товары категории (каталог)",
+     select(Product).where(Product.category == Category.POD, Product.is_active == True),
+     'ix_products_category_active'),
+    ("Число товаров категории",
+     select(func.count(Product.id)).where(Product.category == Category.POD, Product.is_active == True),
+     'ix_products_category_active'),
+    ("Платежи на проверку (сверка)",
+     select(Payment).where(Payment.status == 'pending', Payment.next_check_at <= NOW)
+     .order_by(Payment.next_check_at),
+     'ix_payments_status_next_check'),
+    ("История баланса пользователя (следующая страница)",
+     select(BalanceTransaction).where(
+         BalanceTransaction.user_id == 1,
+         or_(BalanceTransaction.created_at < NOW,
+             and_(BalanceTransaction.created_at == NOW, BalanceTransaction.id < 100))
+     ).order_by(BalanceTransaction.created_at.desc(), BalanceTransaction.id.desc()),
+     'ix_balance_transactions_user_created'),
+    ("Очередь уведомлений",
+     select(NotificationOutbox).where(NotificationOutbox.status == 'pending', NotificationOutbox.next_attempt_at <= NOW)
+     .order_by(NotificationOutbox.next_attempt_at, NotificationOutbox.id),
+     'ix_notification_outbox_status_next'),
+    ("Заявки на проверку наличия",
+     select(StockCheckRequest.id).where(StockCheckRequest.status == 'pending'),
+     'ix_stock_check_requests_status'),
+    ("Просроченные состояния диалога",
+     select(UserState.user_id).where(UserState.expires_at < NOW),
+     'ix_user_states_expires'),
+]
+
+def query_plan(connection, query):
+    sql = str(query.compile(connection, compile_kwargs={'literal_binds': True}))
+    rows = connection.execute(text('EXPLAIN QUERY PLAN ' + sql)).fetchall()
+    return [row[-1] for row in rows]
+
+def main():
+    engine = init_db()
+    if engine.dialect.name != 'sqlite':
+        print(f"Проверка рассчитана на SQLite, а база - {engine.dialect.name}")
+        return 1
+
+    failed = 0
+    with engine.connect() as connection:
+        for title, query, index in HOT_QUERIES:
+            plan = query_plan(connection, query)
+            ok = any(index in step for step in plan)
+            print(f"{'OK  ' if ok else 'FAIL'} {title}: {'; '.join(plan)}")
+            if not ok:
+                print(f"     ожидался индекс {index}")
+                failed += 1
+
+    if failed:
+        print(f"Без ожидаемого индекса: {failed} из {len(HOT_QUERIES)}")
+        return 1
+    print(f"Все {len(HOT_QUERIES)} запросов используют индексы")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,120 @@
+"""
+Заглушка платежного провайдера для SteamTraderClient (bot/payment_client.py).
+
+    python scripts/fake_payment_provider.py [--port 8081] [--latency-ms 50] [--rotate-every 100]
+
+Отвечает так же, как steam-trader.com на запросы клиента:
+GET /deposit/ - страница пополнения с CSRF-токеном (в куки и в форме),
+POST /deposit/pay/ - создание платежа, {"success": true, "redirect": ...}.
+Без куки sid отвечает 401. Токен меняется каждые --rotate-every платежей,
+и запрос со старым токеном отвергается - ответом 403 или, с --reject json,
+ответом {"success": false, "error": "Invalid CSRF token"}, как делает сайт.
+--error-rate задает долю ответов 500.
+
+Для проверки локально укажите в боте base_url клиента, например
+SteamTraderClient(cookies, base_url='http://127.0.0.1:8081').
+Заглушку можно запустить и из кода: start_fake_provider(FakeProvider(...)).
+"""
+import sys
+import uuid
+import random
+import asyncio
+import secrets
+import argparse
+from aiohttp import web
+
+class FakeProvider:
+    def __init__(self, latency=0.0, rotate_every=0, reject='status', error_rate=0.0, page_token=True, seed=1):
+        self.latency = latency
+        self.rotate_every = rotate_every
+        self.reject = reject
+        self.error_rate = error_rate
+        # False - страница пополнения без токена (сайт сменил верстку)
+        self.page_token = page_token
+        self.rng = random.Random(seed)
+        self.token = secrets.token_hex(16)
+        self.payments = 0
+        self.rejected = 0
+        self.errors = 0
+        self.pages = 0
+        self.connections = set()
+
+    def rotate(self):
+        self.token = secrets.token_hex(16)
+
+    async def handle_deposit_page(self, request):
+        self.connections.add(id(request.transport))
+        if 'sid' not in request.cookies:
+            return web.Response(status=401)
+        await asyncio.sleep(self.latency)
+        self.pages += 1
+        if not self.page_token:
+            return web.Response(text='<html><form></form></html>', content_type='text/html')
+        response = web.Response(
+            text=f'<html><form><input type="hidden" name="csrf_token" value="{self.token}"></form></html>',
+            content_type='text/html'
+        )
+        response.set_cookie('csrf_token', self.token)
+        return response
+
+    async def handle_pay(self, request):
+        self.connections.add(id(request.transport))
+        if 'sid' not in request.cookies:
+            return web.Response(status=401)
+        form = await request.post()
+        await asyncio.sleep(self.latency)
+        if self.error_rate and self.rng.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=500, text='Internal Server Error')
+        if form.get('csrf_token') != self.token:
+            self.rejected += 1
+            if self.reject == 'json':
+                return web.json_response({'success': False, 'error': 'Invalid CSRF token'})
+            return web.Response(status=403, text='CSRF token mismatch')
+        try:
+            amount = int(form.get('amount', ''))
+        except ValueError:
+            return web.json_response({'success': False, 'error': 'Неверная сумма'})
+
+        self.payments += 1
+        if self.rotate_every and self.payments % self.rotate_every == 0:
+            self.rotate()
+        payment_id = uuid.uuid4().hex
+        return web.json_response({
+            'success': True,
+            'redirect': f'https://payment.tome.ge/{payment_id}',
+            'amount': amount
+        })
+
+    def create_app(self):
+        app = web.Application()
+        app.router.add_get('/deposit/', self.handle_deposit_page)
+        app.router.add_post('/deposit/pay/', self.handle_pay)
+        return app
+
+async def start_fake_provider(provider, host='127.0.0.1', port=0):
+    """Запускает заглушку в текущем цикле событий, возвращает (runner, base_url)"""
+    runner = web.AppRunner(provider.create_app())
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    bound_host, bound_port = runner.addresses[0][:2]
+    return runner, f'http://{bound_host}:{bound_port}'
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency-ms', type=float, default=50.0)
+    parser.add_argument('--rotate-every', type=int, default=100, help='менять CSRF-токен каждые N платежей (0 - никогда)')
+    parser.add_argument('--reject', choices=['status', 'json'], default='status')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    args = parser.parse_args()
+
+    provider = FakeProvider(args.latency_ms / 1000, args.rotate_every, args.reject, args.error_rate)
+    print(f"Заглушка провайдера: http://{args.host}:{args.port}, CSRF-токен {provider.token}")
+    web.run_app(provider.create_app(), host=args.host, port=args.port, print=None)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
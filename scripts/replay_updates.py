@@ -0,0 +1,212 @@
+"""
+Нагрузочный прогон обработки обновлений: PerUserUpdateProcessor и webhook.
+
+    python scripts/replay_updates.py [--updates 20000] [--users 500] [--workers 64]
+    python scripts/replay_updates.py --record updates.jsonl   # сохранить сгенерированные обновления
+    python scripts/replay_updates.py --input updates.jsonl    # воспроизвести записанные
+    python scripts/replay_updates.py --webhook                # через HTTP-сервер из bot/webhook.py
+
+Обновления (JSON как от Telegram, по одному на строку) воспроизводятся с
+максимальной скоростью. Как и Application, прогон создает задачу на каждое
+обновление из очереди и отдает ее PerUserUpdateProcessor; обработчик
+имитирует работу паузой. С --webhook обновления отправляются POST-запросами
+с секретным заголовком на сервер create_web_app, а он кладет их в очередь.
+
+Проверяется, что обновления каждого пользователя обработаны строго в
+порядке поступления в очередь, одновременно выполнялось не больше --workers
+обработчиков и все принятые обновления обработаны. Код выхода 1 при
+нарушении.
+"""
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Модули бота импортируются так же, как при запуске python bot/main.py
+sys.path.insert(0, os.path.join(ROOT, 'bot'))
+sys.path.insert(0, ROOT)
+
+from telegram import Update
+from update_processor import PerUserUpdateProcessor
+
+CALLBACKS = ['shop', 'category_POD', 'product_12', 'add_cart_12', 'cart', 'page_1', 'search_page_2', 'profile']
+COMMANDS = ['/start', '/menu', '/shop', '/cart', 'elf bar']
+SECRET = 'replay-secret'
+
+def generate_updates(count, users, seed=1):
+    """Обновления в формате Telegram Bot API: сообщения и нажатия кнопок"""
+    rng = random.Random(seed)
+    now = int(time.time())
+    updates = []
+    for update_id in range(1, count + 1):
+        user_id = 100000000 + rng.randrange(users)
+        user = {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+        message = {'message_id': update_id, 'date': now, 'chat': {'id': user_id, 'type': 'private'}, 'from': user}
+        if rng.random() < 0.3:
+            updates.append({'update_id': update_id, 'message': dict(message, text=rng.choice(COMMANDS))})
+        else:
+            updates.append({'update_id': update_id, 'callback_query': {
+                'id': str(update_id), 'from': user, 'chat_instance': str(user_id),
+                'data': rng.choice(CALLBACKS), 'message': dict(message, text='Меню')
+            }})
+    return updates
+
+class ReplayApplication:
+    """
+    То, что webhook и PerUserUpdateProcessor используют от Application:
+    update_queue, update_processor и разбор очереди задачей на обновление
+    """
+
+    def __init__(self, update_processor, handler_ms, slow_share):
+        self.bot = None
+        self.update_queue = asyncio.Queue()
+        self.update_processor = update_processor
+        self.handler_ms = handler_ms
+        self.slow_share = slow_share
+        self.rng = random.Random(2)
+        self.arrived = defaultdict(list)
+        self.handled = defaultdict(list)
+        self.enqueued_at = {}
+        self.latencies = []
+        self.running = 0
+        self.peak = 0
+        self.fetcher = None
+
+    async def start(self):
+        await self.update_processor.initialize()
+        self.fetcher = asyncio.create_task(self.fetch_updates())
+
+    async def fetch_updates(self):
+        while True:
+            update = await self.update_queue.get()
+            self.arrived[update.effective_user.id].append(update.update_id)
+            self.enqueued_at[update.update_id] = time.perf_counter()
+            asyncio.create_task(self.process_update_wrapper(update))
+
+    async def process_update_wrapper(self, update):
+        try:
+            await self.update_processor.process_update(update, self.handle(update))
+        finally:
+            self.update_queue.task_done()
+
+    async def handle(self, update):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        try:
+            delay = self.rng.expovariate(1000 / self.handler_ms)
+            if self.rng.random() < self.slow_share:
+                # Редкие долгие обработчики, как создание платежа
+                delay *= 50
+            await asyncio.sleep(delay)
+            self.handled[update.effective_user.id].append(update.update_id)
+            self.latencies.append(time.perf_counter() - self.enqueued_at[update.update_id])
+        finally:
+            self.running -= 1
+
+    async def stop(self):
+        await self.update_queue.join()
+        self.fetcher.cancel()
+        await self.update_processor.shutdown()
+
+async def replay_direct(application, updates):
+    for data in updates:
+        await application.update_queue.put(Update.de_json(data, None))
+
+async def replay_webhook(application, updates, connections):
+    from aiohttp import web, ClientSession, TCPConnector
+    from webhook import create_web_app, WEBHOOK_CONFIG, SECRET_HEADER
+
+    runner = web.AppRunner(create_web_app(application, SECRET))
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = runner.addresses[0][1]
+    url = f"http://127.0.0.1:{port}{WEBHOOK_CONFIG['path']}"
+
+    statuses = defaultdict(int)
+    # Как Telegram: обновления одного пользователя отправляются по порядку,
+    # разные пользователи - по нескольким соединениям одновременно
+    per_user = defaultdict(list)
+    for data in updates:
+        user = (data.get('message') or data.get('callback_query'))['from']['id']
+        per_user[user].append(data)
+    lanes = [[] for _ in range(connections)]
+    for index, user_updates in enumerate(per_user.values()):
+        lanes[index % connections].extend(user_updates)
+
+    async with ClientSession(connector=TCPConnector(limit=connections)) as session:
+        async def send(lane):
+            for data in sorted(lane, key=lambda item: item['update_id']):
+                async with session.post(url, json=data, headers={SECRET_HEADER: SECRET}) as response:
+                    statuses[response.status] += 1
+        await asyncio.gather(*(send(lane) for lane in lanes))
+        async with session.post(url, json=updates[0], headers={SECRET_HEADER: 'wrong'}) as response:
+            statuses[f"чужой секрет {response.status}"] += 1
+    await runner.cleanup()
+    return dict(statuses)
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))] if values else 0
+
+async def run(args, updates):
+    processor = PerUserUpdateProcessor(args.workers)
+    application = ReplayApplication(processor, args.handler_ms, args.slow_share)
+    await application.start()
+
+    started = time.perf_counter()
+    if args.webhook:
+        statuses = await replay_webhook(application, updates, args.connections)
+        print(f"Ответы webhook: {statuses}")
+    else:
+        await replay_direct(application, updates)
+    accepted = time.perf_counter() - started
+    await application.stop()
+    elapsed = time.perf_counter() - started
+
+    handled = sum(len(ids) for ids in application.handled.values())
+    arrived = sum(len(ids) for ids in application.arrived.values())
+    out_of_order = [user for user, ids in application.handled.items() if ids != application.arrived[user]]
+    print(f"Обновлений: {len(updates)}, пользователей: {len(application.arrived)}, обработчиков: {args.workers}")
+    print(f"Прием: {accepted:.2f} с, обработка: {elapsed:.2f} с ({handled / elapsed:.0f} в секунду)")
+    print(f"От очереди до конца обработки: p50 {percentile(application.latencies, 0.5) * 1000:.0f} мс, "
+          f"p99 {percentile(application.latencies, 0.99) * 1000:.0f} мс")
+    print(f"Одновременно выполнялось: {application.peak}, обработано {processor.processed} из {arrived}")
+    print(f"Пользователей с нарушенным порядком: {len(out_of_order)}")
+
+    ok = not out_of_order and application.peak <= args.workers and handled == arrived == len(updates)
+    return 0 if ok else 1
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=20000)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=64, help='как BOT_CONCURRENT_UPDATES')
+    parser.add_argument('--handler-ms', type=float, default=5.0, help='средняя длительность обработчика')
+    parser.add_argument('--slow-share', type=float, default=0.01, help='доля долгих обработчиков')
+    parser.add_argument('--input', help='файл с записанными обновлениями (JSON по строкам)')
+    parser.add_argument('--record', help='сохранить сгенерированные обновления в файл')
+    parser.add_argument('--webhook', action='store_true', help='отправлять обновления через HTTP-сервер webhook')
+    parser.add_argument('--connections', type=int, default=40, help='соединений к webhook, как max_connections')
+    args = parser.parse_args()
+
+    if args.input:
+        with open(args.input, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = generate_updates(args.updates, args.users)
+    if args.record:
+        with open(args.record, 'w', encoding='utf-8') as f:
+            for data in updates:
+                f.write(json.dumps(data, ensure_ascii=False) + '\n')
+        print(f"Записано {len(updates)} обновлений в {args.record}")
+
+    return asyncio.run(run(args, updates))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,173 @@
+"""
+Фоновый воркер: проверка наличия товаров и доставка уведомлений покупателям.
+
+    python worker.py
+
+Воркеров можно запустить несколько (на разных серверах) - работу выполняет
+только ведущий, выбранный через аренду в таблице worker_leases. Работа -
+задачи APScheduler (см. bot/scheduler.py): раз в
+CHECKER_CONFIG['sweep_interval'] секунд полная проверка всех товаров и
+каждые WORKER_CONFIG['poll_interval'] секунд заявки из админ-панели,
+а также доставка уведомлений покупателям из очереди notification_outbox
+(см. bot/notifications.py).
+Планировщик с задачами создает только ведущий; время последней полной
+проверки хранится в аренде, поэтому новый ведущий продолжает расписание,
+а не начинает полную проверку заново.
+"""
+import os
+import sys
+import signal
+import threading
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy.orm import sessionmaker
+from apscheduler.schedulers.background import BackgroundScheduler
+from bot.database import init_db
+from bot.leases import LeaseKeeper, publish_lease_info, read_lease
+from bot.metrics import call_site, gauge_function, start_metrics_server
+from bot.catalog_cache import bump_catalog_version_on
+from bot.scheduler import add_interval_job, instrument_scheduler
+from bot.notifications import NOTIFICATION_CONFIG, deliver_notifications, pending_notifications, purge_sent_notifications
+from admin_panel.stock_checker import CHECKER_CONFIG, crawler, run_sweep, process_check_requests, subscribe_availability_changes
+
+try:
+    from config import METRICS_HOST, WORKER_METRICS_PORT
+except ImportError:
+    METRICS_HOST = '127.0.0.1'
+    WORKER_METRICS_PORT = 9101
+
+WORKER_CONFIG = {
+    'lease_name': 'stock_checker',
+    'lease_ttl': 60,
+    'poll_interval': 5
+}
+
+stop_event = threading.Event()
+
+# Общие объекты для задач планировщика (engine, Session, аренда, состояние
+# проходов). Задачи живут в памяти планировщика ведущего (см. bot/scheduler.py)
+# и регистрируются без аргументов, поэтому берут их отсюда
+runtime = {}
+
+def request_stop(signum, frame):
+    stop_event.set()
+
+def load_last_sweep(Session):
+    db = Session()
+    try:
+        lease = read_lease(db, WORKER_CONFIG['lease_name'])
+    finally:
+        db.close()
+    if lease and lease['info'].get('last_sweep_at'):
+        return datetime.fromisoformat(lease['info']['last_sweep_at'])
+    return None
+
+def publish_state():
+    state = runtime['state']
+    state['crawler'] = crawler.get_metrics()
+    state['updated_at'] = datetime.now().isoformat()
+    publish_lease_info(runtime['engine'], WORKER_CONFIG['lease_name'], runtime['keeper'].holder, state)
+
+def sweep_stock():
+    """Задача планировщика: полная проверка наличия всех товаров"""
+    with call_site('worker:sweep'):
+        stats = run_sweep(runtime['Session'])
+    runtime['state'].update(last_sweep_at=datetime.now().isoformat(), last_sweep=stats)
+    print(f"Проверено {stats['checked']} товаров, изменений наличия: {stats['changed']}, не удалось проверить: {stats['unknown']}")
+    publish_state()
+
+def process_requests():
+    """Задача планировщика: заявки на проверку из админ-панели"""
+    with call_site('worker:requests'):
+        stats = process_check_requests(runtime['Session'])
+    if stats is not None:
+        runtime['state'].update(last_request_at=datetime.now().isoformat(), last_request=stats)
+        publish_state()
+
+def send_notifications():
+    """Задача планировщика: пачка уведомлений покупателям из очереди"""
+    with call_site('worker:notifications'):
+        stats = deliver_notifications(runtime['Session'])
+    if stats and (stats['retry'] or stats['failed']):
+        print(f"Уведомления: отправлено {stats['sent']}, повтор {stats['retry']}, не доставлено {stats['failed']}")
+
+def cleanup_notifications():
+    with call_site('worker:notifications'):
+        removed = purge_sent_notifications(runtime['Session'])
+    if removed:
+        print(f"Удалено {removed} отправленных уведомлений")
+
+def count_pending_notifications():
+    db = runtime['Session']()
+    try:
+        return pending_notifications(db)
+    finally:
+        db.close()
+
+def register_jobs(scheduler, last_sweep_at=None):
+    """
+    Задачи воркера. Первая полная проверка назначается через sweep_interval
+    после последней (время берется из аренды предыдущего ведущего), поэтому
+    после перезапуска или смены ведущего проверка не начинается заново;
+    просроченная выполняется сразу, один раз.
+    """
+    first_sweep = datetime.now()
+    if last_sweep_at is not None:
+        first_sweep = max(first_sweep, last_sweep_at + timedelta(seconds=CHECKER_CONFIG['sweep_interval']))
+    add_interval_job(
+        scheduler, sweep_stock, 'stock_sweep', CHECKER_CONFIG['sweep_interval'],
+        jitter=30, first_run=first_sweep, misfire_grace_time=CHECKER_CONFIG['sweep_interval']
+    )
+    add_interval_job(scheduler, process_requests, 'stock_check_requests', WORKER_CONFIG['poll_interval'])
+    add_interval_job(scheduler, send_notifications, 'notification_delivery', NOTIFICATION_CONFIG['poll_interval'])
+    add_interval_job(scheduler, cleanup_notifications, 'notification_cleanup', 24 * 3600, jitter=600)
+
+def start_scheduler(Session):
+    """Планировщик ведущего: задачи хранятся в памяти процесса, общего хранилища нет"""
+    # Состояние предыдущего ведущего - когда была последняя полная проверка
+    last_sweep_at = load_last_sweep(Session)
+    runtime['state'] = {'last_sweep_at': last_sweep_at.isoformat() if last_sweep_at else None}
+    scheduler = BackgroundScheduler()
+    instrument_scheduler(scheduler)
+    register_jobs(scheduler, last_sweep_at)
+    scheduler.start()
+    return scheduler
+
+def main():
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    engine = init_db('worker')
+    Session = sessionmaker(bind=engine)
+    # Изменение наличия меняет результаты поиска в боте
+    subscribe_availability_changes(lambda events: bump_catalog_version_on(engine))
+    start_metrics_server(WORKER_METRICS_PORT, METRICS_HOST)
+    keeper = LeaseKeeper(engine, WORKER_CONFIG['lease_name'], ttl=WORKER_CONFIG['lease_ttl'])
+    keeper.start()
+    runtime.update(engine=engine, Session=Session, keeper=keeper, state={})
+    gauge_function('shop_notification_queue', 'Уведомления, ожидающие отправки', count_pending_notifications)
+    print(f"🔧 Воркер проверки наличия запущен ({keeper.holder})")
+
+    # Планировщик есть только у ведущего: он создается при получении аренды
+    # и останавливается (с завершением текущей задачи) при ее потере
+    scheduler = None
+    try:
+        while not stop_event.is_set():
+            if keeper.is_leader and scheduler is None:
+                scheduler = start_scheduler(Session)
+                print("👑 Воркер стал ведущим, задачи запущены")
+            elif not keeper.is_leader and scheduler is not None:
+                print("Воркер потерял аренду, задачи остановлены")
+                scheduler.shutdown(wait=True)
+                scheduler = None
+            stop_event.wait(WORKER_CONFIG['poll_interval'])
+    finally:
+        if scheduler is not None:
+            scheduler.shutdown(wait=True)
+        keeper.stop()
+        print("🛑 Воркер проверки наличия остановлен")
+
+if __name__ == '__main__':
+    main()